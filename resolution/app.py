@@ -15,7 +15,8 @@ import tornado.httpserver
 from tornado.options import options
 import koi
 
-from .controllers import hub_key_handler, redirect_handler
+from .controllers import (batch_handler, hub_key_handler, invalidation, metrics, page_cache, redirect_handler,
+                          shared_cache, stats_handler, warm_up)
 from . import __version__
 
 # directory containing the config files
@@ -29,9 +30,13 @@ def make_application():
     application = tornado.web.Application([
         (r'/s0/.*', hub_key_handler.HubKeyHandler, {'version': __version__}),
         (r'/s1/.*', hub_key_handler.HubKeyHandler, {'version': __version__}),
+        (r'/batch', batch_handler.BatchHandler, {'version': __version__}),
+        (r'/metrics', metrics.MetricsHandler, {'version': __version__}),
+        (r'/stats', stats_handler.StatsHandler, {'version': __version__}),
+        (r'/invalidate', invalidation.InvalidationHandler, {'version': __version__}),
         (r'/assets/(.*)', tornado.web.StaticFileHandler, {'path': os.path.abspath(os.path.join(PWD, '../assets'))}),
         (r'/.*', redirect_handler.RedirectHandler, {'version': __version__}),
-    ])
+    ], template_path=page_cache.TEMPLATE_PATH, template_loader=page_cache.template_loader())
     return application
 
 
@@ -56,9 +61,36 @@ def main():
     koi.load_config(CONF_DIR)
     app = make_application()
     server = koi.make_server(app, CONF_DIR)
+    serve(server, int(options.processes))
+
+
+def serve(server, processes):
+    """
+    Start the server's processes, with the caches, metrics and invalidations
+    they share, and run the IOLoop
+
+    :param server: an HTTPServer bound to its port
+    :param processes: the number of processes, 0 for one per core
+    """
+    # The shared cache has to exist before forking to be shared by the workers
+    if options.memoize_backend == 'shared':
+        shared_cache.create_region(options.memoize_shared_slots,
+                                   options.memoize_shared_slot_bytes)
+
+    # Each process writes its metrics to this directory for /metrics
+    metrics.create_directory(options.metrics_dir or None)
+
+    # and reads the invalidations made by the others from this directory
+    invalidation.create_directory(options.invalidation_dir or None)
 
     # Forks multiple sub-processes, one for each core
-    server.start(int(options.processes))
+    server.start(processes)
+
+    metrics.start()
+    invalidation.start()
+
+    # Load providers and repositories into each worker's caches
+    warm_up.start()
 
     tornado.ioloop.IOLoop.instance().start()
 
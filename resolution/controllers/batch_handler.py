@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Resolve many hub keys or asset ids in one request"""
+import json
+import logging
+
+from koi import base, exceptions
+from tornado import httpclient
+from tornado.gen import coroutine, Return
+from tornado.options import options, define
+
+from hub_key_handler import (_asset_hub_key, _get_provider_by_name, _parse_hub_key, _redirect_url,
+                             canonical_hub_key, requested_hub_key, resolve_link_id_type)
+from parallel import gather
+from redirect_handler import _get_providers_by_type_and_id
+from resolution_index import asset_entry, hub_key_entry, provider_asset_entry, resolved
+
+define('batch_max_keys', default=500,
+       help='Maximum number of keys that can be resolved in one batch request')
+define('batch_concurrency', default=20,
+       help='Maximum number of keys resolved at once for a batch request')
+define('batch_timeout', default=30,
+       help='Number of seconds allowed to resolve a batch of keys')
+
+
+def _index_key(key):
+    """
+    Get the resolution index key for a batch key
+
+    :param key: a hub key, or a dict with "hubidt", "hubaid" and optionally "hubpid"
+    :returns: an index key
+    :raises: koi.exceptions.HTTPError if the key is invalid
+    """
+    if isinstance(key, basestring):
+        return hub_key_entry(canonical_hub_key(key))
+
+    if not isinstance(key, dict) or not key.get('hubidt') or not key.get('hubaid'):
+        raise exceptions.HTTPError(400, 'A key must be a hub key or include hubidt and hubaid')
+
+    if key.get('hubpid'):
+        return provider_asset_entry(key['hubpid'], key['hubidt'], key['hubaid'])
+    else:
+        return asset_entry(key['hubidt'], key['hubaid'])
+
+
+@coroutine
+def _resolve(key, result):
+    """Resolve a key, adding the status and redirect url to the result"""
+    index_key = _index_key(key)
+
+    target = resolved.lookup(index_key)
+    if target:
+        result.update(status=200, redirect=target)
+        return
+
+    if isinstance(key, basestring):
+        parsed_key = yield _parse_hub_key(requested_hub_key(key))
+        provider = parsed_key['provider']
+    else:
+        if key.get('hubpid'):
+            provider = yield _get_provider_by_name(key['hubpid'])
+        else:
+            providers = yield _get_providers_by_type_and_id(key['hubidt'], key['hubaid'])
+            if len(providers) != 1:
+                result.update(status=300, providers=[p.get('id') for p in providers])
+                return
+            provider = providers[0]
+
+        asset_key = yield _asset_hub_key(key['hubidt'], key['hubaid'])
+        parsed_key = yield _parse_hub_key(asset_key)
+
+    link = yield resolve_link_id_type(provider.get('reference_links'), parsed_key)
+    target = _redirect_url(link, parsed_key) if link else None
+    if target:
+        resolved.add(index_key, target)
+
+    result.update(status=200, provider_id=provider.get('id'), redirect=target)
+
+
+@coroutine
+def resolve_key(key):
+    """
+    Resolve a key to the provider's reference link, without rendering anything
+
+    :param key: a hub key, or a dict with "hubidt", "hubaid" and optionally "hubpid"
+    :returns: dict with the key, a status and the redirect url, if there is
+        one. Errors are included in the result rather than raised, because
+        the batch response has already started when a key is resolved
+    """
+    result = {'key': key}
+
+    try:
+        yield _resolve(key, result)
+    except exceptions.HTTPError as exc:
+        result.update(status=exc.status_code, errors=exc.errors)
+    except httpclient.HTTPError as exc:
+        result.update(status=exc.code, errors='Unexpected error ' + str(exc))
+    except Exception:
+        logging.exception('Unable to resolve %r', key)
+        result.update(status=500, errors='Unable to resolve the key')
+
+    raise Return(result)
+
+
+def _unique(keys):
+    """Remove duplicate keys, keeping the order of their first occurrence"""
+    seen = set()
+    unique = []
+    for key in keys:
+        identity = json.dumps(key, sort_keys=True)
+        if identity not in seen:
+            seen.add(identity)
+            unique.append(key)
+
+    return unique
+
+
+class BatchHandler(base.BaseHandler):
+    # resolving keys doesn't change anything, so only needs read access
+    METHOD_ACCESS = dict(base.BaseHandler.METHOD_ACCESS, POST=base.BaseHandler.READ_ACCESS)
+
+    def initialize(self, **kwargs):
+        try:
+            self.version = kwargs['version']
+        except KeyError:
+            raise KeyError('App version is required')
+        self.num_results = 0
+
+    @coroutine
+    def post(self):
+        """
+        Resolve a list of keys, e.g.
+            {"keys": ["https://openpermissions.org/s1/hub1/...",
+                      {"hubpid": "exampleco", "hubidt": "isbn", "hubaid": "9780000000000"}]}
+
+        Returns a JSON array with one result per unique key, which is
+        streamed as the keys are resolved, so the results are not in the
+        same order as the keys.
+        """
+        body = self.get_json_body(required=['keys'])
+        keys = body['keys']
+
+        if not isinstance(keys, list):
+            raise exceptions.HTTPError(400, 'keys must be a list')
+        if len(keys) > options.batch_max_keys:
+            raise exceptions.HTTPError(400, 'Too many keys, the maximum is {}'.format(options.batch_max_keys))
+
+        keys = _unique(keys)
+        pending = {json.dumps(key, sort_keys=True): key for key in keys}
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('[')
+
+        @coroutine
+        def resolve_and_write(key):
+            result = yield resolve_key(key)
+            if pending.pop(json.dumps(key, sort_keys=True), None) is not None:
+                self._write_result(result)
+                self.flush()
+
+        try:
+            yield gather(resolve_and_write, keys, options.batch_concurrency, options.batch_timeout)
+        except exceptions.HTTPError as exc:
+            # too late to change the response status, so report the keys
+            # that were not resolved in time
+            for key in pending.values():
+                self._write_result({'key': key, 'status': exc.status_code, 'errors': exc.errors})
+            pending.clear()
+
+        self.finish(']')
+
+    def _write_result(self, result):
+        if self.num_results:
+            self.write(',')
+        self.num_results += 1
+        self.write(json.dumps(result))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Collect upstream lookups made by concurrent requests and load them in batches.
+
+Keys requested while handling one IOLoop iteration (or within a short
+collection window) are passed together to a batch function, which makes one
+bulk request to the upstream service. The results are then passed back to
+each caller. Lookups from services without a bulk endpoint are not batched,
+as each caller would wait for the slowest call in its batch.
+
+A batch is loaded detached from the deadline of the request that queued the
+first key, and each caller waits for its result until its own deadline.
+"""
+from functools import partial
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import deadlines
+
+
+class BatchLoader(object):
+    """
+    Load keys in batches
+
+    :param batch_fn: coroutine function taking a list of keys and returning
+        a list with a result, or an exception, for each key in the same order
+    :param max_batch_size: (optional) load a batch as soon as it reaches this size
+    :param window: (optional) number of seconds to collect keys for, by
+        default keys are collected until the next IOLoop iteration
+    """
+    def __init__(self, batch_fn, max_batch_size=None, window=0):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.queue = []
+        self._timeout = None
+        self.num_batches = 0L
+        self.num_keys = 0L
+
+    def load(self, *key):
+        """
+        Queue a key to be loaded with the next batch
+
+        :param key: the arguments identifying the item to load
+        :returns: a Future resolving to the item
+        """
+        future = Future()
+        self.queue.append((key, future))
+
+        with deadlines.detached():
+            if self.max_batch_size and len(self.queue) >= self.max_batch_size:
+                self.dispatch()
+            elif len(self.queue) == 1:
+                if self.window:
+                    self._timeout = IOLoop.current().call_later(self.window, self.dispatch)
+                else:
+                    IOLoop.current().add_callback(self.dispatch)
+
+        return deadlines.shared(future)
+
+    def dispatch(self):
+        """Load the queued keys"""
+        # otherwise the window's timer would dispatch the next batch early
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+        queue, self.queue = self.queue, []
+        if not queue:
+            return
+
+        self.num_batches += 1
+        self.num_keys += len(queue)
+
+        keys = [key for key, _ in queue]
+        IOLoop.current().add_future(self.batch_fn(keys), partial(self._loaded, queue))
+
+    def _loaded(self, queue, future):
+        exc = future.exception()
+        results = [exc] * len(queue) if exc else future.result()
+        if len(results) != len(queue):
+            results = [ValueError('Batch of {} keys returned {} results'.format(len(queue), len(results)))] * \
+                len(queue)
+
+        for (_, waiter), result in zip(queue, results):
+            if isinstance(result, Exception):
+                waiter.set_exception(result)
+            else:
+                waiter.set_result(result)
+
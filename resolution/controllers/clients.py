@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Per-process pool of clients for the upstream services.
+
+chub.API creates a new HTTP client, and the SSL context is rebuilt by the
+caller, every time an API object is created. Instead each process keeps one
+HTTP client per upstream service URL, which is shared by all the API
+objects for that service. The curl client is used, so that connections are
+kept alive between requests, unless pycurl is not installed. The curl client
+is given the certificate files rather than an SSL context.
+
+Each upstream service has its own connect and request timeouts, calls are
+limited to the time left before the request's deadline, and a circuit
+breaker stops calling a service that is failing until it has had time to
+recover.
+"""
+import ssl
+import time
+from collections import deque
+from urlparse import urljoin
+
+from chub.api import API, API_VERSION, Resource
+from chub.handlers import async_fetch
+from koi import exceptions
+from koi.configure import ssl_server_options
+from tornado import httpclient
+from tornado.gen import coroutine, Return
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.options import options, define
+
+import deadlines
+
+try:
+    import pycurl  # noqa
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as _HTTPClient
+    _curl = True
+except ImportError:
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as _HTTPClient
+    _curl = False
+
+define('upstream_max_connections', default=20,
+       help='Maximum number of concurrent connections to each upstream service')
+define('upstream_connect_timeout', default=5,
+       help='Number of seconds allowed to connect to an upstream service')
+define('upstream_request_timeout', default=10,
+       help='Number of seconds allowed for a request to an upstream service')
+define('upstream_timeouts', default={},
+       help='Connect and request timeouts for particular upstream services, e.g. {"url_query": [2, 5]}, '
+            'keyed by url_accounts, url_auth, url_index, url_query or repository')
+define('circuit_breaker_window', default=20,
+       help='Number of recent calls to an upstream service used to decide whether it is failing')
+define('circuit_breaker_error_rate', default=0.5,
+       help='Fraction of recent calls to an upstream service that have to fail to stop calling it')
+define('circuit_breaker_reset_seconds', default=10,
+       help='Number of seconds to stop calling a failing upstream service before trying it again')
+
+# options for the upstream services, the repository services are configured
+# by the accounts service
+SERVICES = ('url_accounts', 'url_auth', 'url_index', 'url_query')
+
+
+class UpstreamUnavailable(exceptions.HTTPError):
+    """Raised instead of calling an upstream service while its circuit breaker is open"""
+
+
+def _is_failure(exc):
+    """Return True if exc means that the upstream service is unavailable or failing"""
+    if isinstance(exc, httpclient.HTTPError):
+        return exc.code >= 500
+    return not isinstance(exc, exceptions.HTTPError)
+
+
+def _ssl_defaults():
+    """
+    Get the SSL request defaults for the HTTP client
+
+    The curl client doesn't support ssl_options, so is given the same
+    certificates and verification as the SSL context used by the simple client
+
+    :returns: dict of HTTPRequest arguments
+    """
+    if _curl:
+        return {'ca_certs': options.ssl_ca_cert,
+                'client_cert': options.ssl_cert,
+                'client_key': options.ssl_key,
+                'validate_cert': options.ssl_cert_reqs != ssl.CERT_NONE}
+    return {'ssl_options': ssl_server_options()}
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling an upstream service when too many recent calls failed
+
+    The circuit opens when at least `error_rate` of the last `window` calls
+    failed. After `reset_seconds` one call is let through: the circuit closes
+    if it succeeds and stays open for another `reset_seconds` if it fails.
+    Only the outcome of that trial call changes the state of an open circuit.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    # returned by allow for the trial call
+    TRIAL = 'trial'
+
+    def __init__(self, window, error_rate, reset_seconds):
+        self.outcomes = deque(maxlen=window)
+        self.error_rate = error_rate
+        self.reset_seconds = reset_seconds
+        self.opened = None
+        self.trial = False
+        self.num_opened = 0L
+        self.num_rejected = 0L
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return self.CLOSED
+        return self.HALF_OPEN if self.trial else self.OPEN
+
+    def allow(self):
+        """
+        Check whether a call can be made
+
+        :returns: TRIAL if the call is the trial call of an open circuit,
+            otherwise True if the call can be made
+        """
+        if self.opened is None:
+            return True
+
+        if not self.trial and time.time() - self.opened >= self.reset_seconds:
+            self.trial = True
+            return self.TRIAL
+
+        self.num_rejected += 1
+        return False
+
+    def record(self, failed, allowed=True):
+        """
+        Record the outcome of a call
+
+        :param failed: True if the call failed
+        :param allowed: (optional) what allow returned for the call
+        """
+        if self.opened is not None:
+            # calls made before the circuit opened don't decide the trial
+            if allowed == self.TRIAL:
+                self.trial = False
+                if failed:
+                    self.opened = time.time()
+                else:
+                    self.opened = None
+                    self.outcomes.clear()
+            return
+
+        self.outcomes.append(failed)
+        if (len(self.outcomes) == self.outcomes.maxlen and
+                sum(self.outcomes) >= self.error_rate * len(self.outcomes)):
+            self.opened = time.time()
+            self.num_opened += 1
+
+
+class Upstream(object):
+    """The HTTP client and usage counters for one upstream service"""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.name = _service_name(base_url)
+        self.max_connections = options.upstream_max_connections
+        self.connect_timeout, self.request_timeout = options.upstream_timeouts.get(
+            self.name, (options.upstream_connect_timeout, options.upstream_request_timeout))
+        self.http_client = _HTTPClient(force_instance=True,
+                                       max_clients=self.max_connections,
+                                       defaults=dict(_ssl_defaults(),
+                                                     connect_timeout=self.connect_timeout,
+                                                     request_timeout=self.request_timeout))
+        self.breaker = CircuitBreaker(options.circuit_breaker_window,
+                                      options.circuit_breaker_error_rate,
+                                      options.circuit_breaker_reset_seconds)
+        self.active = 0
+        self.peak_active = 0
+        self.num_requests = 0L
+        self.num_deadline_exceeded = 0L
+
+    @coroutine
+    def fetch(self, request, method, default_headers=None, **kwargs):
+        """Make a request with the shared client, see chub.handlers.async_fetch"""
+        request = self._limit_to_deadline(request)
+
+        allowed = self.breaker.allow()
+        if not allowed:
+            raise UpstreamUnavailable(503, 'Service unavailable', source=self.name)
+
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        self.num_requests += 1
+
+        try:
+            result = yield async_fetch(request, method, default_headers,
+                                       httpclient=self.http_client, **kwargs)
+        except Exception as exc:
+            self.breaker.record(_is_failure(exc), allowed)
+            raise
+        else:
+            self.breaker.record(False, allowed)
+        finally:
+            self.active -= 1
+
+        raise Return(result)
+
+    def _limit_to_deadline(self, request):
+        """
+        Shorten the request's timeouts to the time left before the deadline
+
+        :param request: a url or HTTPRequest
+        :returns: the url or HTTPRequest to fetch
+        :raises: koi.exceptions.HTTPError if the deadline has passed
+        """
+        remaining = deadlines.remaining()
+        if remaining is None or remaining >= self.request_timeout:
+            return request
+
+        if remaining <= 0:
+            self.num_deadline_exceeded += 1
+            raise exceptions.HTTPError(504, 'Timed out waiting for upstream services', source=self.name)
+
+        if not isinstance(request, HTTPRequest):
+            request = HTTPRequest(request)
+        request.connect_timeout = min(self.connect_timeout, remaining)
+        request.request_timeout = remaining
+
+        return request
+
+    def stats(self):
+        """Return the pool utilisation for this upstream service"""
+        return {
+            'name': self.name,
+            'circuit': self.breaker.state,
+            'circuit_opened': self.breaker.num_opened,
+            'circuit_rejected': self.breaker.num_rejected,
+            'deadline_exceeded': self.num_deadline_exceeded,
+            'max_connections': self.max_connections,
+            'active': self.active,
+            'peak_active': self.peak_active,
+            'queued': len(getattr(self.http_client, 'queue', ())),
+            'requests': self.num_requests
+        }
+
+
+def _service_name(base_url):
+    """Get the option name for an upstream service's URL, or 'repository'"""
+    for name in SERVICES:
+        if getattr(options, name, None) == base_url:
+            return name
+    return 'repository'
+
+
+class Client(API):
+    """An API client using a pooled upstream HTTP client"""
+    def __init__(self, upstream, token=None):
+        self.base_url = urljoin(upstream.base_url, API_VERSION)
+        Resource.__init__(self, self.base_url, upstream.fetch)
+        if token:
+            self.token = token
+
+
+_upstreams = {}
+
+
+def get_upstream(base_url):
+    """
+    Get the pooled upstream for a service URL, creating it if this is the
+    first request to the service from this process (or IOLoop)
+
+    :param base_url: the service's URL
+    :returns: Upstream
+    """
+    upstream = _upstreams.get(base_url)
+    if upstream is None or upstream.http_client.io_loop is not IOLoop.current():
+        upstream = _upstreams[base_url] = Upstream(base_url)
+
+    return upstream
+
+
+def get_client(base_url, token=None):
+    """
+    Get an API client for an upstream service
+
+    :param base_url: the service's URL
+    :param token: (optional) an OAuth token
+    :returns: Client
+    """
+    return Client(get_upstream(base_url), token=token)
+
+
+def stats():
+    """Return the pool utilisation for every upstream service"""
+    return [upstream.stats() for upstream in _upstreams.values()]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Deadline for handling a request.
+
+The deadline is kept in a tornado StackContext, so it follows the request
+through every coroutine and callback started while handling it, and each
+upstream call made for the request is limited to the time that is left.
+Work shared by several requests is started detached from any request's
+deadline, and each request waits for it with shared().
+"""
+import contextlib
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+
+from koi import exceptions
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.options import options, define
+from tornado.stack_context import NullContext, StackContext
+
+define('request_deadline_seconds', default=30,
+       help='Number of seconds allowed for all the upstream calls made for a request (0 for no deadline)')
+
+
+class _State(threading.local):
+    deadline = None
+
+
+_state = _State()
+
+
+@contextlib.contextmanager
+def _deadline_context(deadline):
+    previous = _state.deadline
+    _state.deadline = deadline
+    try:
+        yield
+    finally:
+        _state.deadline = previous
+
+
+def run(fn, *args, **kwargs):
+    """
+    Call a coroutine function with a deadline of request_deadline_seconds
+
+    :param fn: coroutine function
+    :returns: the function's Future
+    """
+    if not options.request_deadline_seconds:
+        return fn(*args, **kwargs)
+
+    with StackContext(partial(_deadline_context, time.time() + options.request_deadline_seconds)):
+        return fn(*args, **kwargs)
+
+
+def remaining():
+    """
+    Get the time left before the current request's deadline
+
+    :returns: number of seconds, or None if there is no deadline
+    """
+    if _state.deadline is None:
+        return None
+
+    return _state.deadline - time.time()
+
+
+@contextlib.contextmanager
+def detached():
+    """
+    Context manager for starting work that is not part of the current
+    request, e.g. background refreshes, so it is not limited by the
+    request's deadline
+    """
+    with NullContext(), _deadline_context(None):
+        yield
+
+
+@coroutine
+def shared(future):
+    """
+    Wait for work shared with other requests, e.g. a coalesced upstream call,
+    for no longer than the time left before the current request's deadline
+
+    :param future: a Future started detached from any deadline
+    :returns: the future's result
+    :raises: koi.exceptions.HTTPError if the deadline passes first
+    """
+    left = remaining()
+    if left is None:
+        result = yield future
+        raise Return(result)
+
+    try:
+        # errors after the timeout are for the other requests to handle
+        result = yield gen.with_timeout(timedelta(seconds=max(left, 0)), future, quiet_exceptions=Exception)
+    except gen.TimeoutError:
+        raise exceptions.HTTPError(504, 'Timed out waiting for upstream services')
+
+    raise Return(result)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+HTTP caching headers for resolution responses, so that caches in front of the
+service can answer repeated requests
+"""
+import hashlib
+import json
+
+from tornado.options import options, define
+
+define('cache_control_redirect', default='public, max-age=300',
+       help='Cache-Control header for redirects to a reference link (empty for none)')
+define('cache_control_asset_page', default='public, max-age=60',
+       help='Cache-Control header for asset pages (empty for none)')
+define('cache_control_provider_page', default='public, max-age=300',
+       help='Cache-Control header for provider landing pages (empty for none)')
+define('cache_control_json', default='public, max-age=60',
+       help='Cache-Control header for JSON requested with hubjson (empty for none)')
+define('cache_control_error', default='no-cache',
+       help='Cache-Control header for errors (empty for none)')
+
+REDIRECT = 'redirect'
+ASSET_PAGE = 'asset_page'
+PROVIDER_PAGE = 'provider_page'
+JSON = 'json'
+ERROR = 'error'
+
+
+def set_cache_headers(handler, response_type, vary=None):
+    """
+    Set the Cache-Control and Vary headers for a type of response
+
+    :param handler: the RequestHandler
+    :param response_type: one of REDIRECT, ASSET_PAGE, PROVIDER_PAGE, JSON or ERROR
+    :param vary: (optional) request header(s) the response depends on,
+        other than the url
+    """
+    cache_control = getattr(options, 'cache_control_' + response_type)
+    if cache_control:
+        handler.set_header('Cache-Control', cache_control)
+
+    if vary:
+        handler.set_header('Vary', vary)
+
+
+def etag(data):
+    """
+    Make a strong ETag from resolved data
+
+    :param data: JSON serialisable data that a response is made from
+    :returns: an ETag header value
+    """
+    return '"{}"'.format(hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest())
+
+
+def not_modified(handler, tag):
+    """
+    Set the ETag header and respond with 304 Not Modified if it matches the
+    request's If-None-Match header
+
+    :param handler: the RequestHandler
+    :param tag: the response's ETag
+    :returns: True if the response has been finished
+    """
+    handler.set_header('ETag', tag)
+
+    if handler.check_etag_header():
+        handler.set_status(304)
+        handler.finish()
+        return True
+
+    return False
@@ -8,27 +8,54 @@
 # See the License for the specific language governing permissions and limitations under the License.
 
 """Resolve a Hub Key"""
+import hashlib
+import json
+import re
+import time
 import urllib
 
 from urllib import urlencode, unquote
 from urlparse import urlparse, parse_qs, urlunparse
 
 from bass import hubkey
-from chub import API
 from koi import base, exceptions
-from koi.configure import ssl_server_options
 from tornado import httpclient
-from tornado.gen import coroutine, Return
-from tornado.options import options
-
-from chub.oauth2 import Read, get_token
-
+from tornado.gen import coroutine, maybe_future, Return
+from tornado.options import options, define
+
+from batching import BatchLoader
+import deadlines
+from clients import get_client
+from http_cache import ASSET_PAGE, ERROR, JSON, REDIRECT, etag, not_modified, set_cache_headers
+from link_rules import index_source_ids, payment_link_rule, reference_link_rule
+import metrics
 from memoize import MemoizeCoroutine
+from page_cache import pages
+from parallel import gather
+from records import AssetDetails, Provider, Repository, plain
+from resolution_index import hub_key_entry, resolved
+from tokens import read_token
 
 import logging
 
+define('resolve_reference_link_first', default=True,
+       help='Redirect to a reference link without fetching asset details and offers')
+define('offers_batch_window', default=0.002,
+       help='Number of seconds to collect offers lookups for, to fetch them in one request')
+define('offers_batch_max_size', default=50,
+       help='Maximum number of assets to fetch offers for in one request')
+define('offers_batch_ids', default=True,
+       help='Whether the query service includes the source_id_type and source_id in each offer, '
+            'which is needed to fetch offers for several assets in one request')
+define('hub_key_host', default='',
+       help='Host used in the cache keys of all hub keys, so that keys using any of the service\'s '
+            'host names share cache entries (the requested host is kept if empty)')
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+UNRESERVED = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-._~')
+PERCENT_ENCODED = re.compile('%([0-9a-fA-F]{2})')
+
 @MemoizeCoroutine
-@coroutine
 def _get_repository(repository_id):
     """Get a repository from the accounts service
 
@@ -36,11 +63,16 @@ def _get_repository(repository_id):
     :returns: repository resource
     :raises: koi.exceptions.HTTPError
     """
-    client = API(options.url_accounts, ssl_options=ssl_server_options())
+    return _fetch_repository(repository_id)
+
+@coroutine
+def _fetch_repository(repository_id):
+    """Fetch a repository from the accounts service, see _get_repository"""
+    client = get_client(options.url_accounts)
 
     try:
         repo = yield client.accounts.repositories[repository_id].get()
-        raise Return(repo)
+        raise Return(Repository.from_resource(repo['data']))
     except httpclient.HTTPError as exc:
         if exc.code == 404:
             msg = 'Unknown repository ID'
@@ -58,11 +90,28 @@ def _get_provider_by_name(provider):
     :returns: organisation resource
     :raises: koi.exceptions.HTTPError
     """
-    client = API(options.url_accounts, ssl_options=ssl_server_options())
+    document = yield _fetch_provider_document_by_name(provider)
+    raise Return(Provider.from_resource(document))
+
+@MemoizeCoroutine
+def _get_provider_document_by_name(provider):
+    """Get a provider's full organisation resource, which is only needed for
+    JSON responses, see _get_provider_by_name
+
+    :param provider: str
+    :returns: dict
+    :raises: koi.exceptions.HTTPError
+    """
+    return _fetch_provider_document_by_name(provider)
+
+@coroutine
+def _fetch_provider_document_by_name(provider):
+    """Fetch an organisation by name from the accounts service"""
+    client = get_client(options.url_accounts)
 
     try:
         res = yield client.accounts.organisations.get(name=provider)
-        raise Return(res['data'][0])
+        raise Return(plain(res['data'][0]))
     except httpclient.HTTPError as exc:
         if exc.code == 404:
             msg = 'Unknown provider'
@@ -72,7 +121,6 @@ def _get_provider_by_name(provider):
         raise exceptions.HTTPError(exc.code, msg, source='accounts')
 
 @MemoizeCoroutine
-@coroutine
 def _get_provider(provider_id):
     """Get a provider from the accounts service
 
@@ -80,11 +128,33 @@ def _get_provider(provider_id):
     :returns: organisation resource
     :raises: koi.exceptions.HTTPError
     """
-    client = API(options.url_accounts, ssl_options=ssl_server_options())
+    return _fetch_provider(provider_id)
+
+@coroutine
+def _fetch_provider(provider_id):
+    """Fetch a provider from the accounts service, see _get_provider"""
+    document = yield _fetch_provider_document(provider_id)
+    raise Return(Provider.from_resource(document))
+
+@MemoizeCoroutine
+def _get_provider_document(provider_id):
+    """Get a provider's full organisation resource, which is only needed for
+    JSON responses, see _get_provider
+
+    :param provider_id: str
+    :returns: dict
+    :raises: koi.exceptions.HTTPError
+    """
+    return _fetch_provider_document(provider_id)
+
+@coroutine
+def _fetch_provider_document(provider_id):
+    """Fetch an organisation from the accounts service"""
+    client = get_client(options.url_accounts)
 
     try:
         org = yield client.accounts.organisations[provider_id].get()
-        raise Return(org)
+        raise Return(plain(org['data']))
     except httpclient.HTTPError as exc:
         if exc.code == 404:
             msg = 'Unknown provider ID'
@@ -93,8 +163,6 @@ def _get_provider(provider_id):
 
         raise exceptions.HTTPError(exc.code, msg, source='accounts')
 
-@MemoizeCoroutine
-@coroutine
 def _get_ids(repository_id, entity_id):
     """Get ids from the repository service
 
@@ -102,15 +170,30 @@ def _get_ids(repository_id, entity_id):
     :returns: organisation resource
     :raises: koi.exceptions.HTTPError
     """
+    return _fetch_ids(repository_id, entity_id)
+
+@MemoizeCoroutine
+@coroutine
+def _get_source_ids_by_type(repository_id, entity_id):
+    """Get an asset's source ids from the repository service, indexed by
+    their normalised type
+
+    :param repository_id: str
+    :param entity_id: str
+    :returns: dict of source id type to source id, see link_rules.index_source_ids
+    :raises: koi.exceptions.HTTPError
+    """
+    source_ids = yield _get_ids(repository_id, entity_id)
+    raise Return(index_source_ids(source_ids))
+
+@coroutine
+def _fetch_ids(repository_id, entity_id):
+    """Fetch ids from the repository service, see _get_ids"""
     repository = yield _get_repository(repository_id)
-    repository_url = repository['data']['service']['location']
+    repository_url = repository.location
 
-    token = yield get_token(
-        options.url_auth, options.service_id,
-        options.client_secret, scope=Read(),
-        ssl_options=ssl_server_options()
-    )
-    client = API(repository_url, token=token, ssl_options=ssl_server_options())
+    token = yield read_token.get()
+    client = get_client(repository_url, token=token)
 
     try:
         res = yield client.repository.repositories[repository_id].assets[entity_id].ids.get()
@@ -127,20 +210,18 @@ def _get_repos_for_source_id(source_id_type, source_id):
     :returns: organisation resource
     :raises: koi.exceptions.HTTPError
     """
-    token = yield get_token(
-        options.url_auth, options.service_id,
-        options.client_secret, scope=Read(),
-        ssl_options=ssl_server_options()
-    )
-    client = API(options.url_index, token=token, ssl_options=ssl_server_options())
+    token = yield read_token.get()
+    client = get_client(options.url_index, token=token)
     repos = yield client.index['entity-types']['asset']['id-types'][source_id_type].ids[source_id].repositories.get()
     raise Return(repos['data']['repositories'])
 
-@MemoizeCoroutine
 @coroutine
 def _parse_hub_key(hub_key):
     """Parse a hub key
 
+    The key isn't memoized, as its fields are used in links exactly as
+    requested, but the provider's lookups are.
+
     :param key: a hub key
     :returns: a parsed hub key, including the provider organisation
     :raises: koi.exceptions.HTTPError
@@ -152,89 +233,69 @@ def _parse_hub_key(hub_key):
             provider = yield _get_provider(parsed['organisation_id'])
         else:
             repository = yield _get_repository(parsed['repository_id'])
-            provider = yield _get_provider(repository['data']['organisation']['id'])
+            provider = yield _get_provider(repository.organisation_id)
     except ValueError as exc:
         raise exceptions.HTTPError(404, 'Invalid hub key: ' + exc.message)
 
-    parsed['provider'] = provider['data']
-    parsed['provider']['website'] = _parse_url(parsed['provider'].get('website', ''))
+    parsed['provider'] = provider.copy(website=_parse_url(provider.get('website', '')))
     parsed['hub_key'] = hub_key
 
     raise Return(parsed)
 
 @coroutine
 def resolve_link_id_type(reference_links, parsed_key):
-    if not reference_links:
-        raise Return(None)
-
-    redirect_id_type = reference_links.get('redirect_id_type')
+    rule = reference_link_rule(reference_links)
 
-    if not redirect_id_type:
+    if not rule:
         raise Return(None)
 
-    redirect_id_type = redirect_id_type.lower()
+    if not rule.uses_source_id:
+        raise Return(rule.template)
 
-    _link_for_id_type = reference_links.get("links",{}).get(redirect_id_type)
-
-    if not _link_for_id_type:
+    if not rule.valid:
         raise Return(None)
 
-    if '{source_id}' not in _link_for_id_type:
-        raise Return(_link_for_id_type)
-
     if "id_type" in parsed_key:
         # s0 key
-        if parsed_key['id_type'] == redirect_id_type:
-            source_ids = [{'source_id_type': parsed_key['id_type'], 'source_id': parsed_key['entity_id']}]
+        if parsed_key['id_type'] == rule.id_type:
+            source_id = urllib.unquote(parsed_key['entity_id'])
         else:
             repo_ids = yield _get_repos_for_source_id(parsed_key['id_type'], parsed_key['entity_id'])
-            source_ids = []
-
-            for repo in repo_ids:
-                partial_source_ids = yield _get_ids(repo['repository_id'], repo['entity_id'])
-                source_ids += partial_source_ids
+            indexes = yield gather(
+                lambda repo: _get_source_ids_by_type(repo['repository_id'], repo['entity_id']), repo_ids)
+            source_id = None
+            for index in indexes:
+                source_id = index.get(rule.id_type, source_id)
     else:
         # s1 key
-        source_ids = yield _get_ids(parsed_key['repository_id'], parsed_key['entity_id'])
+        index = yield _get_source_ids_by_type(parsed_key['repository_id'], parsed_key['entity_id'])
+        source_id = index.get(rule.id_type)
 
-    link_for_id_type = None
-    for cid in source_ids:
-        if urllib.unquote(cid["source_id_type"]).lower() == redirect_id_type:
-            link_for_id_type = _link_for_id_type.format(source_id=urllib.unquote(cid["source_id"]))
+    if source_id is None:
+        raise Return(None)
 
-    raise Return(link_for_id_type)
+    raise Return(rule.format(source_id=source_id))
 
 @coroutine
 def resolve_payment_link_id_type(payment, parsed_key, offer_id):
-    if not payment:
-        raise Return(None)
+    rule = payment_link_rule(payment)
 
-    redirect_id_type = payment.get("source_id_type", None)
-
-    if not redirect_id_type:
+    if not rule:
         raise Return(None)
 
-    redirect_id_type = redirect_id_type.lower()
+    if not rule.uses_source_id:
+        raise Return(rule.template)
 
-    _link_for_id_type = payment.get("url", None)
+    index = yield _get_source_ids_by_type(parsed_key['repository_id'], parsed_key['entity_id'])
+    source_id = index.get(rule.id_type)
 
-    if not _link_for_id_type:
+    if source_id is None:
         raise Return(None)
 
-    if '{source_id}' not in _link_for_id_type:
-        raise Return(_link_for_id_type)
-
-    source_ids = yield _get_ids(parsed_key['repository_id'], parsed_key['entity_id'])
-
-    link_for_id_type = None
-    for cid in source_ids:
-        if urllib.unquote(cid["source_id_type"]).lower() == redirect_id_type:
-            try:
-                link_for_id_type = _link_for_id_type.format(source_id=urllib.unquote(cid["source_id"]), offer_id=offer_id)
-            except KeyError:
-                raise exceptions.HTTPError(500, 'Payment link missing either {source_id} or {offer_id}', source='resolution')
+    if not rule.valid:
+        raise exceptions.HTTPError(500, 'Payment link missing either {source_id} or {offer_id}', source='resolution')
 
-    raise Return(link_for_id_type)    
+    raise Return(rule.format(source_id=source_id, offer_id=offer_id))
 
 def _parse_url(url):
     """Parse a url. If it's got no protocol, adds
@@ -248,16 +309,73 @@ def _parse_url(url):
         url = 'http://' + url
     return url
 
-@MemoizeCoroutine
+def _normalise_percent_encoding(match):
+    char = chr(int(match.group(1), 16))
+    if char in UNRESERVED:
+        return char
+    return '%' + match.group(1).upper()
+
+def requested_hub_key(url):
+    """Get the hub key of a request, which is the URL without its query
+    string and fragment. Links and upstream calls use the key as requested.
+
+    :param url: the requested URL
+    :returns: a hub key
+    """
+    parsed = urlparse(url)
+    return urlunparse((parsed.scheme, parsed.netloc, parsed.path, '', '', ''))
+
+def canonical_hub_key(url):
+    """Get the canonical form of a requested hub key, used only as its cache
+    key.
+
+    The scheme is always https, the host is lower case without a default
+    port (or options.hub_key_host if set), the query string and fragment are
+    removed, and percent-encoding is normalised as described in RFC 3986.
+
+    :param url: the requested URL
+    :returns: a hub key
+    """
+    parsed = urlparse(url)
+    host = options.hub_key_host or parsed.netloc.lower()
+    default_port = DEFAULT_PORTS.get(parsed.scheme.lower())
+    if default_port and host.endswith(default_port):
+        host = host[:-len(default_port)]
+
+    path = PERCENT_ENCODED.sub(_normalise_percent_encoding, parsed.path)
+
+    return urlunparse(('https', host, path, '', '', ''))
+
+def _asset_cache_key(hubkey):
+    return (canonical_hub_key(hubkey),)
+
+@MemoizeCoroutine.keyed(_asset_cache_key)
 @coroutine
 def _get_asset_details(hubkey):
     """ get the asset details from a hubkey
     """
-    client = API(options.url_query, ssl_options=ssl_server_options())
+    document = yield _fetch_asset_document(hubkey)
+    raise Return(AssetDetails.from_resource(document))
+
+@MemoizeCoroutine.keyed(_asset_cache_key)
+def _get_asset_document(hubkey):
+    """Get the full JSON-LD description of an asset, which is only needed
+    for JSON responses, see _get_asset_details
+
+    :param hubkey: the asset's hub key
+    :returns: dict with an "@graph"
+    :raises: koi.exceptions.HTTPError
+    """
+    return _fetch_asset_document(hubkey)
+
+@coroutine
+def _fetch_asset_document(hubkey):
+    """Fetch an asset from the query service"""
+    client = get_client(options.url_query)
 
     try:
         res = yield client.query.entities.get(hub_key=hubkey)
-        raise Return(res['data'])
+        raise Return(plain(res['data']))
     except httpclient.HTTPError as exc:
         if exc.code == 404:
             msg = 'No matching asset found'
@@ -286,7 +404,6 @@ def testNodeContainsValue(node, prop, searchValue):
         return (searchValue in node.get(prop))
 
 @MemoizeCoroutine
-@coroutine
 def _get_offers_by_type_and_id(source_id_type, source_id):
     """ get asset offers for given type and id
     :param source_id_type: str
@@ -294,37 +411,134 @@ def _get_offers_by_type_and_id(source_id_type, source_id):
     :returns: list of offers json
     :raises: koi.exceptions.HTTPError
     """
-    client = API(options.url_query, ssl_options=ssl_server_options())
+    global _offers_loader
+
+    if not (options.offers_batch_ids and _offers_batching):
+        return _query_offers([(source_id_type, source_id)])
+
+    # the loader is configured by options, so it is created on first use
+    if _offers_loader is None:
+        _offers_loader = BatchLoader(_fetch_offers, options.offers_batch_max_size, options.offers_batch_window)
+
+    return _offers_loader.load(source_id_type, source_id)
+
+def _offers_key(source_id_type, source_id):
+    """The normalised source id type and id used to match offers to the
+    assets they were requested for"""
+    return unquote(source_id_type).lower(), unquote(source_id)
+
+@coroutine
+def _query_offers(keys):
+    """Query the offers for assets from the query service
+
+    :param keys: list of (source_id_type, source_id)
+    :returns: list of offers json
+    :raises: koi.exceptions.HTTPError
+    """
+    client = get_client(options.url_query)
 
     try:
-        req_body = '[{"source_id_type": "' + source_id_type + '", "source_id": "' + source_id + '"}]'
+        req_body = json.dumps([{'source_id_type': source_id_type, 'source_id': source_id}
+                               for source_id_type, source_id in keys])
 
         client.query.search.offers.prepare_request(headers={'Content-Type': 'application/json'},
-                                                body=req_body.strip())
+                                                   body=req_body)
         res = yield client.query.search.offers.post()
-        raise Return(res['data'])        
     except httpclient.HTTPError as exc:
         msg = 'Unexpected error ' + exc.message
         raise exceptions.HTTPError(exc.code, msg, source='query')
 
-def _getCleanQuerystringParts(cls):
+    raise Return(res['data'])
+
+@coroutine
+def _query_asset_offers(key):
+    """Query the offers for one asset, returning the error rather than
+    raising it, see _fetch_offers"""
+    try:
+        offers = yield _query_offers([key])
+    except exceptions.HTTPError as exc:
+        offers = exc
+
+    raise Return(offers)
+
+@coroutine
+def _fetch_offers(keys):
+    """Fetch the offers for several assets in one request to the query
+    service, see _get_offers_by_type_and_id
+
+    The response to a query for one asset is that asset's offers. When
+    several assets are queried each offer in the response must include the
+    source_id_type and source_id it was found for, which are matched to the
+    keys with the same normalisation as the assets' source ids. If any offer
+    doesn't, batching is turned off for the rest of the process' life.
+
+    If the batch fails, or batching has just been turned off, the assets are
+    queried one per request, so that each gets its own offers or error.
+
+    :param keys: list of (source_id_type, source_id)
+    :returns: list of offers json, or an exception, for each key
     """
-    strip our internal parameters from the querystring and return all others
+    global _offers_batching
+
+    try:
+        offers = yield _query_offers(keys)
+    except exceptions.HTTPError as exc:
+        if len(keys) == 1:
+            raise Return([exc])
+        logging.warning('Unable to fetch offers for %s assets in one request: %s', len(keys), exc)
+        offers = None
+
+    if offers is not None and len(keys) == 1:
+        raise Return([offers])
+
+    if offers is not None and not all(offer.get('source_id_type') and offer.get('source_id') for offer in offers):
+        logging.error('Offers returned without their source ids, so offers will be fetched for one asset '
+                      'per request. Set offers_batch_ids to false to skip the batch requests')
+        _offers_batching = False
+        offers = None
+
+    if offers is None:
+        results = yield [_query_asset_offers(key) for key in keys]
+        raise Return(results)
+
+    by_id = {}
+    for offer in offers:
+        by_id.setdefault(_offers_key(offer['source_id_type'], offer['source_id']), []).append(offer)
+
+    raise Return([by_id.get(_offers_key(source_id_type, source_id), []) for source_id_type, source_id in keys])
+
+_offers_loader = None
+# turned off if the query service doesn't include the source ids in offers
+_offers_batching = True
+
+class RequestContext(object):
+    """
+    The options for resolving one request, with its query string parsed once
+
+    :param query: the request's query string
+    :param show_json: (optional) whether to respond with JSON instead of a
+        redirect or page
+    """
+    def __init__(self, query, show_json=False):
+        self.show_json = show_json
+        self.clean_params = _getCleanQuerystringParts(parse_qs(query))
+        self.clean_query = urlencode(sorted(self.clean_params.items()), True)
+
+def _getCleanQuerystringParts(parts):
+    """
+    strip our internal parameters from the parsed querystring and return all others
 
     returns a dict
     """
     cleanQs = {}
 
-    qs = cls.request.query
-    parts = parse_qs(qs)
-
     for x in parts:
         if x not in ['hubpid', 'hubidt', 'hubaid']:
             cleanQs[x] = parts[x]
 
     return cleanQs
 
-def _mergeQuerystrings(cls, linkUrl):
+def _mergeQuerystrings(context, linkUrl):
     """
     takes the linkUrl and adds in any querystring params in the request Url
 
@@ -336,111 +550,243 @@ def _mergeQuerystrings(cls, linkUrl):
     url_parts = list(urlparse(linkUrl))
     linkQs = parse_qs(url_parts[4])
 
-    linkQs.update(_getCleanQuerystringParts(cls))
+    linkQs.update(context.clean_params)
     
     url_parts[4] = urlencode(linkQs, True)
     
     return urlunparse(url_parts)
             
 @coroutine
-def redirectToAsset(cls, provider, assetIdType, assetId, showJson=None, hub_key=None):
+def _asset_hub_key(assetIdType, assetId):
+    """Build a dummy hub key for an asset so we can re-use existing code to
+    extract asset details
+
+    :param assetIdType: the asset's source id type
+    :param assetId: the asset's source id
+    :returns: a s1 hub key
+    :raises: koi.exceptions.HTTPError
+    """
+    try:
+        repo_ids = yield _get_repos_for_source_id(assetIdType.lower(), assetId)
+    except httpclient.HTTPError as exc:
+        if exc.code == 404:
+            msg = 'No repository found for id/type combination'
+        else:
+            msg = 'Unexpected error ' + exc.message
+        raise exceptions.HTTPError(exc.code, msg, source='index')
+
+    repository_id = repo_ids[0]['repository_id']
+    entity_id = repo_ids[0]['entity_id']
+
+    raise Return("http://copyrighthub.org/s1/hub1/%s/asset/%s" % (repository_id, entity_id))
+
+def _timed(timings, stage, future):
+    """Record how long the future for a stage of a resolution takes
+
+    :param timings: dict of stage name to seconds
+    :param stage: name of the stage
+    :param future: the stage's Future
+    :returns: the future
+    """
+    start = time.time()
+    future.add_done_callback(lambda f: timings.__setitem__(stage, time.time() - start))
+    return future
+
+@coroutine
+def redirectToAsset(cls, context, provider, assetIdType, assetId, hub_key=None, index_key=None,
+                    provider_document=None):
+    """
+    Redirect to an asset's reference link, or respond with its page or JSON
+
+    :param provider: the asset's Provider
+    :param provider_document: (optional) the provider's full resource, as
+        returned by the service it was found with, for the JSON response.
+        By default the provider's organisation is fetched from the accounts
+        service
+    """
+    timings = {}
+    offers_future = None
+    reference_links = provider.get('reference_links')
+
+    # a redirect only needs the parsed key, so unless JSON was requested look
+    # for a reference link before fetching the asset details and offers
+    lazy = options.resolve_reference_link_first and not context.show_json and reference_links
+
     if not assetIdType and hub_key:
-        parsed_key = yield _parse_hub_key(hub_key)
-         # get asset details
-        details = yield _get_asset_details(hub_key)
+        asset_key = hub_key
     else:
-        # build dummy hub_key so we can re-use existing code to extract asset details
-        try:
-            repo_ids = yield _get_repos_for_source_id(assetIdType.lower(), assetId)
-        except httpclient.HTTPError as exc:
-            if exc.code == 404:
-                msg = 'No repository found for id/type combination'
-            else:
-                msg = 'Unexpected error ' + exc.message
-            raise exceptions.HTTPError(exc.code, msg, source='index')    
+        # the asset's id and type are known, so get offers while looking up the asset
+        if not lazy:
+            offers_future = _timed(timings, 'offers', _get_offers_by_type_and_id(assetIdType, assetId))
 
-        repository_id = repo_ids[0]['repository_id']
-        entity_id = repo_ids[0]['entity_id']
-        dummy_hub_key = "http://copyrighthub.org/s1/hub1/%s/asset/%s" % (repository_id, entity_id)
+        asset_key = yield _timed(timings, 'repositories', _asset_hub_key(assetIdType, assetId))
 
-        parsed_key = yield _parse_hub_key(dummy_hub_key)
+    if lazy:
+        parsed_key = yield _timed(timings, 'parse_hub_key', _parse_hub_key(asset_key))
 
-        # get asset details
-        details = yield _get_asset_details(dummy_hub_key)
+        # get reference links
+        link_future = _timed(timings, 'reference_link', resolve_link_id_type(reference_links, parsed_key))
+        link_for_id_type = yield link_future
 
-    reference_links = provider.get('reference_links')
+        if link_for_id_type:
+            logging.debug('redirectToAsset timings: %s', timings)
+            _redirectToLink(cls, context, link_for_id_type, parsed_key, index_key)
+            raise Return()
+
+        if assetIdType:
+            offers_future = _timed(timings, 'offers', _get_offers_by_type_and_id(assetIdType, assetId))
+        details = yield _timed(timings, 'asset_details', _get_asset_details(asset_key))
+    elif context.show_json:
+        # the JSON response includes the asset's and provider's full documents
+        parsed_key, asset_document, provider_document = yield [
+            _timed(timings, 'parse_hub_key', _parse_hub_key(asset_key)),
+            _timed(timings, 'asset_details', _get_asset_document(asset_key)),
+            _provider_document(provider) if provider_document is None else maybe_future(provider_document)]
+        details = AssetDetails.from_resource(asset_document)
+
+        # get reference links
+        link_future = _timed(timings, 'reference_link', resolve_link_id_type(reference_links, parsed_key))
+    else:
+        # get the parsed key and asset details at the same time
+        parsed_key, details = yield [_timed(timings, 'parse_hub_key', _parse_hub_key(asset_key)),
+                                     _timed(timings, 'asset_details', _get_asset_details(asset_key))]
 
-    # get reference links
-    link_for_id_type = yield resolve_link_id_type(reference_links, parsed_key)
+        # get reference links
+        link_future = _timed(timings, 'reference_link', resolve_link_id_type(reference_links, parsed_key))
 
     asset_details = []
     asset_description = ''
 
-    if details.get('@graph', '') != '':
-        for item in details['@graph']:
-            if testNodeContainsValue(item, '@type', 'op:Id'):
-                asset_detail = {
-                    'id': item['op:value']['@value'],
-                    'idType': item['op:id_type']['@id'][4:]
-                }
-                asset_details.append(asset_detail)
-
-                # save the asset's id and type if we don't know it (resolving a hub_key)
-                if not assetIdType:
-                    assetId = item['op:value']['@value']
-                    assetIdType = item['op:id_type']['@id'][4:]
-            elif testNodeContainsValue(item, '@type', 'op:Asset') and item.get('dcterm:description', '') != '':
-                asset_description = item['dcterm:description'].get('@value', '')
+    for _, id_type, value in details.ids:
+        asset_detail = {
+            'id': value,
+            'idType': id_type[4:]
+        }
+        asset_details.append(asset_detail)
+
+        # save the asset's id and type if we don't know it (resolving a hub_key)
+        if not assetIdType:
+            assetId = value
+            assetIdType = id_type[4:]
+
+    if details.description:
+        asset_description = details.description[1]
 
     # get offers
-    offers = yield _get_offers_by_type_and_id(assetIdType, assetId)
+    if offers_future is None:
+        offers_future = _timed(timings, 'offers', _get_offers_by_type_and_id(assetIdType, assetId))
+
+    link_for_id_type, offers = yield [link_future, offers_future]
+
+    # reuse the asset page if it has already been rendered, which also
+    # saves resolving the payment links
+    page_key = None
+    if not context.show_json and not link_for_id_type:
+        set_cache_headers(cls, ASSET_PAGE)
+        page_key = _asset_page_key(context, provider, asset_key, offers)
+        page = pages.lookup(page_key)
+        if page:
+            logging.debug('redirectToAsset timings: %s', timings)
+            pages.write(cls, page)
+            raise Return()
 
     offer_details = []
 
     if offers and provider.get('payment', None):
-        for offer in offers[0]['offers']:
-            # find the actual offer details inside the @graph node
-            for snippet in offer['@graph']:
-                if snippet.get('type', '') == 'offer':
-                    # get payment link
-                    offer_id = snippet['@id'][3:]
-                    payment_link = yield resolve_payment_link_id_type(provider.get('payment', ''), parsed_key, offer_id)
-
-                    offer_detail = {
-                        'title': getOfferTextValue(snippet, 'dcterm:title'),
-                        'description': getOfferTextValue(snippet, 'op:policyDescription'),
-                        'link': _mergeQuerystrings(cls, payment_link)
-                    }
-                    
-                    offer_details.append(offer_detail)
+        # find the actual offer details inside the @graph nodes
+        snippets = [snippet for offer in offers[0]['offers'] for snippet in offer['@graph']
+                    if snippet.get('type', '') == 'offer']
+
+        # get payment links
+        payment_links = yield _timed(timings, 'payment_links', gather(
+            lambda snippet: resolve_payment_link_id_type(provider.get('payment', ''), parsed_key, snippet['@id'][3:]),
+            snippets))
+
+        for snippet, payment_link in zip(snippets, payment_links):
+            offer_detail = {
+                'title': getOfferTextValue(snippet, 'dcterm:title'),
+                'description': getOfferTextValue(snippet, 'op:policyDescription'),
+                'link': _mergeQuerystrings(context, payment_link)
+            }
+
+            offer_details.append(offer_detail)
+
+    logging.debug('redirectToAsset timings: %s', timings)
 
     # return Json if requested to
-    if showJson:
+    if context.show_json:
         cls.set_header('Content-Type', 'application/json; charset=UTF-8')
 
         res = {
-            'asset': details,
-            'provider': provider,
+            'asset': asset_document,
+            'provider': provider_document,
             'offers': offers
         }
-        cls.write(res)
+
+        set_cache_headers(cls, JSON)
+        if not not_modified(cls, etag(res)):
+            cls.write(res)
     else:
         # use the reference link if there is one
         if link_for_id_type:
-            # replace tokens in reference link with real values
-            redirect = _redirect_url(link_for_id_type, parsed_key)
-
-            # add passed-in querystring values
-            redirect = _mergeQuerystrings(cls, redirect)
-
-            cls.redirect(redirect)
+            _redirectToLink(cls, context, link_for_id_type, parsed_key, index_key)
         else:
             for asset in asset_details:
                 asset['idType'] = unquote(asset['idType'])
                 asset['id'] = unquote(asset['id'])
 
-            cls.render('asset_template.html', data=provider, assets=asset_details, 
-                            description=asset_description, offers=offer_details)
+            pages.render(cls, page_key, 'asset_template.html', data=provider, assets=asset_details,
+                         description=asset_description, offers=offer_details)
+
+@coroutine
+def _provider_document(provider):
+    """Get the full organisation resource of a provider
+
+    :param provider: a Provider, or a dict
+    :returns: dict, with the provider's website as normalised for the page
+    """
+    if not provider.get('id'):
+        raise Return(dict(provider))
+
+    document = yield _get_provider_document(provider['id'])
+    if 'website' in provider:
+        document = dict(document, website=provider['website'])
+
+    raise Return(document)
+
+def _asset_page_key(context, provider, asset_key, offers):
+    """Key for a rendered asset page
+
+    :param provider: the provider organisation
+    :param asset_key: the asset's hub key
+    :param offers: the asset's offers
+    :returns: tuple of the provider id, asset key, a version of the offers and
+        the request's query string, which is added to the payment links
+    """
+    offers_version = hashlib.sha1(json.dumps(offers, sort_keys=True)).hexdigest()
+
+    return ('asset', provider.get('id'), canonical_hub_key(asset_key), offers_version, context.clean_query)
+
+def _redirectToLink(cls, context, link, parsed_key, index_key=None):
+    """Redirect to a provider's reference link for an asset
+
+    :param context: the RequestContext
+    :param link: the reference link
+    :param parsed_key: a dictionary of parameters associated with hub_key
+    :param index_key: (optional) key to store the redirect under in the
+        resolution index
+    """
+    # replace tokens in reference link with real values
+    redirect = _redirect_url(link, parsed_key)
+
+    if index_key:
+        resolved.add(index_key, redirect)
+
+    # add passed-in querystring values
+    redirect = _mergeQuerystrings(context, redirect)
+
+    set_cache_headers(cls, REDIRECT)
+    cls.redirect(redirect)
 
 def _redirect_url(url, parsed_key):
     """Take a redirect url string,
@@ -464,12 +810,20 @@ class HubKeyHandler(base.BaseHandler):
         except KeyError:
             raise KeyError('App version is required')
 
+    def on_finish(self):
+        # the hub key's schema version, s0 or s1
+        schema_version = self.request.path.split('/')[1]
+        metrics.observe('resolution_request_seconds', self.request.request_time(),
+                        handler='hub_key', branch=schema_version)
+
     def write_error(self, status_code, **kwargs):
         """
         Use BaseHandler.write_error if json, otherwise use a html template
 
         :param status_code: the response's status code, e.g. 500
         """
+        set_cache_headers(self, ERROR, vary='Accept')
+
         if 'application/json' in self.request.headers.get('Accept', '').split(';'):
             return super(HubKeyHandler, self).write_error(status_code, **kwargs)
 
@@ -483,17 +837,32 @@ class HubKeyHandler(base.BaseHandler):
         self.render('error.html', errors=errors)
 
 
-    @coroutine
     def get(self):
         """
         Resolve a hub key
 
         Returns JSON if request Content-Type is JSON, and HTML otherwise.
         """
+        return deadlines.run(self._get)
+
+    @coroutine
+    def _get(self):
+        # the query string is only passed on to links, so it isn't part of the key
+        hub_key = requested_hub_key(self.request.full_url())
+        index_key = hub_key_entry(canonical_hub_key(hub_key))
+        context = RequestContext(self.request.query)
+
+        # redirect straight away if the hub key has already been resolved
+        target = resolved.lookup(index_key)
+        if target:
+            set_cache_headers(self, REDIRECT)
+            self.redirect(_mergeQuerystrings(context, target))
+            raise Return()
+
         try:
-            hub_key = self.request.full_url()
             parsed_key = yield _parse_hub_key(hub_key)
         except ValueError:
+            set_cache_headers(self, ERROR)
             self.set_status(404)
             self.finish()
             raise Return()
@@ -508,4 +877,4 @@ class HubKeyHandler(base.BaseHandler):
         if assetId:
             assetId = urllib.unquote(assetId)
 
-        yield redirectToAsset(self, provider, assetIdType, assetId, None, hub_key)
\ No newline at end of file
+        yield redirectToAsset(self, context, provider, assetIdType, assetId, hub_key, index_key=index_key)
\ No newline at end of file
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Purge cached upstream data when a provider, repository or asset changes.
+
+An invalidation names any of a provider id or name, a repository id, a hub
+key or a source id, and every cached entry mentioning one of them is
+deleted: memoized calls, whose arguments or results include it, rendered
+pages, whose keys include it, and resolved redirects. As a redirect may
+depend on any provider or repository, invalidating a provider or repository
+deletes every resolved redirect.
+
+The process handling the request purges its own caches straight away and
+appends the invalidation to a log in a directory created before forking,
+which the other processes regularly read. Each process records how far it
+has read, and once the log is over invalidation_log_max_bytes and every
+living process has read all of it, it is emptied.
+
+Invalidating is always authenticated, even if use_oauth is off, with either
+a token with write access or the invalidation_secret.
+"""
+import contextlib
+import errno
+import fcntl
+import hmac
+import json
+import logging
+import os
+import tempfile
+import urllib
+
+from koi import base, exceptions
+from tornado.gen import coroutine
+from tornado.ioloop import PeriodicCallback
+from tornado.options import options, define
+
+import memoize
+from hub_key_handler import canonical_hub_key
+from page_cache import pages
+from records import Record
+from resolution_index import resolved
+
+define('invalidation_dir', default='',
+       help='Directory the processes share invalidations through (a temporary directory by default)')
+define('invalidation_poll_seconds', default=1,
+       help='Number of seconds between each process reading the invalidations made by the others')
+define('invalidation_log_max_bytes', default=1048576,
+       help='Size after which the invalidation log is emptied, once every process has read it')
+define('invalidation_secret', default='',
+       help='Secret that may be given as the bearer token to invalidate, instead of an OAuth token')
+
+FIELDS = ('provider_id', 'provider_name', 'repository_id', 'hub_key', 'source_id')
+
+LOG_NAME = 'invalidations.log'
+LOCK_NAME = 'invalidations.lock'
+GENERATION_NAME = 'invalidations.generation'
+OFFSET_PREFIX = 'offset.'
+
+_directory = None
+_offset = 0
+_generation = 0
+_recorded = None
+
+
+def _terms(invalidation):
+    """The lower case strings identifying the entries to delete"""
+    terms = set(value.lower() for field, value in invalidation.iteritems() if field != 'hub_key')
+    if invalidation.get('hub_key'):
+        terms.add(canonical_hub_key(invalidation['hub_key']).lower())
+    return terms
+
+
+def _strings(value):
+    """Every string in a key or value, including in containers and records"""
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, Record):
+        for string in _strings(value.__getstate__()):
+            yield string
+    elif isinstance(value, dict):
+        for item in value.iteritems():
+            for string in _strings(item):
+                yield string
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for string in _strings(item):
+                yield string
+
+
+def _mentions(value, terms):
+    """
+    Check if a key or value mentions any of the terms, either as a whole
+    string or as a segment of a path, e.g. a hub key or link
+
+    :param value: a cache key or value
+    :param terms: set of lower case strings
+    :returns: True if the value mentions a term
+    """
+    for string in _strings(value):
+        string = string.lower()
+        if string in terms:
+            return True
+        if '/' in string and any(urllib.unquote(part) in terms for part in string.split('/')):
+            return True
+    return False
+
+
+def purge(invalidation):
+    """
+    Delete the entries matching an invalidation from this process' caches
+
+    :param invalidation: dict with any of the FIELDS
+    :returns: number of entries deleted
+    """
+    terms = _terms(invalidation)
+
+    def match(key, value):
+        return _mentions(key, terms) or _mentions(value, terms)
+
+    def match_key(key):
+        return _mentions(key, terms)
+
+    num_purged = sum(memoized.invalidate(match) for memoized in memoize.REGISTRY)
+    num_purged += pages.invalidate(match_key)
+
+    if any(invalidation.get(field) for field in ('provider_id', 'provider_name', 'repository_id')):
+        num_purged += resolved.clear()
+    else:
+        num_purged += resolved.invalidate(match)
+
+    logging.info('Invalidated %s: %s cache entries purged', invalidation, num_purged)
+    return num_purged
+
+
+def create_directory(path=None):
+    """
+    Create the directory that the processes share invalidations through,
+    which has to be done before forking
+
+    :param path: (optional) the directory, a temporary directory by default
+    """
+    global _directory
+
+    _directory = path or tempfile.mkdtemp(prefix='resolution-invalidation-')
+    for name in os.listdir(_directory):
+        if name in (LOG_NAME, GENERATION_NAME) or name.startswith(OFFSET_PREFIX):
+            os.remove(os.path.join(_directory, name))
+
+
+def _path(name):
+    """The path of a file in the shared directory"""
+    return os.path.join(_directory, name)
+
+
+@contextlib.contextmanager
+def _locked(operation):
+    """
+    Hold a lock on the log, shared for reading it and exclusive for writing
+    or emptying it
+
+    :param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+    """
+    fd = os.open(_path(LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+
+def _read_generation():
+    """The number of times the log has been emptied"""
+    try:
+        with open(_path(GENERATION_NAME)) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def _read_offset(name):
+    """The generation and offset a process has read the log to, or None"""
+    try:
+        with open(_path(name)) as f:
+            generation, offset = f.read().split()
+        return int(generation), int(offset)
+    except (IOError, ValueError):
+        return None
+
+
+def _record_offset():
+    """Record how far this process has read the log"""
+    global _recorded
+
+    if _recorded == (_generation, _offset):
+        return
+    name = _path(OFFSET_PREFIX + str(os.getpid()))
+    with open(name + '.tmp', 'w') as f:
+        f.write('{} {}'.format(_generation, _offset))
+    # renamed so the other processes never read part of it
+    os.rename(name + '.tmp', name)
+    _recorded = (_generation, _offset)
+
+
+def _is_alive(pid):
+    """Check if a process still exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+def _empty_if_read():
+    """
+    Empty the log if it is over invalidation_log_max_bytes and every living
+    process has read all of it
+    """
+    global _generation, _offset
+
+    try:
+        if os.path.getsize(_path(LOG_NAME)) < options.invalidation_log_max_bytes:
+            return
+    except OSError:
+        return
+
+    with _locked(fcntl.LOCK_EX):
+        generation = _read_generation()
+        read_to = (generation, os.path.getsize(_path(LOG_NAME)))
+
+        for name in os.listdir(_directory):
+            if not name.startswith(OFFSET_PREFIX) or name.endswith('.tmp'):
+                continue
+            try:
+                pid = int(name[len(OFFSET_PREFIX):])
+            except ValueError:
+                continue
+            if not _is_alive(pid):
+                os.remove(_path(name))
+            elif _read_offset(name) != read_to:
+                return
+
+        with open(_path(LOG_NAME), 'w'):
+            pass
+        with open(_path(GENERATION_NAME), 'w') as f:
+            f.write(str(generation + 1))
+
+    logging.info('Emptied the invalidation log after it was read by every process')
+
+
+def publish(invalidation):
+    """
+    Purge this process' caches and log the invalidation for the other processes
+
+    :param invalidation: dict with any of the FIELDS
+    :returns: number of entries deleted from this process' caches
+    """
+    num_purged = purge(invalidation)
+
+    if _directory:
+        line = json.dumps({'pid': os.getpid(), 'invalidation': invalidation}) + '\n'
+        # appended in one write, so lines from different processes aren't interleaved
+        with _locked(fcntl.LOCK_EX):
+            fd = os.open(_path(LOG_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    return num_purged
+
+
+def poll():
+    """Apply the invalidations logged by the other processes since the last poll"""
+    global _generation, _offset
+
+    if not _directory:
+        return
+
+    with _locked(fcntl.LOCK_SH):
+        generation = _read_generation()
+        if generation != _generation:
+            # emptied since the last poll, after this process had read all of it
+            _generation, _offset = generation, 0
+        try:
+            with open(_path(LOG_NAME), 'rb') as f:
+                f.seek(_offset)
+                data = f.read()
+        except IOError:
+            data = ''
+
+    # a line may still be being written
+    end = data.rfind('\n') + 1
+    _offset += end
+    _record_offset()
+
+    for line in data[:end].splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logging.warning('Unable to read invalidation %r', line)
+            continue
+
+        if entry['pid'] != os.getpid():
+            purge(entry['invalidation'])
+
+    _empty_if_read()
+
+
+def start():
+    """Regularly apply the invalidations made by the other processes"""
+    global _generation, _offset
+
+    if _directory:
+        # a new process has nothing cached from before it started
+        with _locked(fcntl.LOCK_SH):
+            _generation = _read_generation()
+            try:
+                _offset = os.path.getsize(_path(LOG_NAME))
+            except OSError:
+                _offset = 0
+            _record_offset()
+        PeriodicCallback(poll, options.invalidation_poll_seconds * 1000).start()
+
+
+def _utf8(value):
+    """Encode unicode as UTF-8, as compare_digest only compares ASCII unicode"""
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class InvalidationHandler(base.BaseHandler):
+    # purging the caches changes what is returned, so needs write access
+    METHOD_ACCESS = dict(base.BaseHandler.METHOD_ACCESS, POST=base.BaseHandler.WRITE_ACCESS)
+
+    def initialize(self, **kwargs):
+        try:
+            self.version = kwargs['version']
+        except KeyError:
+            raise KeyError('App version is required')
+
+    @coroutine
+    def prepare(self):
+        """
+        Require the invalidation_secret or a token with access, whether or
+        not use_oauth is set
+
+        :raise: HTTPError if no token is provided or it does not have access
+        """
+        requested_access = self.endpoint_access(self.request.method)
+        if requested_access == self.UNAUTHENTICATED_ACCESS:
+            return
+
+        token = self.request.headers.get('Authorization', '').split(' ')[-1]
+        if not token:
+            raise exceptions.HTTPError(401, 'OAuth token not provided')
+
+        secret = options.invalidation_secret
+        if secret and hmac.compare_digest(_utf8(token), _utf8(secret)):
+            return
+
+        has_access = yield self.verify_token(token, requested_access)
+        if not has_access:
+            raise exceptions.HTTPError(403, "'{}' access not granted.".format(requested_access))
+
+    def post(self):
+        """
+        Purge cached data about a provider, repository or asset from every
+        process, e.g.
+            {"provider_id": "3e1a7b...", "provider_name": "exampleco"}
+
+        Any of provider_id, provider_name, repository_id, hub_key and
+        source_id may be given. Returns the number of entries purged by the
+        process handling the request, the others purge theirs within
+        invalidation_poll_seconds.
+        """
+        body = self.get_json_body()
+        if not isinstance(body, dict):
+            raise exceptions.HTTPError(400, 'The body must be a JSON object')
+
+        invalidation = dict((field, body[field]) for field in FIELDS if body.get(field))
+        if not invalidation:
+            raise exceptions.HTTPError(400, 'At least one of {} is required'.format(', '.join(FIELDS)))
+        if not all(isinstance(value, basestring) for value in invalidation.itervalues()):
+            raise exceptions.HTTPError(400, 'Values must be strings')
+
+        num_purged = publish(invalidation)
+
+        self.set_header('Cache-Control', 'no-cache')
+        self.finish({'status': 200, 'data': {'purged': num_purged}})
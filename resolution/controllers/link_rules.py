@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Providers' rules for linking to their assets.
+
+A provider's reference_links and payment settings name the source id type
+used in its links and a link template. Each rule is compiled and validated
+once, and kept for every later request using the same settings, so that
+resolving a link is a lookup of the asset's source id by type and a single
+format.
+"""
+import logging
+import urllib
+from string import Formatter
+
+REFERENCE_LINK_FIELDS = frozenset(['source_id'])
+PAYMENT_LINK_FIELDS = frozenset(['source_id', 'offer_id'])
+
+# the number of rules is bounded by the number of providers, so the cache is
+# only cleared to guard against providers changing their settings repeatedly
+MAX_RULES = 10000
+
+_rules = {}
+
+
+class LinkRule(object):
+    """
+    A compiled link rule
+
+    :param id_type: the source id type used in links
+    :param template: the link, which may include the fields
+    :param fields: the names of the fields the template may include
+    """
+    __slots__ = ('id_type', 'template', 'uses_source_id', 'valid')
+
+    def __init__(self, id_type, template, fields):
+        self.id_type = id_type.lower()
+        self.template = template
+
+        try:
+            names = set(name for _, name, _, _ in Formatter().parse(template) if name is not None)
+        except ValueError:
+            names = None
+
+        self.valid = names is not None and names <= fields
+        self.uses_source_id = '{source_id}' in template
+
+    def format(self, **kwargs):
+        """
+        Format the link
+
+        :param kwargs: the fields' values
+        :returns: the link
+        """
+        return self.template.format(**kwargs)
+
+
+def _rule(id_type, template, fields):
+    key = (id_type, template, fields)
+    rule = _rules.get(key)
+
+    if rule is None:
+        if len(_rules) >= MAX_RULES:
+            _rules.clear()
+
+        rule = _rules[key] = LinkRule(id_type, template, fields)
+        if not rule.valid:
+            logging.warning('Invalid link template %r, which may only include %s',
+                            template, ', '.join('{' + field + '}' for field in sorted(fields)))
+
+    return rule
+
+
+def reference_link_rule(reference_links):
+    """
+    Get the rule for a provider's reference links
+
+    :param reference_links: the provider's reference_links setting
+    :returns: a LinkRule, or None if the provider has no reference link
+    """
+    if not reference_links:
+        return None
+
+    id_type = reference_links.get('redirect_id_type')
+    if not id_type:
+        return None
+
+    template = reference_links.get('links', {}).get(id_type.lower())
+    if not template:
+        return None
+
+    return _rule(id_type, template, REFERENCE_LINK_FIELDS)
+
+
+def payment_link_rule(payment):
+    """
+    Get the rule for a provider's payment links
+
+    :param payment: the provider's payment setting
+    :returns: a LinkRule, or None if the provider has no payment link
+    """
+    if not payment:
+        return None
+
+    id_type = payment.get('source_id_type')
+    if not id_type:
+        return None
+
+    template = payment.get('url')
+    if not template:
+        return None
+
+    return _rule(id_type, template, PAYMENT_LINK_FIELDS)
+
+
+def index_source_ids(source_ids):
+    """
+    Index an asset's source ids by their normalised type
+
+    :param source_ids: list of dicts with "source_id_type" and "source_id"
+    :returns: dict of lower case, unquoted source id type to the unquoted
+        source id. If the asset has several ids of a type, the last one is used
+    """
+    return dict((urllib.unquote(cid['source_id_type']).lower(), urllib.unquote(cid['source_id']))
+                for cid in source_ids)
@@ -7,87 +7,506 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
-from tornado.options import options
+from collections import OrderedDict
+from functools import partial
+
+from tornado.options import options, define
 
 import time, logging
 
+from tornado import httpclient, web
 from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
 
-# memoize a coroutine
-class MemoizeCoroutine:
-    def __init__(self, fn):
+import deadlines
+import metrics
+from clients import UpstreamUnavailable, _is_failure
+
+define('memoize_backend', default='local',
+       help='Cache backend used by memoized functions, e.g. "local" or "shared"')
+define('memoize_seconds', default=60,
+       help='Number of seconds to cache memoized function calls')
+define('memoize_max_items', default=10000,
+       help='Maximum number of entries to cache per memoized function')
+define('memoize_max_bytes', default=0,
+       help='Approximate maximum size in bytes of the cache per memoized function (0 for no limit)')
+define('memoize_stale_seconds', default=0,
+       help='Number of seconds after expiry during which a cached value is served '
+            'while it is refreshed in the background')
+define('memoize_stale_if_error_seconds', default=0,
+       help='Number of seconds after expiry during which a cached value is served '
+            'if refreshing it fails')
+define('memoize_negative_seconds', default=10,
+       help='Number of seconds to cache "not found" errors from memoized coroutines (0 to disable)')
+define('memoize_negative_max_items', default=1000,
+       help='Maximum number of "not found" errors to cache per memoized coroutine')
+
+
+def _approx_size(value):
+    """Roughly estimate the memory used by a decoded JSON-like value
+
+    :param value: a dict, list, string, scalar or record with __slots__
+    :returns: approximate size in bytes
+    """
+    if hasattr(value, '__slots__'):
+        return 16 + sum(8 + _approx_size(getattr(value, name)) for name in value.__slots__)
+    elif isinstance(value, dict):
+        return 64 + sum(_approx_size(k) + _approx_size(v) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return 32 + sum(_approx_size(v) for v in value)
+    elif isinstance(value, basestring):
+        return 40 + len(value)
+    else:
+        return 24
+
+
+def _is_not_found(exc):
+    """Return True if exc is a 404 error from us or from an upstream service"""
+    if isinstance(exc, web.HTTPError):
+        return exc.status_code == 404
+    elif isinstance(exc, httpclient.HTTPError):
+        return exc.code == 404
+    return False
+
+
+def _is_upstream_failure(exc):
+    """
+    Return True if exc means that an upstream service is unavailable or
+    failing, rather than that it answered, e.g. with a 404. Upstream errors
+    are usually re-raised as a koi HTTPError with the upstream status code.
+    """
+    if isinstance(exc, UpstreamUnavailable):
+        return True
+    elif isinstance(exc, web.HTTPError):
+        return exc.status_code >= 500
+    return _is_failure(exc)
+
+
+class _Entry(object):
+    __slots__ = ('value', 'timestamp', 'expires', 'size')
+
+    def __init__(self, value, timestamp, expires, size):
+        self.value = value
+        self.timestamp = timestamp
+        self.expires = expires
+        self.size = size
+
+
+class LRUCache(object):
+    """
+    A least recently used cache bounded by number of entries and
+    (optionally) approximate size in bytes. Every entry carries its own
+    expiry time, but expired entries are only removed when they fall off
+    the end of the cache so that callers can decide what to do with them.
+    """
+    def __init__(self, max_items, max_bytes=0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.num_evictions = 0L
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the entry for key (or None), marking it most recently used"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds, evicting old entries if needed"""
+        self.delete(key)
+
+        now = time.time()
+        size = _approx_size(value)
+        self.entries[key] = _Entry(value, now, now + ttl, size)
+        self.bytes += size
+
+        while self.entries and (len(self.entries) > self.max_items or
+                                (self.max_bytes and self.bytes > self.max_bytes)):
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.num_evictions += 1
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def items(self):
+        """Return a list of (key, value) for every entry"""
+        return [(key, entry.value) for key, entry in self.entries.iteritems()]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+# Cache backends, keyed by the name used in the memoize_backend option.
+# A backend is a factory called with (namespace, max_items, max_bytes) which
+# returns an object providing get(key), set(key, value, ttl), delete(key),
+# items(), clear(), __len__ and a num_evictions counter, where get returns an object
+# with value, timestamp and expires attributes (or None). Values are decoded upstream responses, so a
+# backend shared between processes has to serialise them.
+BACKENDS = {
+    'local': lambda namespace, max_items, max_bytes: LRUCache(max_items, max_bytes)
+}
+
+
+# every memoized function, for reporting their cache statistics
+REGISTRY = []
+
+
+def purge(cache, match):
+    """Delete the entries of a cache backend that match
+
+    :param cache: a cache backend
+    :param match: function called with each entry's key and value, which
+        returns True if the entry should be deleted
+    :returns: number of entries deleted
+    """
+    keys = [key for key, value in cache.items() if match(key, value)]
+    for key in keys:
+        cache.delete(key)
+    return len(keys)
+
+
+class TTLCache(object):
+    """
+    A cache of values kept for a number of seconds, in the configured backend
+
+    The backend is created when the cache is first used, so that the options
+    are read after the config is loaded.
+
+    :param namespace: the cache's name
+    :param max_items_option: name of the option with the maximum number of entries
+    :param seconds_option: name of the option with the number of seconds an
+        entry is kept, where 0 disables the cache
+    """
+    def __init__(self, namespace, max_items_option, seconds_option):
+        self.namespace = namespace
+        self.max_items_option = max_items_option
+        self.seconds_option = seconds_option
+        self._cache = None
+        self.num_hits = 0L
+        self.num_misses = 0L
+        metrics.register_cache(namespace, self)
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            factory = BACKENDS[options.memoize_backend]
+            self._cache = factory(self.namespace, getattr(options, self.max_items_option), 0)
+        return self._cache
+
+    @property
+    def seconds(self):
+        return getattr(options, self.seconds_option)
+
+    def lookup(self, key):
+        """
+        Get a value that has not expired
+
+        :param key: the value's key
+        :returns: the value, or None
+        """
+        if not self.seconds:
+            return None
+
+        entry = self.cache.get(key)
+        if entry is None or time.time() > entry.expires:
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return entry.value
+
+    def add(self, key, value):
+        """
+        Store a value, unless the cache is disabled
+
+        :param key: the value's key
+        :param value: the value
+        """
+        if self.seconds:
+            self.cache.set(key, value, self.seconds)
+
+    def invalidate(self, match):
+        """
+        Delete the entries that match, see purge
+
+        :returns: number of entries deleted
+        """
+        return purge(self.cache, match)
+
+    def clear(self):
+        """
+        Delete every entry
+
+        :returns: number of entries deleted
+        """
+        num_purged = len(self.cache)
+        self.cache.clear()
+        return num_purged
+
+
+def register_backend(name, factory):
+    """Make a cache backend available to the memoize_backend option
+
+    :param name: name of the backend
+    :param factory: callable returning a cache for (namespace, max_items, max_bytes)
+    """
+    BACKENDS[name] = factory
+
+
+class _MemoizeBase(object):
+    def __init__(self, fn, key=None):
         self.fn = fn
-        self.memo = {}
-        self.timestamp = {}
-        self.items = 0
+        self.key = key
+        self.name = getattr(fn, '__name__', str(id(fn)))
+        self.namespace = '{}.{}'.format(getattr(fn, '__module__', None), self.name)
+        self._cache = None
         self.num_hits = 0L
         self.num_misses = 0L
         self.num_refreshes = 0L
-        self.num_clearouts = 0L
+        REGISTRY.append(self)
+        metrics.register_cache(self.namespace, self)
 
-    @coroutine
-    def __call__(self, *args):
-        # clear if too many items (to stop memory being consumed indefinitely)
-        if self.items > options.memoize_max_items:
-            self.memo = {}
-            self.timestamp = {}
-            self.items = 0
-            self.num_clearouts += 1
-            
-        if args not in self.memo:
-            # execute function and store if not already in memo
-            self.memo[args] = yield self.fn(*args)
-            self.timestamp[args] = time.time()
-            self.items += 1
+    @property
+    def cache(self):
+        # created on first use, like TTLCache
+        if self._cache is None:
+            factory = BACKENDS[options.memoize_backend]
+            self._cache = factory(self.namespace, options.memoize_max_items, options.memoize_max_bytes)
+        return self._cache
+
+    @classmethod
+    def keyed(cls, key):
+        """Memoize a function, caching each call under key(*args) instead of
+        its arguments, e.g. so that equivalent arguments share an entry. The
+        function is called with the arguments of the first call for a key
+
+        :param key: function returning the cache key tuple for the arguments
+        """
+        return lambda fn: cls(fn, key=key)
+
+    @property
+    def num_evictions(self):
+        return self.cache.num_evictions
+
+    def _cache_key(self, args):
+        return self.key(*args) if self.key else args
+
+    def _lookup(self, key):
+        """Return the cached entry if it is still fresh, recording a hit or miss"""
+        entry = self.cache.get(key)
+
+        if entry is None:
             self.num_misses += 1
-        elif time.time() > self.timestamp[args] + options.memoize_seconds:
-            # execute function and store if passed expiry time
-            self.memo[args] = yield self.fn(*args)
-            self.timestamp[args] = time.time()
+        elif time.time() > entry.expires:
             self.num_refreshes += 1
+            entry = None
         else:
             self.num_hits += 1
 
-        logging.debug('MemoizeCoroutine : ' + str(self.fn))
-        logging.debug('hits:' + str(self.num_hits) + ' misses:' + str(self.num_misses) + ' refreshes:' + str(self.num_refreshes) + ' clears:' + str(self.num_clearouts))
+        return entry
 
-        raise Return(self.memo[args])
+    def _store(self, key, value):
+        self.cache.set(key, value, options.memoize_seconds)
 
-# memoize a normal function
-class Memoize:
-    def __init__(self, fn):
-        self.fn = fn
-        self.memo = {}
-        self.timestamp = {}
-        self.items = 0
-        self.num_hits = 0L
-        self.num_misses = 0L
-        self.num_refreshes = 0L
-        self.num_clearouts = 0L
+    def prime(self, args, value):
+        """Cache a value fetched elsewhere, e.g. by a bulk warm-up"""
+        self._store(self._cache_key(args), value)
+
+    def invalidate(self, match):
+        """Delete the cached calls that match, see purge
+
+        :returns: number of entries deleted
+        """
+        return purge(self.cache, match)
+
+    def stats(self):
+        """Return the cache statistics for this function"""
+        return {
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'refreshes': self.num_refreshes,
+            'evictions': self.num_evictions,
+            'entries': len(self.cache),
+            'bytes': getattr(self.cache, 'bytes', None)
+        }
+
+    def _log(self, name):
+        # called for every memoized call, so don't format anything unless it's logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('%s : %s hits:%s misses:%s refreshes:%s evictions:%s', name, self.namespace,
+                          self.num_hits, self.num_misses, self.num_refreshes, self.num_evictions)
+
+
+# memoize a coroutine
+class MemoizeCoroutine(_MemoizeBase):
+    def __init__(self, fn, key=None):
+        super(MemoizeCoroutine, self).__init__(fn, key)
+        self.in_flight = {}
+        self._negative_cache = None
+        self.num_coalesced = 0L
+        self.num_stale_hits = 0L
+        self.num_stale_errors = 0L
+        self.num_negative_hits = 0L
+        self.num_negative_misses = 0L
+
+    def stats(self):
+        """Return the cache statistics for this coroutine"""
+        stats = super(MemoizeCoroutine, self).stats()
+        stats.update({
+            'coalesced': self.num_coalesced,
+            'in_flight': len(self.in_flight),
+            'stale_hits': self.num_stale_hits,
+            'stale_errors': self.num_stale_errors,
+            'negative_hits': self.num_negative_hits,
+            'negative_misses': self.num_negative_misses
+        })
+        return stats
+
+    @property
+    def negative_cache(self):
+        # "not found" errors are kept apart so they cannot push out real entries
+        if self._negative_cache is None:
+            self._negative_cache = LRUCache(options.memoize_negative_max_items)
+        return self._negative_cache
 
+    def invalidate(self, match):
+        """Delete the cached calls and "not found" errors that match, see purge
+
+        :returns: number of entries deleted
+        """
+        num_purged = super(MemoizeCoroutine, self).invalidate(match)
+        if self._negative_cache is not None:
+            num_purged += purge(self._negative_cache, match)
+        return num_purged
+
+    @coroutine
     def __call__(self, *args):
-        # clear if too many items (to stop memory being consumed indefinitely)
-        if self.items > options.memoize_max_items:
-            self.memo = {}
-            self.timestamp = {}
-            self.items = 0
-            self.num_clearouts += 1
-            
-        if args not in self.memo:
-            # execute function and store if not already in memo
-            self.memo[args] = self.fn(*args)
-            self.timestamp[args] = time.time()
-            self.items += 1
+        key = self._cache_key(args)
+        entry = self.cache.get(key)
+        now = time.time()
+
+        if entry is None:
+            self._raise_if_not_found(key, now)
+            # execute function and store if not already cached
             self.num_misses += 1
-        elif time.time() > self.timestamp[args] + options.memoize_seconds:
-            # execute function and store if passed expiry time
-            self.memo[args] = self.fn(*args)
-            self.timestamp[args] = time.time()
+            result = yield deadlines.shared(self._fetch(key, args))
+        elif now <= entry.expires:
+            self.num_hits += 1
+            result = entry.value
+        elif now <= entry.expires + options.memoize_stale_seconds:
+            # serve the stale value and refresh it once the request is handled
+            self.num_stale_hits += 1
+            with deadlines.detached():
+                IOLoop.current().add_callback(self._refresh, key, args)
+            result = entry.value
+        else:
+            # execute function and store if passed expiry time, falling back
+            # to the stale value for up to memoize_stale_if_error_seconds if
+            # the upstream service is failing, including while its circuit
+            # is open. Errors that are answers, e.g. a 404, are raised
             self.num_refreshes += 1
+            try:
+                result = yield deadlines.shared(self._fetch(key, args))
+            except Exception as exc:
+                if (not _is_upstream_failure(exc) or
+                        now > entry.expires + options.memoize_stale_if_error_seconds):
+                    raise
+                logging.warning('MemoizeCoroutine : serving stale value for %s after error: %s', self.fn, exc)
+                self.num_stale_errors += 1
+                result = entry.value
+
+        self._log('MemoizeCoroutine')
+
+        raise Return(result)
+
+    def _raise_if_not_found(self, key, now):
+        """Raise the cached error if the key recently resulted in a 404"""
+        if not options.memoize_negative_seconds:
+            return
+
+        entry = self.negative_cache.get(key)
+        if entry is not None and now <= entry.expires:
+            self.num_negative_hits += 1
+            raise entry.value
+
+        self.num_negative_misses += 1
+
+    def _refresh(self, key, args):
+        """Refresh an entry in the background, keeping the stale value on error"""
+        if key not in self.in_flight:
+            IOLoop.current().add_future(self._fetch(key, args), self._refreshed)
+
+    def _refreshed(self, future):
+        if future.exception() is not None:
+            logging.warning('MemoizeCoroutine : background refresh of %s failed: %s', self.fn, future.exception())
+
+    def _fetch(self, key, args):
+        """
+        Call the function, sharing a single call between all the callers
+        waiting for the same key. Errors are passed to every waiter
+        and are not cached. The call is detached from the deadline of the
+        request that started it, each caller waits until its own deadline
+        with deadlines.shared.
+
+        :param key: the cache key
+        :param args: tuple of arguments
+        :returns: a Future
+        """
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.num_coalesced += 1
+            return future
+
+        with deadlines.detached():
+            future = metrics.timed('resolution_upstream_seconds', self.fn(*args), function=self.name)
+        self.in_flight[key] = future
+        future.add_done_callback(partial(self._fetched, key))
+
+        return future
+
+    def _fetched(self, key, future):
+        del self.in_flight[key]
+        exc = future.exception()
+        if exc is None:
+            self._store(key, future.result())
+            if self._negative_cache is not None:
+                self._negative_cache.delete(key)
+        elif options.memoize_negative_seconds and _is_not_found(exc):
+            # drop the expired value, otherwise it would be refreshed again
+            # rather than the "not found" error being served from the cache
+            self.cache.delete(key)
+            self.negative_cache.set(key, exc, options.memoize_negative_seconds)
+
+# memoize a normal function
+class Memoize(_MemoizeBase):
+    def __call__(self, *args):
+        key = self._cache_key(args)
+        entry = self._lookup(key)
+
+        if entry is None:
+            # execute function and store if not cached or passed expiry time
+            result = self.fn(*args)
+            self._store(key, result)
         else:
-            self.num_hits += 1
+            result = entry.value
+
+        self._log('Memoize')
+
+        return result
 
-        logging.debug('Memoize : ' + str(self.fn))
-        logging.debug('hits:' + str(self.num_hits) + ' misses:' + str(self.num_misses) + ' refreshes:' + str(self.num_refreshes) + ' clears:' + str(self.num_clearouts))
 
-        return self.memo[args]
+def stats():
+    """Return the cache statistics for every memoized function, by namespace"""
+    return dict((memoized.namespace, memoized.stats()) for memoized in REGISTRY)
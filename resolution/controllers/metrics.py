@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Latency histograms and cache counters, exposed in the Prometheus text format.
+
+Each process records its own metrics. When the service runs several
+processes, each one regularly writes a snapshot of its metrics to a
+directory created before forking, and the process that handles a request
+for /metrics merges the snapshots of all the processes. Snapshots of
+processes that have exited are deleted, and ones that have not been updated
+for STALE_SNAPSHOTS snapshot intervals are ignored.
+"""
+import bisect
+import cPickle
+import errno
+import glob
+import logging
+import os
+import tempfile
+import time
+
+from koi import base
+from tornado.ioloop import PeriodicCallback
+from tornado.options import options, define
+
+define('metrics_dir', default='',
+       help='Directory the processes write their metrics to (a temporary directory by default)')
+define('metrics_snapshot_seconds', default=5,
+       help='Number of seconds between each process writing its metrics for /metrics')
+
+# number of metrics_snapshot_seconds after which a snapshot that has not been
+# updated is ignored
+STALE_SNAPSHOTS = 3
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'resolution_upstream_seconds': ('histogram', 'Latency of calls to upstream services'),
+    'resolution_request_seconds': ('histogram', 'Latency of requests by handler branch'),
+    'resolution_render_seconds': ('histogram', 'Time to render a template'),
+    'resolution_cache_hits_total': ('counter', 'Number of cache hits'),
+    'resolution_cache_misses_total': ('counter', 'Number of cache misses'),
+}
+
+# {(name, labels): [bucket counts..., sum]}, where labels is a sorted tuple of
+# (label, value) and the bucket counts are not cumulative
+_histograms = {}
+
+# {name: object with num_hits and num_misses}
+_caches = {}
+
+_directory = None
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration in a histogram
+
+    :param name: the metric's name
+    :param seconds: the duration
+    :param labels: the metric's labels
+    """
+    key = (name, _labels(labels))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+
+    histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+
+def timed(name, future, **labels):
+    """
+    Record how long a Future takes to resolve in a histogram
+
+    :param name: the metric's name
+    :param future: a Future
+    :param labels: the metric's labels
+    :returns: the future
+    """
+    start = time.time()
+    future.add_done_callback(lambda f: observe(name, time.time() - start, **labels))
+    return future
+
+
+def register_cache(name, cache):
+    """
+    Report the hit ratio of a cache
+
+    :param name: the cache's name, used as the "cache" label
+    :param cache: an object with num_hits and num_misses counters
+    """
+    _caches[name] = cache
+
+
+def snapshot():
+    """
+    Get this process' metrics
+
+    :returns: dict of histograms and counters
+    """
+    counters = {}
+    for name, cache in _caches.iteritems():
+        counters[('resolution_cache_hits_total', (('cache', name),))] = cache.num_hits
+        counters[('resolution_cache_misses_total', (('cache', name),))] = cache.num_misses
+
+    return {'histograms': dict((key, list(value)) for key, value in _histograms.iteritems()),
+            'counters': counters}
+
+
+def _merge(total, metrics):
+    for key, histogram in metrics['histograms'].iteritems():
+        merged = total['histograms'].setdefault(key, [0] * len(histogram))
+        for index, count in enumerate(histogram):
+            merged[index] += count
+
+    for key, count in metrics['counters'].iteritems():
+        total['counters'][key] = total['counters'].get(key, 0) + count
+
+
+def create_directory(path=None):
+    """
+    Create the directory that the processes write their metrics to, which has
+    to be done before forking
+
+    :param path: (optional) the directory, a temporary directory by default
+    """
+    global _directory
+
+    _directory = path or tempfile.mkdtemp(prefix='resolution-metrics-')
+    for filename in glob.glob(os.path.join(_directory, '*.metrics')):
+        os.remove(filename)
+
+
+def write_snapshot():
+    """Write this process' metrics to the shared directory"""
+    if not _directory:
+        return
+
+    filename = os.path.join(_directory, '{}.metrics'.format(os.getpid()))
+    with open(filename + '.tmp', 'wb') as f:
+        cPickle.dump(snapshot(), f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+
+
+def _is_alive(pid):
+    """Check if a process still exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+def _is_current(filename):
+    """
+    Check if a snapshot is from a living process and has been updated
+    recently, deleting it if the process has exited
+
+    :param filename: the snapshot's path
+    :returns: True if the snapshot should be collected
+    """
+    try:
+        pid = int(os.path.basename(filename).split('.')[0])
+    except ValueError:
+        return False
+
+    if not _is_alive(pid):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return False
+
+    try:
+        age = time.time() - os.path.getmtime(filename)
+    except OSError:
+        return False
+    return age <= STALE_SNAPSHOTS * options.metrics_snapshot_seconds
+
+
+def collect():
+    """
+    Get the metrics of all the processes
+
+    :returns: dict of histograms and counters
+    """
+    total = {'histograms': {}, 'counters': {}}
+    _merge(total, snapshot())
+
+    if _directory:
+        own = os.path.join(_directory, '{}.metrics'.format(os.getpid()))
+        for filename in glob.glob(os.path.join(_directory, '*.metrics')):
+            if filename == own or not _is_current(filename):
+                continue
+            try:
+                with open(filename, 'rb') as f:
+                    _merge(total, cPickle.load(f))
+            except (IOError, EOFError, cPickle.UnpicklingError) as exc:
+                logging.warning('Unable to read metrics from %s: %s', filename, exc)
+
+    return total
+
+
+def _format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def exposition(metrics):
+    """
+    Format metrics in the Prometheus text format
+
+    :param metrics: dict of histograms and counters, see collect
+    :returns: str
+    """
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described:
+            described.add(name)
+            metric_type, description = HELP.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+    for (name, labels), histogram in sorted(metrics['histograms'].iteritems()):
+        describe(name)
+        count = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+            count += bucket
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bound),)), count))
+        lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), histogram[-1]))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+
+    for (name, labels), value in sorted(metrics['counters'].iteritems()):
+        describe(name)
+        lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def start():
+    """Regularly write this process' metrics for the other processes"""
+    if _directory:
+        write_snapshot()
+        PeriodicCallback(write_snapshot, options.metrics_snapshot_seconds * 1000).start()
+
+
+class MetricsHandler(base.BaseHandler):
+    # scraped by monitoring without an OAuth token
+    METHOD_ACCESS = dict(base.BaseHandler.METHOD_ACCESS, GET=base.BaseHandler.UNAUTHENTICATED_ACCESS)
+
+    def initialize(self, **kwargs):
+        try:
+            self.version = kwargs['version']
+        except KeyError:
+            raise KeyError('App version is required')
+
+    def get(self):
+        """Get the service's metrics in the Prometheus text format"""
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.finish(exposition(collect()))
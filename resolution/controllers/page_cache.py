@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Render the HTML pages.
+
+The templates are compiled once by template_loader, before the workers are
+forked, instead of by each worker when a template is first used. Rendered
+asset and provider pages are kept in the configured memoize backend, keyed on
+everything the page depends on, and are sent with ETag and Last-Modified
+headers so that clients with the current page get a 304 Not Modified.
+"""
+import calendar
+import email.utils
+import hashlib
+import os
+import time
+from collections import namedtuple
+
+from tornado import template
+from tornado.options import define
+
+import metrics
+from http_cache import not_modified
+from memoize import TTLCache
+
+define('page_cache_seconds', default=60,
+       help='Number of seconds a rendered page is reused (0 to disable)')
+define('page_cache_max_items', default=1000,
+       help='Maximum number of rendered pages kept by each process')
+
+TEMPLATE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+Page = namedtuple('Page', ['html', 'etag', 'modified'])
+
+
+def template_loader():
+    """
+    Create a template loader with every template already compiled
+
+    :returns: a tornado.template.Loader for the template_loader application setting
+    """
+    loader = template.Loader(TEMPLATE_PATH)
+    for name in sorted(os.listdir(TEMPLATE_PATH)):
+        if name.endswith('.html'):
+            loader.load(name)
+
+    return loader
+
+
+def _not_modified_since(handler, modified):
+    """Check the request's If-Modified-Since header against when the page was rendered"""
+    since = handler.request.headers.get('If-Modified-Since')
+    if not since or handler.request.headers.get('If-None-Match'):
+        return False
+
+    since = email.utils.parsedate(since)
+    return since is not None and calendar.timegm(since) >= int(modified)
+
+
+class PageCache(TTLCache):
+    """The rendered pages, keyed by everything a page depends on"""
+    def __init__(self):
+        super(PageCache, self).__init__('resolution.pages', 'page_cache_max_items', 'page_cache_seconds')
+
+    def render(self, handler, key, template_name, **kwargs):
+        """
+        Render a template, store the page and write it to the response
+
+        :param handler: the RequestHandler
+        :param key: tuple identifying the page's content
+        :param template_name: the template's file name
+        :param kwargs: the template's arguments
+        """
+        start = time.time()
+        html = handler.render_string(template_name, **kwargs)
+        metrics.observe('resolution_render_seconds', time.time() - start, template=template_name)
+        page = Page(html, '"{}"'.format(hashlib.sha1(html).hexdigest()), time.time())
+
+        self.add(key, page)
+        self.write(handler, page)
+
+    def write(self, handler, page):
+        """
+        Write a page to the response, or a 304 Not Modified if the client
+        already has it
+
+        :param handler: the RequestHandler
+        :param page: a Page
+        """
+        handler.set_header('Last-Modified', email.utils.formatdate(page.modified, usegmt=True))
+
+        if not_modified(handler, page.etag):
+            return
+
+        if _not_modified_since(handler, page.modified):
+            handler.set_status(304)
+            handler.finish()
+        else:
+            handler.finish(page.html)
+
+    def invalidate(self, match):
+        """
+        Delete the pages whose keys match
+
+        :param match: function called with each page's key, which returns
+            True if the page should be deleted
+        :returns: number of pages deleted
+        """
+        return super(PageCache, self).invalidate(lambda key, page: match(key))
+
+
+pages = PageCache()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Run upstream calls concurrently"""
+from datetime import timedelta
+
+from koi import exceptions
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.options import options, define
+
+define('fanout_concurrency', default=10,
+       help='Maximum number of concurrent upstream calls made for one fan-out')
+define('fanout_timeout', default=10,
+       help='Number of seconds allowed for a fan-out of upstream calls')
+
+
+@coroutine
+def gather(fn, items, concurrency=None, timeout=None):
+    """
+    Call a coroutine for each item, running up to `concurrency` calls at once
+
+    :param fn: a coroutine function taking one item
+    :param items: iterable of items
+    :param concurrency: (optional) maximum number of concurrent calls,
+        defaults to the fanout_concurrency option
+    :param timeout: (optional) number of seconds allowed for all the calls,
+        defaults to the fanout_timeout option
+    :returns: list of results, in the same order as items
+    :raises: koi.exceptions.HTTPError if the calls took too long
+    """
+    items = list(items)
+    results = [None] * len(items)
+    remaining = iter(enumerate(items))
+
+    @coroutine
+    def worker():
+        for index, item in remaining:
+            results[index] = yield fn(item)
+
+    concurrency = concurrency or options.fanout_concurrency
+    workers = gen.multi_future([worker() for _ in xrange(min(concurrency, len(items)))])
+
+    timeout = timeout or options.fanout_timeout
+    try:
+        yield gen.with_timeout(timedelta(seconds=timeout), workers)
+    except gen.TimeoutError:
+        raise exceptions.HTTPError(504, 'Timed out waiting for upstream services')
+
+    raise Return(results)
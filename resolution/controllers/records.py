@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Compact records of the upstream resources kept in the memoize caches.
+
+The accounts and query services return complete documents, of which only a
+few fields are used to resolve a hub key or render a page. Each document is
+projected into a record with __slots__ when it is fetched, so that the
+caches only hold the fields that are used. Records can be pickled for the
+shared memoize backend.
+"""
+
+
+def plain(value):
+    """Copy a decoded JSON value, replacing dict subclasses (e.g. chub's
+    ResponseObject) with plain dicts"""
+    if isinstance(value, dict):
+        return dict((k, plain(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
+
+
+class Record(object):
+    """
+    Base class for records, which have a field for each name in __slots__.
+    Fields that are not given are None.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+
+        if fields:
+            raise TypeError('Unknown fields: ' + ', '.join(sorted(fields)))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__
+            if getattr(self, name) is not None))
+
+
+class Repository(Record):
+    """The fields of a repository used to resolve hub keys"""
+    __slots__ = ('id', 'organisation_id', 'organisation_name', 'location')
+
+    @classmethod
+    def from_resource(cls, data):
+        """
+        Project a repository from the accounts service
+
+        :param data: the repository resource's data
+        :returns: a Repository
+        """
+        organisation = data.get('organisation') or {}
+        service = data.get('service') or {}
+
+        return cls(id=data.get('id'),
+                   organisation_id=organisation.get('id'),
+                   organisation_name=organisation.get('name'),
+                   location=service.get('location'))
+
+
+class Provider(Record):
+    """
+    The fields of an organisation used to resolve hub keys and render pages
+
+    Templates and handlers use a provider as a read only dict, so a Provider
+    has the dict methods for reading, where fields that are None are treated
+    as missing.
+    """
+    __slots__ = ('id', 'name', 'description', 'website', 'email', 'phone', 'address', 'logo',
+                 'primary_color', 'secondary_color', 'star_rating', 'reference_links', 'payment')
+
+    @classmethod
+    def from_resource(cls, data):
+        """
+        Project an organisation from the accounts or query service
+
+        :param data: the organisation resource's data
+        :returns: a Provider
+        """
+        return cls(**dict((name, plain(data.get(name))) for name in cls.__slots__))
+
+    def copy(self, **changes):
+        """
+        Copy the provider
+
+        :param changes: fields to change in the copy
+        :returns: a Provider
+        """
+        fields = dict(self.iteritems())
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def keys(self):
+        return [name for name in self.__slots__ if getattr(self, name) is not None]
+
+    def iteritems(self):
+        return ((name, getattr(self, name)) for name in self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, name):
+        return name in self.__slots__ and getattr(self, name) is not None
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return getattr(self, name)
+
+
+class AssetDetails(Record):
+    """
+    The nodes of an asset's JSON-LD description used to resolve hub keys
+    and render pages
+
+    ids is a tuple of (node id, id type reference, id value) for each op:Id
+    node, and description is (node id, description) for the op:Asset node
+    with a description, or None.
+    """
+    __slots__ = ('ids', 'description')
+
+    @classmethod
+    def from_resource(cls, data):
+        """
+        Project an asset from the query service
+
+        :param data: the entity resource's data, with an "@graph"
+        :returns: an AssetDetails
+        """
+        ids = []
+        description = None
+
+        for item in data.get('@graph') or []:
+            types = item.get('@type') or ()
+            if isinstance(types, basestring):
+                types = (types,)
+
+            if 'op:Id' in types:
+                ids.append((item.get('@id'), item['op:id_type']['@id'], item['op:value']['@value']))
+            elif 'op:Asset' in types and item.get('dcterm:description', '') != '':
+                description = (item.get('@id'), item['dcterm:description'].get('@value', ''))
+
+        return cls(ids=tuple(ids), description=description)
@@ -12,17 +12,24 @@ import logging
 
 import urllib
 
-from chub import API
 from koi import base, exceptions
-from koi.configure import ssl_server_options
 from bass.hubkey import generate_hub_key
 from tornado import httpclient, httputil
 from tornado.gen import coroutine, Return
 from tornado.options import options, define
 from tornado.web import RedirectHandler
 
-from hub_key_handler import redirectToAsset, _get_provider_by_name, _get_repository, _get_repos_for_source_id
+import deadlines
+from clients import get_client
+from http_cache import ASSET_PAGE, ERROR, PROVIDER_PAGE, REDIRECT, etag, not_modified, set_cache_headers
+from hub_key_handler import (RequestContext, redirectToAsset, _get_provider_by_name, _get_provider_document_by_name,
+                             _get_repository, _get_repos_for_source_id, _mergeQuerystrings)
+import metrics
 from memoize import MemoizeCoroutine
+from page_cache import pages
+from parallel import gather
+from records import Provider, plain
+from resolution_index import asset_entry, provider_asset_entry, resolved
 
 define('redirect_to_website', default='http://openpermissions.org/',
        help='The website to which the resolution service redirects for unknown requests')
@@ -37,11 +44,29 @@ def _get_providers_by_type_and_id(source_id_type, source_id):
     :returns: list of organisations
     :raises: koi.exceptsion.HTTPError
     """
-    client = API(options.url_query, ssl_options=ssl_server_options())
+    licensors = yield _fetch_licensors(source_id_type, source_id)
+    raise Return([Provider.from_resource(licensor) for licensor in licensors])
+
+@MemoizeCoroutine
+def _get_licensors_by_type_and_id(source_id_type, source_id):
+    """Get the matching providers' full licensor resources, which are only
+    needed for JSON responses, see _get_providers_by_type_and_id
+
+    :param source_id_type: str
+    :param source_id: str
+    :returns: list of dicts
+    :raises: koi.exceptions.HTTPError
+    """
+    return _fetch_licensors(source_id_type, source_id)
+
+@coroutine
+def _fetch_licensors(source_id_type, source_id):
+    """Fetch the licensors of an asset from the query service"""
+    client = get_client(options.url_query)
 
     try:
         res = yield client.query.licensors.get(source_id_type=source_id_type, source_id=source_id)
-        raise Return(res['data'])
+        raise Return(plain(res['data']))
     except httpclient.HTTPError as exc:
         if exc.code == 404:
             msg = 'No matching providers found'
@@ -82,7 +107,38 @@ class RedirectHandler(base.BaseHandler):
         except KeyError:
             raise KeyError('App version is required')
 
-    @coroutine
+        # the A, B, C or D path taken by get
+        self.branch = 'other'
+
+    def on_finish(self):
+        metrics.observe('resolution_request_seconds', self.request.request_time(),
+                        handler='redirect', branch=self.branch)
+
+    def write_error(self, status_code, **kwargs):
+        """
+        Set the caching headers for errors and use BaseHandler.write_error
+
+        :param status_code: the response's status code, e.g. 500
+        """
+        set_cache_headers(self, ERROR)
+        super(RedirectHandler, self).write_error(status_code, **kwargs)
+
+    def _redirect_if_resolved(self, index_key, context):
+        """
+        Redirect if the asset has already been resolved to a reference link
+
+        :param index_key: the asset's key in the resolution index
+        :param context: the RequestContext
+        :returns: True if the request has been redirected
+        """
+        target = None if context.show_json else resolved.lookup(index_key)
+        if target:
+            logging.debug("redirect to resolved link")
+            set_cache_headers(self, REDIRECT)
+            self.redirect(_mergeQuerystrings(context, target))
+
+        return bool(target)
+
     def get(self):
         """
         Resolve an asset from querystring parameters:
@@ -90,12 +146,14 @@ class RedirectHandler(base.BaseHandler):
             . hubidt = asset id type
             . hubaid = asset id
         """
+        return deadlines.run(self._get)
+
+    @coroutine
+    def _get(self):
         providerId = self.get_query_argument('hubpid', None)
         assetIdType = self.get_query_argument('hubidt', None)
         assetId = self.get_query_argument('hubaid', None)
-        
-        global showJson
-        showJson = self.get_query_argument('hubjson', None)
+        context = RequestContext(self.request.query, show_json=bool(self.get_query_argument('hubjson', None)))
 
         # get the subdomain from the request
         hostProvider = _getHostSubDomain(self)
@@ -107,24 +165,39 @@ class RedirectHandler(base.BaseHandler):
                 providerId = hostProvider
             else:
                 if hostProvider.lower() != providerId.lower():
+                    set_cache_headers(self, ERROR)
                     self.render('error.html', errors=['hostname contradicts querystring provider'])
                     raise Return()
 
         # if our parameters are all missing redirect to default page 
         if not providerId and not assetIdType and not assetId:
             logging.debug("A : redirect to options.redirect_to_website")
+            self.branch = 'A'
+            set_cache_headers(self, REDIRECT)
             self.redirect(options.redirect_to_website)
             raise Return()
 
         # if providerId is missing but other two are there then look for multiple providers for asset
         if not providerId and assetIdType and assetId:
             logging.debug("C : lookup asset")
+            self.branch = 'C'
 
-            # search for providers by assetId and assetIdType
-            providers = yield _get_providers_by_type_and_id(assetIdType, assetId)
+            index_key = asset_entry(assetIdType, assetId)
+            if self._redirect_if_resolved(index_key, context):
+                raise Return()
+
+            # search for providers by assetId and assetIdType, the JSON
+            # response includes the licensor as returned by the query service
+            if context.show_json:
+                licensors = yield _get_licensors_by_type_and_id(assetIdType, assetId)
+                providers = [Provider.from_resource(licensor) for licensor in licensors]
+            else:
+                licensors = None
+                providers = yield _get_providers_by_type_and_id(assetIdType, assetId)
 
             if len(providers) == 1:
-                yield redirectToAsset(self, providers[0], assetIdType, assetId, showJson)
+                yield redirectToAsset(self, context, providers[0], assetIdType, assetId, index_key=index_key,
+                                      provider_document=licensors[0] if licensors else None)
                 raise Return()
             else:
                 links=[]
@@ -132,9 +205,10 @@ class RedirectHandler(base.BaseHandler):
                 assets = yield _get_repos_for_source_id(assetIdType, assetId)
 
                 # get provider details for each and build a link
-                for asset in assets:
-                    repo = yield _get_repository(asset["repository_id"])
-                    provider_name = repo["data"]["organisation"]["name"]
+                repos = yield gather(lambda asset: _get_repository(asset["repository_id"]), assets)
+
+                for asset, repo in zip(assets, repos):
+                    provider_name = repo.organisation_name
                     hub_key = generate_hub_key(options.default_resolver_id, options.hub_id, asset["repository_id"], 'asset', asset["entity_id"])
 
                     link = {
@@ -144,28 +218,45 @@ class RedirectHandler(base.BaseHandler):
 
                     links.append(link)
 
-                self.render('multiple_providers_template.html', links=links)
+                set_cache_headers(self, ASSET_PAGE)
+                if not not_modified(self, etag(links)):
+                    self.render('multiple_providers_template.html', links=links)
                 raise Return()
 
         # look for just providerId specified
         if providerId and not assetIdType and not assetId:
             logging.debug("D : show provider landing page")
+            self.branch = 'D'
             # get provider info
             provider = yield _get_provider_by_name(providerId)
 
             # show the provider's special branded landing page
-            self.render('provider_template.html', data=provider)
+            set_cache_headers(self, PROVIDER_PAGE)
+            pages.render(self, ('provider', provider.get('id')), 'provider_template.html', data=provider)
             raise Return()
 
         # look for all three parameters specified
         if providerId and assetIdType and assetId:
             logging.debug("B : all specified")
-            # look up reference links stuff and redirect
-            provider = yield _get_provider_by_name(providerId)
-            logging.debug ('prov ' + str(provider))
-            yield redirectToAsset(self, provider, assetIdType, assetId, showJson)
+            self.branch = 'B'
+            index_key = provider_asset_entry(providerId, assetIdType, assetId)
+            if self._redirect_if_resolved(index_key, context):
+                raise Return()
+
+            # look up reference links stuff and redirect, the JSON response
+            # includes the organisation as returned by the accounts service
+            if context.show_json:
+                provider_document = yield _get_provider_document_by_name(providerId)
+                provider = Provider.from_resource(provider_document)
+            else:
+                provider_document = None
+                provider = yield _get_provider_by_name(providerId)
+            logging.debug('prov %s', provider.get('id'))
+            yield redirectToAsset(self, context, provider, assetIdType, assetId, index_key=index_key,
+                                  provider_document=provider_document)
         else:
             # this should never happen so return error if it does
+            set_cache_headers(self, ERROR)
             self.render('error.html', errors=['unable to find matching asset from provided identifiers'])
             raise Return()
 
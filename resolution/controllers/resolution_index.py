@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Index of resolved redirects.
+
+Resolving a hub key, or a provider and asset id, to a reference link takes a
+chain of upstream calls. The redirect target is stored here once it has been
+resolved, so that later requests for the same key are redirected without any
+upstream calls. Entries are kept in the configured memoize backend, so the
+index is shared between the workers when memoize_backend is "shared".
+"""
+from tornado.options import define
+
+from memoize import TTLCache
+
+define('resolution_index_seconds', default=300,
+       help='Number of seconds a resolved redirect is reused (0 to disable)')
+define('resolution_index_max_items', default=100000,
+       help='Maximum number of resolved redirects kept by each process')
+
+
+def hub_key_entry(hub_key):
+    """Index key for a hub key"""
+    return ('hub_key', hub_key)
+
+
+def provider_asset_entry(provider_id, id_type, asset_id):
+    """Index key for an asset of a known provider"""
+    return ('provider_asset', provider_id.lower(), id_type.lower(), asset_id)
+
+
+def asset_entry(id_type, asset_id):
+    """Index key for an asset that may be held by any provider"""
+    return ('asset', id_type.lower(), asset_id)
+
+
+class ResolutionIndex(TTLCache):
+    """The redirect target for each index key, without the request's query string"""
+    def __init__(self):
+        super(ResolutionIndex, self).__init__('resolution.index', 'resolution_index_max_items',
+                                              'resolution_index_seconds')
+
+
+resolved = ResolutionIndex()
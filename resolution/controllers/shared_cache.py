@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Memoize cache backend shared between forked worker processes.
+
+The cache lives in an anonymous shared memory map which is created by the
+parent process before it forks, so every worker reads and writes the same
+pages. The map is split into fixed size slots grouped into small buckets;
+a key is hashed to a bucket and, when the bucket is full, the entry closest
+to expiry is replaced. Buckets are locked with fcntl byte range locks.
+"""
+import copy_reg
+import cPickle as pickle
+import fcntl
+import hashlib
+import logging
+import mmap
+import struct
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+from chub.handlers import ResponseObject
+from tornado.options import options, define
+
+from memoize import _Entry, register_backend
+
+define('memoize_shared_slots', default=8192,
+       help='Number of entries in the shared memoize cache')
+define('memoize_shared_slot_bytes', default=8192,
+       help='Maximum size in bytes of a pickled entry in the shared memoize cache')
+
+# key hash, namespace id, timestamp, expiry time, payload length
+_HEADER = struct.Struct('<QIddI')
+_WAYS = 4
+
+# ResponseObject's __getattr__ breaks unpickling, so pickle it as a dict
+copy_reg.pickle(ResponseObject, lambda obj: (ResponseObject, (dict(obj),)))
+
+
+class SharedRegion(object):
+    """Shared memory map and the lock file guarding its buckets"""
+    def __init__(self, slots, slot_bytes):
+        self.buckets = max(slots // _WAYS, 1)
+        self.slot_bytes = slot_bytes
+        self.map = mmap.mmap(-1, self.buckets * _WAYS * slot_bytes)
+        self.lock_file = tempfile.TemporaryFile()
+
+    @contextmanager
+    def lock(self, bucket):
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, bucket)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, bucket)
+
+    def slots(self, bucket=None):
+        """Return the offsets of the slots in a bucket, or of every slot"""
+        if bucket is None:
+            return xrange(0, len(self.map), self.slot_bytes)
+        start = bucket * _WAYS * self.slot_bytes
+        return xrange(start, start + _WAYS * self.slot_bytes, self.slot_bytes)
+
+
+_region = None
+
+
+def create_region(slots, slot_bytes):
+    """
+    Create the shared memory region. Must be called before the worker
+    processes are forked for the cache to be shared between them.
+
+    :param slots: number of entries
+    :param slot_bytes: maximum size of a pickled entry
+    :returns: SharedRegion
+    """
+    global _region
+    _region = SharedRegion(slots, slot_bytes)
+    return _region
+
+
+class SharedMemoryCache(object):
+    """The entries of one memoized function in the shared region"""
+    def __init__(self, namespace, region):
+        self.namespace = namespace
+        self.namespace_id = zlib.crc32(namespace) & 0xffffffff
+        self.region = region
+        self.num_evictions = 0L
+        self.num_oversized = 0L
+
+    def __len__(self):
+        return sum(1 for offset in self.region.slots() if self._owns(offset))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _hash(self, key):
+        digest = hashlib.md5(self.namespace + '\0' + repr(key)).digest()
+        # 0 marks an empty slot
+        return struct.unpack('<Q', digest[:8])[0] | 1
+
+    def _owns(self, offset, key_hash=None):
+        header = _HEADER.unpack_from(self.region.map, offset)
+        return (header[0] != 0 and header[1] == self.namespace_id and
+                (key_hash is None or header[0] == key_hash))
+
+    def _find(self, key_hash):
+        """Return the offset of the slot holding key_hash, or None"""
+        for offset in self.region.slots(key_hash % self.region.buckets):
+            if self._owns(offset, key_hash):
+                return offset
+
+    def get(self, key):
+        key_hash = self._hash(key)
+
+        with self.region.lock(key_hash % self.region.buckets):
+            offset = self._find(key_hash)
+            if offset is None:
+                return None
+            _, _, timestamp, expires, length = _HEADER.unpack_from(self.region.map, offset)
+            start = offset + _HEADER.size
+            payload = self.region.map[start:start + length]
+
+        stored_key, value = pickle.loads(payload)
+        if stored_key != key:
+            return None
+
+        return _Entry(value, timestamp, expires, length)
+
+    def set(self, key, value, ttl):
+        payload = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.region.slot_bytes - _HEADER.size:
+            self.num_oversized += 1
+            logging.debug('SharedMemoryCache : entry too large for %s', self.namespace)
+            return
+
+        key_hash = self._hash(key)
+        bucket = key_hash % self.region.buckets
+        now = time.time()
+
+        with self.region.lock(bucket):
+            offset = self._find(key_hash)
+            if offset is None:
+                offset = min(self.region.slots(bucket), key=self._replacement_order)
+                if _HEADER.unpack_from(self.region.map, offset)[0] != 0:
+                    self.num_evictions += 1
+
+            start = offset + _HEADER.size
+            self.region.map[start:start + len(payload)] = payload
+            _HEADER.pack_into(self.region.map, offset, key_hash, self.namespace_id, now, now + ttl, len(payload))
+
+    def _replacement_order(self, offset):
+        # prefer empty slots, then the entry that expires first
+        key_hash, _, _, expires, _ = _HEADER.unpack_from(self.region.map, offset)
+        return (key_hash != 0, expires)
+
+    def delete(self, key):
+        key_hash = self._hash(key)
+
+        with self.region.lock(key_hash % self.region.buckets):
+            offset = self._find(key_hash)
+            if offset is not None:
+                _HEADER.pack_into(self.region.map, offset, 0, 0, 0, 0, 0)
+
+    def items(self):
+        items = []
+        for bucket in xrange(self.region.buckets):
+            with self.region.lock(bucket):
+                payloads = []
+                for offset in self.region.slots(bucket):
+                    if self._owns(offset):
+                        length = _HEADER.unpack_from(self.region.map, offset)[4]
+                        start = offset + _HEADER.size
+                        payloads.append(self.region.map[start:start + length])
+
+            items.extend(pickle.loads(payload) for payload in payloads)
+
+        return items
+
+    def clear(self):
+        for bucket in xrange(self.region.buckets):
+            with self.region.lock(bucket):
+                for offset in self.region.slots(bucket):
+                    if self._owns(offset):
+                        _HEADER.pack_into(self.region.map, offset, 0, 0, 0, 0, 0)
+
+
+def _make_cache(namespace, max_items, max_bytes):
+    if _region is None:
+        logging.warning('Shared memoize cache created after forking, it will not be shared between processes')
+        create_region(options.memoize_shared_slots, options.memoize_shared_slot_bytes)
+
+    return SharedMemoryCache(namespace, _region)
+
+
+register_backend('shared', _make_cache)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Report the cache and upstream connection statistics of the process handling the request"""
+import os
+
+from koi import base
+
+import clients
+import memoize
+from page_cache import pages
+from resolution_index import resolved
+
+
+def stats():
+    """
+    Get this process' statistics
+
+    :returns: dict
+    """
+    return {
+        'pid': os.getpid(),
+        'memoize': memoize.stats(),
+        'resolution_index': {'hits': resolved.num_hits, 'misses': resolved.num_misses},
+        'pages': {'hits': pages.num_hits, 'misses': pages.num_misses},
+        'upstreams': clients.stats()
+    }
+
+
+class StatsHandler(base.BaseHandler):
+    # unlike /metrics, describes the process' internals, so needs read access
+    METHOD_ACCESS = dict(base.BaseHandler.METHOD_ACCESS, GET=base.BaseHandler.READ_ACCESS)
+
+    def initialize(self, **kwargs):
+        try:
+            self.version = kwargs['version']
+        except KeyError:
+            raise KeyError('App version is required')
+
+    def get(self):
+        """
+        Get the statistics of the process handling the request, e.g.
+            {"status": 200, "data": {"pid": 123, "memoize": {"resolution.controllers.hub_key_handler._get_provider":
+                                                             {"hits": 10, "misses": 2, ...}}, ...}}
+        """
+        self.set_header('Cache-Control', 'no-cache')
+        self.finish({'status': 200, 'data': stats()})
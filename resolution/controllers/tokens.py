@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Per-process cache of the OAuth tokens used to call other services.
+
+A token is requested once, reused until shortly before it expires and
+refreshed in the background ahead of its expiry, so the auth service is
+called about once per token lifetime. Concurrent requests for a token
+share a single call to the auth service.
+"""
+import base64
+import logging
+import time
+import urllib
+
+from chub.oauth2 import CLIENT_CREDENTIALS, Read
+from koi import exceptions
+from tornado import httpclient
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.options import options, define
+
+import deadlines
+import metrics
+from clients import get_client
+
+define('token_refresh_seconds', default=120,
+       help='Number of seconds before an OAuth token expires that it is refreshed')
+
+# don't use a token with less than this many seconds remaining
+MIN_REMAINING_SECONDS = 10
+
+
+class TokenManager(object):
+    """Keeps a token with the given scope for this service"""
+    def __init__(self, scope):
+        self.scope = scope
+        self.access_token = None
+        self.expiry = 0
+        self.in_flight = None
+        self.num_requests = 0L
+
+    @coroutine
+    def get(self):
+        """
+        Get a valid token, only calling the auth service if there isn't one
+
+        :returns: the access token
+        :raises: koi.exceptions.HTTPError
+        """
+        if self.access_token and self.expiry - time.time() > MIN_REMAINING_SECONDS:
+            raise Return(self.access_token)
+
+        token = yield self.refresh()
+        raise Return(token)
+
+    def refresh(self):
+        """
+        Request a new token, sharing one request between concurrent callers
+
+        :returns: a Future resolving to the access token
+        """
+        future = self.in_flight
+        if future is None:
+            future = self.in_flight = metrics.timed('resolution_upstream_seconds', self._request(),
+                                                    function='get_token')
+            future.add_done_callback(self._refreshed)
+
+        return future
+
+    @coroutine
+    def _request(self):
+        logging.debug('Getting an OAuth token with scope "%s"', self.scope)
+        self.num_requests += 1
+
+        credentials = base64.b64encode('{}:{}'.format(options.service_id, options.client_secret))
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Accept': 'application/json',
+                   'Authorization': 'Basic ' + credentials}
+        body = urllib.urlencode({'grant_type': CLIENT_CREDENTIALS, 'scope': str(self.scope)})
+
+        client = get_client(options.url_auth)
+        try:
+            response = yield client.auth.token.post(body=body, headers=headers)
+        except httpclient.HTTPError as exc:
+            raise exceptions.HTTPError(exc.code, 'Unable to get token', source='auth')
+
+        self.access_token = response['access_token']
+        self.expiry = response.get('expiry', time.time() + response.get('expires_in', 0))
+
+        # refresh the token before it expires
+        delay = max(self.expiry - time.time() - options.token_refresh_seconds, MIN_REMAINING_SECONDS)
+        with deadlines.detached():
+            IOLoop.current().call_later(delay, self._refresh_in_background)
+
+        raise Return(self.access_token)
+
+    def _refreshed(self, future):
+        self.in_flight = None
+
+    def _refresh_in_background(self):
+        IOLoop.current().add_future(self.refresh(), self._refreshed_in_background)
+
+    def _refreshed_in_background(self, future):
+        if future.exception() is not None:
+            logging.warning('Unable to refresh OAuth token with scope "%s": %s', self.scope, future.exception())
+
+
+read_token = TokenManager(Read())
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Load providers and repositories from the accounts service into the memoize caches"""
+import logging
+import random
+
+from tornado import process
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.options import options, define
+
+from clients import get_client
+from hub_key_handler import _get_provider, _get_provider_by_name, _get_repository
+from records import Provider, Repository
+
+define('warm_up', default=True,
+       help='Load providers and repositories from the accounts service at start up')
+define('warm_up_interval_seconds', default=3600,
+       help='Number of seconds between loading providers and repositories (0 to only load at start up)')
+define('warm_up_page_size', default=100,
+       help='Number of organisations or repositories fetched from the accounts service in each request')
+define('warm_up_max_items', default=10000,
+       help='Maximum number of organisations, and of repositories, loaded')
+
+# fraction of warm_up_interval_seconds by which each interval is randomly
+# lengthened or shortened, so that processes don't all reload together
+JITTER = 0.1
+
+
+@coroutine
+def _fetch_all(resource):
+    """
+    Fetch a list from the accounts service a page at a time, up to
+    warm_up_max_items
+
+    :param resource: the accounts service resource, e.g. organisations
+    :returns: list of dicts
+    """
+    items = []
+    page = 1
+    while len(items) < options.warm_up_max_items:
+        result = yield resource.get(page=page, page_size=options.warm_up_page_size)
+        items.extend(result['data'])
+        # a short page is the last, and a longer one means paging isn't supported
+        if len(result['data']) != options.warm_up_page_size:
+            break
+        page += 1
+
+    raise Return(items[:options.warm_up_max_items])
+
+
+@coroutine
+def warm_up():
+    """
+    Fetch every organisation and repository from the accounts service and
+    cache them as if they had been fetched by _get_provider,
+    _get_provider_by_name and _get_repository
+
+    :returns: number of organisations and repositories cached
+    """
+    client = get_client(options.url_accounts)
+    organisations = yield _fetch_all(client.accounts.organisations)
+    repositories = yield _fetch_all(client.accounts.repositories)
+
+    for organisation in organisations:
+        provider = Provider.from_resource(organisation)
+        _get_provider.prime((organisation['id'],), provider)
+        if organisation.get('name'):
+            _get_provider_by_name.prime((organisation['name'],), provider)
+
+    num_repositories = 0
+    for repository in repositories:
+        # only cache repositories with the fields used to resolve hub keys
+        if repository.get('organisation', {}).get('id') and repository.get('service', {}).get('location'):
+            _get_repository.prime((repository['id'],), Repository.from_resource(repository))
+            num_repositories += 1
+
+    raise Return((len(organisations), num_repositories))
+
+
+@coroutine
+def _run():
+    try:
+        num_organisations, num_repositories = yield warm_up()
+    except Exception as exc:
+        logging.warning('Unable to warm up caches: %s', exc)
+    else:
+        logging.info('Warmed up caches with %s organisations and %s repositories',
+                     num_organisations, num_repositories)
+
+    if options.warm_up_interval_seconds:
+        delay = options.warm_up_interval_seconds * random.uniform(1 - JITTER, 1 + JITTER)
+        IOLoop.current().call_later(delay, _run)
+
+
+def start():
+    """Warm up the caches now, and then about every warm_up_interval_seconds"""
+    if not options.warm_up:
+        return
+
+    # a shared cache only needs to be warmed up by one worker
+    if options.memoize_backend == 'shared' and process.task_id() not in (None, 0):
+        return
+
+    IOLoop.current().add_callback(_run)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Benchmark the resolution service against fake upstream services.
+
+The fake services and the resolution service are started in their own
+processes on localhost, then a mix of hub key, provider, asset and JSON
+requests is sent to the resolution service, e.g.
+
+    python -m tests.benchmark.run --requests=5000 --concurrency=50 --processes=4 --upstream-latency=0.02
+
+Reports the requests per second, latency percentiles, number of upstream
+calls per request and the memory used by each resolution process.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+from collections import Counter, defaultdict
+
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.options import options
+
+import upstreams
+
+DEFAULT_MIX = 's0:2,s1:3,provider:1,asset:2,provider_asset:1,json:1'
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the resolution service')
+    parser.add_argument('--requests', type=int, default=2000, help='number of requests to measure')
+    parser.add_argument('--warmup', type=int, default=200, help='number of requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of concurrent requests')
+    parser.add_argument('--processes', type=int, default=1, help='number of resolution processes')
+    parser.add_argument('--memoize-backend', default='local', help='memoize_backend option, e.g. local or shared')
+    parser.add_argument('--providers', type=int, default=20, help='number of providers in the data set')
+    parser.add_argument('--assets', type=int, default=1000, help='number of assets in the data set')
+    parser.add_argument('--upstream-latency', type=float, default=0.005,
+                        help='average number of seconds taken by each upstream call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of upstream calls that fail with a 503')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weights of each kind of request, default ' + DEFAULT_MIX)
+    parser.add_argument('--port', type=int, default=8709, help='port for the resolution service')
+    parser.add_argument('--upstream-port', type=int, default=8710, help='port for the fake upstream services')
+    parser.add_argument('--seed', type=int, default=0, help='seed for choosing requests')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args(argv)
+
+
+def _configure_logging():
+    # errors are counted in the report, so don't log every failed request
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+
+
+def serve_upstreams(args, dataset):
+    """Run the fake upstream services, in a child process"""
+    _configure_logging()
+    upstreams.make_application(dataset, args.upstream_latency, args.error_rate).listen(
+        args.upstream_port, '127.0.0.1')
+    IOLoop.current().start()
+
+
+def serve_resolution(args, upstream_url):
+    """Run the resolution service against the fake upstream services, in a child process"""
+    # in its own process group, so that the forked processes can be stopped together
+    os.setpgrp()
+    _configure_logging()
+
+    from koi.configure import load_config_file
+    from resolution.app import CONF_DIR, make_application, serve
+
+    load_config_file(CONF_DIR)
+    for name in ('url_accounts', 'url_auth', 'url_index', 'url_query'):
+        setattr(options, name, upstream_url)
+    options.use_oauth = False
+    options.memoize_backend = args.memoize_backend
+
+    server = HTTPServer(make_application())
+    server.bind(args.port, '127.0.0.1')
+    serve(server, args.processes)
+
+
+def make_requests(args, dataset, base_url):
+    """
+    Choose the requests to send
+
+    :returns: list of (kind, url)
+    """
+    rng = random.Random(args.seed)
+    mix = [(kind, int(weight)) for kind, weight in (part.split(':') for part in args.mix.split(','))]
+    kinds = [kind for kind, weight in mix for _ in xrange(weight)]
+
+    def url(kind, asset):
+        provider = dataset.providers_for(asset)[0]
+        repository = asset['repositories'][0]
+        if kind == 's0':
+            return '{}/s0/hub1/asset/{}/{}/{}'.format(base_url, provider['id'], upstreams.ID_TYPE,
+                                                     asset['source_id'])
+        elif kind == 's1':
+            return '{}/s1/hub1/{}/asset/{}'.format(base_url, repository['id'], asset['entity_id'])
+        elif kind == 'provider':
+            return '{}/?hubpid={}'.format(base_url, provider['name'])
+        elif kind == 'asset':
+            return '{}/?hubidt={}&hubaid={}'.format(base_url, upstreams.ID_TYPE, asset['source_id'])
+        elif kind == 'provider_asset':
+            return '{}/?hubpid={}&hubidt={}&hubaid={}'.format(base_url, provider['name'], upstreams.ID_TYPE,
+                                                            asset['source_id'])
+        elif kind == 'json':
+            return '{}/?hubpid={}&hubidt={}&hubaid={}&hubjson=1'.format(base_url, provider['name'],
+                                                                     upstreams.ID_TYPE, asset['source_id'])
+        raise ValueError('Unknown kind of request ' + kind)
+
+    requests = []
+    for _ in xrange(args.warmup + args.requests):
+        kind = rng.choice(kinds)
+        requests.append((kind, url(kind, rng.choice(dataset.assets))))
+
+    return requests
+
+
+@coroutine
+def wait_until_up(url, timeout=30):
+    client = AsyncHTTPClient()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            yield client.fetch(url)
+        except Exception:
+            if time.time() > deadline:
+                raise
+            yield gen.sleep(0.1)
+        else:
+            break
+
+
+@coroutine
+def send(requests, concurrency):
+    """
+    Send requests, with up to `concurrency` requests at once
+
+    :returns: list of (kind, status code, seconds)
+    """
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    remaining = iter(requests)
+    results = []
+
+    @coroutine
+    def worker():
+        for kind, url in remaining:
+            start = time.time()
+            response = yield client.fetch(url, follow_redirects=False, raise_error=False, request_timeout=60)
+            results.append((kind, response.code, time.time() - start))
+
+    yield [worker() for _ in xrange(concurrency)]
+    client.close()
+    raise Return(results)
+
+
+@coroutine
+def upstream_counts(upstream_url):
+    response = yield AsyncHTTPClient().fetch(upstream_url + '/_stats')
+    raise Return(Counter(json.loads(response.body)))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def memory(pid):
+    """
+    Get the resident memory of the resolution processes
+
+    :param pid: the process started to run the resolution service
+    :returns: dict of pid to resident memory in kB
+    """
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (IOError, IndexError, ValueError):
+                continue
+
+    # with several processes the first one only waits for the others
+    if len(pids) > 1:
+        pids.remove(pid)
+
+    rss = {}
+    for worker in pids:
+        try:
+            with open('/proc/{}/status'.format(worker)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss[worker] = int(line.split()[1])
+        except IOError:
+            continue
+
+    return rss
+
+
+def summarise(args, results, seconds, calls, rss):
+    latencies = [latency for _, _, latency in results]
+    by_kind = defaultdict(list)
+    for kind, _, latency in results:
+        by_kind[kind].append(latency)
+
+    def latency_summary(values):
+        return dict(('p{}'.format(int(p * 100)), round(percentile(values, p) * 1000, 2))
+                    for p in (0.5, 0.9, 0.99, 1.0))
+
+    return {
+        'requests': len(results),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(results) / seconds, 1),
+        'latency_ms': latency_summary(latencies),
+        'latency_ms_by_kind': dict((kind, latency_summary(values)) for kind, values in by_kind.iteritems()),
+        'status_codes': dict(Counter(code for _, code, _ in results)),
+        'upstream_calls_per_request': round(sum(calls.values()) / float(len(results)), 3),
+        'upstream_calls_per_request_by_service': dict((service, round(count / float(len(results)), 3))
+                                                      for service, count in calls.iteritems()),
+        'memory_kb_by_process': rss,
+        'options': vars(args)
+    }
+
+
+def report(summary):
+    print 'Requests:   {requests} in {seconds}s, {requests_per_second} req/s'.format(**summary)
+    print 'Latency ms: p50 {p50}, p90 {p90}, p99 {p99}, max {p100}'.format(**summary['latency_ms'])
+    for kind, latency in sorted(summary['latency_ms_by_kind'].iteritems()):
+        print '    {:<15} p50 {p50}, p90 {p90}, p99 {p99}, max {p100}'.format(kind, **latency)
+    print 'Status:     ' + ', '.join('{}: {}'.format(*item) for item in sorted(summary['status_codes'].items()))
+    print 'Upstream calls per request: {}'.format(summary['upstream_calls_per_request'])
+    for service, calls in sorted(summary['upstream_calls_per_request_by_service'].iteritems()):
+        print '    {:<15} {}'.format(service, calls)
+    print 'Memory (RSS):'
+    for pid, rss in sorted(summary['memory_kb_by_process'].iteritems()):
+        print '    pid {:<11} {:.1f} MB'.format(pid, rss / 1024.0)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    upstream_url = 'http://127.0.0.1:{}'.format(args.upstream_port)
+    base_url = 'http://127.0.0.1:{}'.format(args.port)
+    dataset = upstreams.Dataset(args.providers, args.assets, upstream_url)
+
+    upstream_process = multiprocessing.Process(target=serve_upstreams, args=(args, dataset))
+    resolution_process = multiprocessing.Process(target=serve_resolution, args=(args, upstream_url))
+    upstream_process.start()
+    resolution_process.start()
+
+    @coroutine
+    def run():
+        yield wait_until_up(upstream_url + '/_stats')
+        yield wait_until_up(base_url + '/stats')
+
+        requests = make_requests(args, dataset, base_url)
+        yield send(requests[:args.warmup], args.concurrency)
+
+        before = yield upstream_counts(upstream_url)
+        start = time.time()
+        results = yield send(requests[args.warmup:], args.concurrency)
+        seconds = time.time() - start
+        after = yield upstream_counts(upstream_url)
+
+        raise Return(summarise(args, results, seconds, after - before, memory(resolution_process.pid)))
+
+    try:
+        summary = IOLoop.current().run_sync(run)
+    finally:
+        os.killpg(resolution_process.pid, signal.SIGTERM)
+        upstream_process.terminate()
+        resolution_process.join()
+        upstream_process.join()
+
+    if args.json:
+        print json.dumps(summary, indent=2, sort_keys=True)
+    else:
+        report(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Fake accounts, index, query, auth and repository services for benchmarking.
+
+All the services are served by one application, under their usual paths, e.g.
+/v1/accounts/organisations. Every response is delayed by about the configured
+latency, and a configurable fraction of requests fail with a 503. The number
+of requests made to each service is available from /_stats.
+"""
+import json
+import random
+from collections import Counter
+
+from tornado import gen
+from tornado.gen import coroutine
+from tornado.web import Application, HTTPError, RequestHandler
+
+ID_TYPE = 'isbn'
+
+
+class Dataset(object):
+    """
+    Providers, repositories and assets served by the fake services
+
+    Every provider has one repository. Every 10th asset is held by two
+    providers, and every other provider has reference links (the others have
+    payment links), so that all the resolution paths are exercised.
+
+    :param num_providers: number of providers
+    :param num_assets: number of assets
+    :param upstream_url: the fake services' URL, used as the repositories' location
+    """
+    def __init__(self, num_providers, num_assets, upstream_url):
+        self.providers = [self._provider(i) for i in xrange(num_providers)]
+        self.repositories = [self._repository(provider, upstream_url) for provider in self.providers]
+        self.assets = [self._asset(i, num_providers) for i in xrange(num_assets)]
+
+        self.providers_by_id = dict((p['id'], p) for p in self.providers)
+        self.providers_by_name = dict((p['name'], p) for p in self.providers)
+        self.repositories_by_id = dict((r['id'], r) for r in self.repositories)
+        self.assets_by_source_id = dict((a['source_id'], a) for a in self.assets)
+        self.assets_by_entity_id = dict((a['entity_id'], a) for a in self.assets)
+
+    @staticmethod
+    def _provider(i):
+        provider = {
+            'id': 'org{}'.format(i),
+            'name': 'provider{}'.format(i),
+            'website': 'provider{}.example.com'.format(i),
+            'description': 'Provider {}'.format(i),
+            'email': 'licensing@provider{}.example.com'.format(i),
+            'primary_color': '#336699',
+            'star_rating': i % 5
+        }
+
+        if i % 2 == 0:
+            provider['reference_links'] = {
+                'redirect_id_type': ID_TYPE,
+                'links': {ID_TYPE: 'https://provider{}.example.com/books/{{source_id}}'.format(i)}
+            }
+        else:
+            provider['payment'] = {
+                'source_id_type': ID_TYPE,
+                'url': 'https://pay.example.com/{source_id}/{offer_id}'
+            }
+
+        return provider
+
+    @staticmethod
+    def _repository(provider, upstream_url):
+        return {
+            'id': '{:032x}'.format(0xa0000 + int(provider['id'][3:])),
+            'name': provider['name'] + ' repository',
+            'organisation': {'id': provider['id'], 'name': provider['name']},
+            'service': {'location': upstream_url}
+        }
+
+    def _asset(self, i, num_providers):
+        holders = [self.repositories[i % num_providers]]
+        if i % 10 == 0 and num_providers > 1:
+            holders.append(self.repositories[(i + 1) % num_providers])
+
+        return {
+            'source_id': '978{:010d}'.format(i),
+            'entity_id': '{:032x}'.format(0xe0000 + i),
+            'repositories': holders,
+            'description': 'Asset {}'.format(i)
+        }
+
+    def providers_for(self, asset):
+        """The providers holding an asset"""
+        return [self.providers_by_id[r['organisation']['id']] for r in asset['repositories']]
+
+
+class FakeHandler(RequestHandler):
+    def initialize(self, dataset, latency, error_rate, counts):
+        self.dataset = dataset
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts = counts
+
+    @coroutine
+    def prepare(self):
+        # /v1/<service>/...
+        self.counts[self.request.path.split('/')[2]] += 1
+
+        if self.latency:
+            yield gen.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if self.error_rate and random.random() < self.error_rate:
+            raise HTTPError(503)
+
+    def respond(self, data):
+        self.finish({'status': 200, 'data': data})
+
+    def asset(self, source_id):
+        try:
+            return self.dataset.assets_by_source_id[source_id]
+        except KeyError:
+            raise HTTPError(404)
+
+
+class OrganisationsHandler(FakeHandler):
+    def get(self, organisation_id=None):
+        if organisation_id:
+            provider = self.dataset.providers_by_id.get(organisation_id)
+            if not provider:
+                raise HTTPError(404)
+            self.respond(provider)
+        elif self.get_query_argument('name', None):
+            provider = self.dataset.providers_by_name.get(self.get_query_argument('name'))
+            if not provider:
+                raise HTTPError(404)
+            self.respond([provider])
+        else:
+            self.respond(self.dataset.providers)
+
+
+class RepositoriesHandler(FakeHandler):
+    def get(self, repository_id=None):
+        if repository_id:
+            repository = self.dataset.repositories_by_id.get(repository_id)
+            if not repository:
+                raise HTTPError(404)
+            self.respond(repository)
+        else:
+            self.respond(self.dataset.repositories)
+
+
+class IndexRepositoriesHandler(FakeHandler):
+    def get(self, id_type, source_id):
+        asset = self.asset(source_id)
+        self.respond({'repositories': [{'repository_id': r['id'], 'entity_id': asset['entity_id']}
+                                       for r in asset['repositories']]})
+
+
+class EntitiesHandler(FakeHandler):
+    def get(self):
+        entity_id = self.get_query_argument('hub_key').rstrip('/').split('/')[-1]
+        asset = self.dataset.assets_by_entity_id.get(entity_id)
+        if not asset:
+            raise HTTPError(404)
+
+        self.respond({'@graph': [
+            {'@id': 'id:' + asset['entity_id'], '@type': 'op:Id',
+             'op:value': {'@value': asset['source_id']}, 'op:id_type': {'@id': 'hub:' + ID_TYPE}},
+            {'@id': 'id:asset', '@type': 'op:Asset', 'dcterm:description': {'@value': asset['description']}}
+        ]})
+
+
+class LicensorsHandler(FakeHandler):
+    def get(self):
+        asset = self.asset(self.get_query_argument('source_id'))
+        self.respond(self.dataset.providers_for(asset))
+
+
+class OffersHandler(FakeHandler):
+    def post(self):
+        results = []
+        for item in json.loads(self.request.body):
+            asset = self.dataset.assets_by_source_id.get(item['source_id'])
+            if asset:
+                results.append(dict(item, offers=[{'@graph': [
+                    {'@id': 'id:offer' + asset['entity_id'][-6:], 'type': 'offer',
+                     'dcterm:title': {'@value': 'Standard licence'},
+                     'op:policyDescription': {'@value': 'Use in print and online'}}
+                ]}]))
+
+        self.respond(results)
+
+
+class TokenHandler(FakeHandler):
+    def post(self):
+        self.finish({'status': 200, 'access_token': 'benchmark', 'expires_in': 3600})
+
+
+class IdsHandler(FakeHandler):
+    def get(self, repository_id, entity_id):
+        asset = self.dataset.assets_by_entity_id.get(entity_id)
+        if not asset:
+            raise HTTPError(404)
+        self.respond([{'source_id_type': ID_TYPE, 'source_id': asset['source_id']}])
+
+
+class StatsHandler(RequestHandler):
+    def initialize(self, counts):
+        self.counts = counts
+
+    def get(self):
+        self.finish(dict(self.counts))
+
+
+def make_application(dataset, latency=0, error_rate=0):
+    """
+    Make the application serving the fake services
+
+    :param dataset: a Dataset
+    :param latency: (optional) average number of seconds to delay each response
+    :param error_rate: (optional) fraction of requests that fail
+    :returns: tornado.web.Application
+    """
+    counts = Counter()
+    kwargs = {'dataset': dataset, 'latency': latency, 'error_rate': error_rate, 'counts': counts}
+
+    return Application([
+        (r'/v1/accounts/organisations', OrganisationsHandler, kwargs),
+        (r'/v1/accounts/organisations/([^/]+)', OrganisationsHandler, kwargs),
+        (r'/v1/accounts/repositories', RepositoriesHandler, kwargs),
+        (r'/v1/accounts/repositories/([^/]+)', RepositoriesHandler, kwargs),
+        (r'/v1/index/entity-types/asset/id-types/([^/]+)/ids/([^/]+)/repositories', IndexRepositoriesHandler, kwargs),
+        (r'/v1/query/entities', EntitiesHandler, kwargs),
+        (r'/v1/query/licensors', LicensorsHandler, kwargs),
+        (r'/v1/query/search/offers', OffersHandler, kwargs),
+        (r'/v1/auth/token', TokenHandler, kwargs),
+        (r'/v1/repository/repositories/([^/]+)/assets/([^/]+)/ids', IdsHandler, kwargs),
+        (r'/_stats', StatsHandler, {'counts': counts}),
+    ])
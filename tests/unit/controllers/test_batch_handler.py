@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+
+from mock import Mock, patch
+
+from koi.exceptions import HTTPError
+from tornado import httpclient
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import batch_handler
+
+PROVIDER = {'id': 'org1', 'reference_links': {'redirect_id_type': 'isbn',
+                                              'links': {'isbn': 'http://example.com/{source_id}'}}}
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._parse_hub_key')
+@gen_test
+def test_resolve_hub_key(_parse_hub_key, resolved):
+    hub_key = 'https://openpermissions.org/s0/hub1/asset/exampleco/isbn/1234'
+    resolved.lookup.return_value = None
+    _parse_hub_key.return_value = make_future({'id_type': 'isbn', 'entity_id': '1234', 'provider': PROVIDER})
+
+    result = yield batch_handler.resolve_key(hub_key)
+
+    assert result == {'key': hub_key, 'status': 200, 'provider_id': 'org1', 'redirect': 'http://example.com/1234'}
+    resolved.add.assert_called_once_with(('hub_key', hub_key), 'http://example.com/1234')
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._get_provider_by_name')
+@gen_test
+def test_resolve_already_resolved_key(_get_provider_by_name, resolved):
+    resolved.lookup.return_value = 'http://example.com/1234'
+    key = {'hubpid': 'exampleco', 'hubidt': 'isbn', 'hubaid': '1234'}
+
+    result = yield batch_handler.resolve_key(key)
+
+    assert result == {'key': key, 'status': 200, 'redirect': 'http://example.com/1234'}
+    assert not _get_provider_by_name.called
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._get_provider_by_name')
+@gen_test
+def test_resolve_unknown_provider(_get_provider_by_name, resolved):
+    resolved.lookup.return_value = None
+    _get_provider_by_name.side_effect = HTTPError(404, 'Unknown provider')
+    key = {'hubpid': 'unknown', 'hubidt': 'isbn', 'hubaid': '1234'}
+
+    result = yield batch_handler.resolve_key(key)
+
+    assert result == {'key': key, 'status': 404, 'errors': 'Unknown provider'}
+
+
+@gen_test
+def test_resolve_invalid_key():
+    result = yield batch_handler.resolve_key({'hubidt': 'isbn'})
+
+    assert result['status'] == 400
+
+
+def test_unique_keys():
+    keys = ['a', {'hubidt': 'isbn', 'hubaid': '1'}, 'a', {'hubaid': '1', 'hubidt': 'isbn'}, 'b']
+
+    assert batch_handler._unique(keys) == ['a', {'hubidt': 'isbn', 'hubaid': '1'}, 'b']
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._parse_hub_key')
+@gen_test
+def test_resolve_key_upstream_error(_parse_hub_key, resolved):
+    hub_key = 'https://openpermissions.org/s0/hub1/asset/exampleco/doi/1234'
+    resolved.lookup.return_value = None
+    _parse_hub_key.side_effect = httpclient.HTTPError(404)
+
+    result = yield batch_handler.resolve_key(hub_key)
+
+    assert result['key'] == hub_key
+    assert result['status'] == 404
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._asset_hub_key')
+@patch('resolution.controllers.batch_handler._get_provider_by_name')
+@gen_test
+def test_resolve_key_unexpected_error(_get_provider_by_name, _asset_hub_key, resolved):
+    resolved.lookup.return_value = None
+    _get_provider_by_name.return_value = make_future(PROVIDER)
+    _asset_hub_key.side_effect = IndexError('list index out of range')
+    key = {'hubpid': 'exampleco', 'hubidt': 'isbn', 'hubaid': '1234'}
+
+    result = yield batch_handler.resolve_key(key)
+
+    assert result['key'] == key
+    assert result['status'] == 500
+
+
+@patch('resolution.controllers.batch_handler.resolved')
+@patch('resolution.controllers.batch_handler._parse_hub_key')
+@gen_test
+def test_batch_with_failing_key_is_valid_json(_parse_hub_key, resolved):
+    good = 'https://openpermissions.org/s0/hub1/asset/exampleco/isbn/1234'
+    bad = 'https://openpermissions.org/s0/hub1/asset/exampleco/doi/1234'
+    resolved.lookup.return_value = None
+
+    def parse_hub_key(hub_key):
+        if hub_key == bad:
+            raise httpclient.HTTPError(404)
+        return make_future({'id_type': 'isbn', 'entity_id': '1234', 'provider': PROVIDER})
+
+    _parse_hub_key.side_effect = parse_hub_key
+    handler = Mock()
+    handler.num_results = 0
+    handler.get_json_body.return_value = {'keys': [good, bad, good]}
+    handler._write_result = lambda result: batch_handler.BatchHandler._write_result.__func__(handler, result)
+
+    yield batch_handler.BatchHandler.post.__func__(handler)
+
+    written = ''.join(call[0][0] for call in handler.write.call_args_list) + handler.finish.call_args[0][0]
+    results = {result['key']: result for result in json.loads(written)}
+    assert len(results) == 2
+    assert results[good]['status'] == 200
+    assert results[bad]['status'] == 404
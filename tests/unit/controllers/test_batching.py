@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import Mock, patch
+from tornado import gen
+from tornado.gen import coroutine, Return
+
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import batching, deadlines
+
+
+@gen_test
+def test_keys_loaded_in_one_batch():
+    batch_fn = Mock(return_value=make_future(['a', 'b', 'c']))
+    loader = batching.BatchLoader(batch_fn)
+
+    results = yield [loader.load('1'), loader.load('2'), loader.load('3')]
+
+    assert results == ['a', 'b', 'c']
+    batch_fn.assert_called_once_with([('1',), ('2',), ('3',)])
+    assert loader.num_batches == 1
+
+
+@gen_test
+def test_batch_dispatched_at_max_size():
+    batch_fn = Mock(side_effect=[make_future(['a', 'b']), make_future(['c'])])
+    loader = batching.BatchLoader(batch_fn, max_batch_size=2)
+
+    results = yield [loader.load('1'), loader.load('2'), loader.load('3')]
+
+    assert results == ['a', 'b', 'c']
+    assert batch_fn.call_count == 2
+
+
+@gen_test
+def test_errors_passed_to_each_caller():
+    error = HTTPError(404, 'Unknown provider')
+    loader = batching.BatchLoader(Mock(return_value=make_future(['a', error])))
+
+    found = loader.load('1')
+    missing = loader.load('2')
+
+    assert (yield found) == 'a'
+    with pytest.raises(HTTPError):
+        yield missing
+
+
+@gen_test
+def test_window_restarts_after_batch_dispatched_at_max_size():
+    batch_fn = Mock(side_effect=[make_future(['a', 'b']), make_future(['c'])])
+    loader = batching.BatchLoader(batch_fn, max_batch_size=2, window=0.2)
+
+    first = [loader.load('1'), loader.load('2')]
+    yield gen.sleep(0.1)
+    last = loader.load('3')
+    yield gen.sleep(0.15)
+
+    # the first batch's window has passed, but not the last one's
+    assert batch_fn.call_count == 1
+    assert (yield first + [last]) == ['a', 'b', 'c']
+    assert batch_fn.call_count == 2
+
+
+@gen_test
+def test_wrong_number_of_results_passed_to_each_caller():
+    loader = batching.BatchLoader(Mock(return_value=make_future(['a'])))
+
+    first = loader.load('1')
+    second = loader.load('2')
+
+    for future in (first, second):
+        with pytest.raises(ValueError):
+            yield future
+
+
+@patch('resolution.controllers.deadlines.options')
+@gen_test
+def test_each_caller_waits_until_its_own_deadline(options):
+    remaining = []
+
+    @coroutine
+    def batch_fn(keys):
+        remaining.append(deadlines.remaining())
+        yield gen.sleep(0.05)
+        raise Return([key[0].upper() for key in keys])
+
+    loader = batching.BatchLoader(batch_fn)
+    options.request_deadline_seconds = 0.01
+    hurried = deadlines.run(lambda: loader.load('a'))
+    options.request_deadline_seconds = 0
+    patient = loader.load('b')
+
+    with pytest.raises(HTTPError) as exc:
+        yield hurried
+    result = yield patient
+
+    assert exc.value.status_code == 504
+    assert result == 'B'
+    assert remaining == [None]
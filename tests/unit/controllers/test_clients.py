@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import ssl
+
+import pytest
+from mock import patch
+
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import clients
+
+
+@gen_test
+def test_get_client_reuses_upstream():
+    first = clients.get_client('https://localhost:8006')
+    second = clients.get_client('https://localhost:8006', token='token')
+
+    assert first.fetch == second.fetch
+    assert second.token == 'token'
+    assert 'Authorization' not in first.default_headers
+    assert first.base_url == 'https://localhost:8006/v1'
+
+
+@patch('resolution.controllers.clients.options')
+@patch('resolution.controllers.clients._HTTPClient')
+@patch('resolution.controllers.clients._curl', True)
+def test_curl_client_is_given_certificate_files(_HTTPClient, options):
+    options.upstream_timeouts = {}
+    options.upstream_connect_timeout = 5
+    options.upstream_request_timeout = 10
+    options.ssl_ca_cert = 'CA.crt'
+    options.ssl_cert = 'localhost.crt'
+    options.ssl_key = 'localhost.key'
+    options.ssl_cert_reqs = ssl.CERT_REQUIRED
+
+    clients.Upstream('https://localhost:8006')
+
+    defaults = _HTTPClient.call_args[1]['defaults']
+    assert 'ssl_options' not in defaults
+    assert defaults == {'ca_certs': 'CA.crt', 'client_cert': 'localhost.crt', 'client_key': 'localhost.key',
+                        'validate_cert': True, 'connect_timeout': 5, 'request_timeout': 10}
+
+
+@patch('resolution.controllers.clients._HTTPClient')
+@patch('resolution.controllers.clients._curl', False)
+def test_simple_client_is_given_ssl_options(_HTTPClient):
+    clients.Upstream('https://localhost:8006')
+
+    assert 'ssl_options' in _HTTPClient.call_args[1]['defaults']
+
+
+@patch('resolution.controllers.clients.async_fetch')
+@gen_test
+def test_client_counts_requests(async_fetch):
+    async_fetch.return_value = make_future({'data': {}})
+    client = clients.get_client('https://localhost:8006')
+
+    result = yield client.accounts.organisations['orgid'].get()
+
+    upstream = clients.get_upstream('https://localhost:8006')
+    assert result == {'data': {}}
+    assert upstream.num_requests == 1
+    assert upstream.active == 0
+    assert upstream.peak_active == 1
+    request = async_fetch.call_args[0][0]
+    assert request == 'https://localhost:8006/v1/accounts/organisations/orgid'
+
+
+@patch('resolution.controllers.clients.time')
+def test_circuit_breaker_opens_and_recovers(time):
+    time.time.return_value = 1000
+    breaker = clients.CircuitBreaker(4, 0.5, 10)
+
+    for failed in (False, True, False, True):
+        assert breaker.allow()
+        breaker.record(failed)
+
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+    time.time.return_value = 1010
+    trial = breaker.allow()
+    assert trial == breaker.TRIAL
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record(False, trial)
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+@patch('resolution.controllers.clients.time')
+def test_circuit_breaker_stays_open_after_failed_trial(time):
+    time.time.return_value = 1000
+    breaker = clients.CircuitBreaker(2, 0.5, 10)
+    breaker.record(True)
+    breaker.record(True)
+
+    time.time.return_value = 1010
+    trial = breaker.allow()
+    breaker.record(True, trial)
+
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+
+@patch('resolution.controllers.clients.time')
+def test_circuit_breaker_trial_decided_only_by_trial_call(time):
+    time.time.return_value = 1000
+    breaker = clients.CircuitBreaker(2, 0.5, 10)
+    breaker.record(True)
+    breaker.record(True)
+
+    time.time.return_value = 1010
+    trial = breaker.allow()
+    # a call made before the circuit opened
+    breaker.record(False)
+
+    assert breaker.state == breaker.HALF_OPEN
+
+    breaker.record(True, trial)
+
+    assert breaker.state == breaker.OPEN
+
+
+@patch('resolution.controllers.clients.async_fetch')
+@gen_test
+def test_client_fails_fast_when_circuit_open(async_fetch):
+    upstream = clients.Upstream('https://localhost:8008')
+    upstream.breaker.opened = upstream.breaker.reset_seconds + 10 ** 10
+
+    with pytest.raises(clients.UpstreamUnavailable) as exc:
+        yield upstream.fetch('https://localhost:8008/v1/query/entities', 'GET')
+
+    assert exc.value.status_code == 503
+    assert not async_fetch.called
+
+
+@patch('resolution.controllers.clients.deadlines')
+@patch('resolution.controllers.clients.async_fetch')
+@gen_test
+def test_client_limits_request_to_deadline(async_fetch, deadlines):
+    async_fetch.return_value = make_future({'data': {}})
+    deadlines.remaining.return_value = 2
+    upstream = clients.Upstream('https://localhost:8008')
+
+    yield upstream.fetch('https://localhost:8008/v1/query/entities', 'GET')
+
+    request = async_fetch.call_args[0][0]
+    assert request.url == 'https://localhost:8008/v1/query/entities'
+    assert request.request_timeout == 2
+
+
+@patch('resolution.controllers.clients.deadlines')
+@patch('resolution.controllers.clients.async_fetch')
+@gen_test
+def test_client_deadline_exceeded(async_fetch, deadlines):
+    deadlines.remaining.return_value = -1
+    upstream = clients.Upstream('https://localhost:8008')
+
+    with pytest.raises(HTTPError) as exc:
+        yield upstream.fetch('https://localhost:8008/v1/query/entities', 'GET')
+
+    assert exc.value.status_code == 504
+    assert not async_fetch.called
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+
+from koi.test_helpers import gen_test
+from resolution.controllers import deadlines
+
+
+@coroutine
+def _remaining_after_yield():
+    yield gen.moment
+    raise Return(deadlines.remaining())
+
+
+@gen_test
+def test_deadline_follows_coroutines():
+    remaining = yield deadlines.run(_remaining_after_yield)
+
+    assert 0 < remaining <= deadlines.options.request_deadline_seconds
+    assert deadlines.remaining() is None
+
+
+@gen_test
+def test_detached_callbacks_have_no_deadline():
+    results = []
+
+    @coroutine
+    def start():
+        with deadlines.detached():
+            IOLoop.current().add_callback(lambda: results.append(deadlines.remaining()))
+        yield gen.moment
+
+    yield deadlines.run(start)
+    yield gen.moment
+
+    assert results == [None]
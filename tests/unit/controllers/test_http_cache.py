@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import MagicMock, call, patch
+
+from resolution.controllers import http_cache
+
+
+@patch('resolution.controllers.http_cache.options')
+def test_set_cache_headers(options):
+    options.cache_control_redirect = 'public, max-age=300'
+    handler = MagicMock()
+
+    http_cache.set_cache_headers(handler, http_cache.REDIRECT, vary='Accept')
+
+    assert handler.set_header.call_args_list == [call('Cache-Control', 'public, max-age=300'),
+                                                 call('Vary', 'Accept')]
+
+
+@patch('resolution.controllers.http_cache.options')
+def test_set_cache_headers_disabled(options):
+    options.cache_control_error = ''
+    handler = MagicMock()
+
+    http_cache.set_cache_headers(handler, http_cache.ERROR)
+
+    assert not handler.set_header.called
+
+
+def test_etag_from_data():
+    assert http_cache.etag({'a': 1, 'b': 2}) == http_cache.etag({'b': 2, 'a': 1})
+    assert http_cache.etag({'a': 1}) != http_cache.etag({'a': 2})
+    assert http_cache.etag({'a': 1}).startswith('"')
+
+
+def test_not_modified():
+    handler = MagicMock()
+    handler.check_etag_header.return_value = True
+
+    assert http_cache.not_modified(handler, '"abc"')
+    handler.set_header.assert_called_once_with('ETag', '"abc"')
+    handler.set_status.assert_called_once_with(304)
+    handler.finish.assert_called_once_with()
+
+
+def test_modified():
+    handler = MagicMock()
+    handler.check_etag_header.return_value = False
+
+    assert not http_cache.not_modified(handler, '"abc"')
+    assert not handler.finish.called
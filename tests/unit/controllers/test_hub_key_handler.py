@@ -7,26 +7,25 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import json
 import pytest
 from functools import partial
-from mock import patch
+from mock import Mock, patch
 
+from tornado import httpclient
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
+from koi.exceptions import HTTPError
 from koi.test_helpers import make_future, gen_test
 from resolution.controllers import hub_key_handler
+from resolution.controllers.records import AssetDetails, Provider, Repository
 
 
 @patch('resolution.controllers.hub_key_handler._get_provider')
 def test_parse_hub_key_s0(_get_provider):
     hub_key = 'https://openpermissions.org/s0/hub1/asset/maryevans/maryevanspictureid/10413373'
-    _get_provider.return_value = make_future(
-        {
-            'data': {
-                'website': 'www.something.org'
-            }
-        }
-    )
+    _get_provider.return_value = make_future(Provider(website='www.something.org'))
     expected = {
         'resolver_id': 'https://openpermissions.org',
         'schema_version': 's0',
@@ -36,9 +35,7 @@ def test_parse_hub_key_s0(_get_provider):
         'id_type': 'maryevanspictureid',
         'entity_id': '10413373',
         'hub_key': hub_key,
-        'provider': {
-            'website': 'http://www.something.org'
-        }
+        'provider': Provider(website='http://www.something.org')
     }
 
     result = IOLoop.current().run_sync(
@@ -52,17 +49,8 @@ def test_parse_hub_key_s0(_get_provider):
 @patch('resolution.controllers.hub_key_handler._get_provider')
 def test_parse_hub_key_s1(_get_provider, _get_repository):
     hub_key = 'https://openpermissions.org/s1/hub1/0123456789abcdef0123456789abcdef/asset/abcdef0123456789abcdef0123456789'
-    _get_repository.return_value = make_future({
-        'data': {
-            'organisation': {'id': 'orguid'}
-        }
-    })
-    _get_provider.return_value = make_future({
-        'data': {
-            'organisation_id': 'orguid',
-            'website': 'www.something.org'
-        }
-    })
+    _get_repository.return_value = make_future(Repository(organisation_id='orguid'))
+    _get_provider.return_value = make_future(Provider(id='orguid', website='www.something.org'))
     expected = {
         'entity_id': 'abcdef0123456789abcdef0123456789',
         'entity_type': 'asset',
@@ -71,10 +59,7 @@ def test_parse_hub_key_s1(_get_provider, _get_repository):
         'resolver_id': 'https://openpermissions.org',
         'schema_version': 's1',
         'hub_key': hub_key,
-        'provider': {
-            'organisation_id': 'orguid',
-            'website': 'http://www.something.org'
-        }
+        'provider': Provider(id='orguid', website='http://www.something.org')
     }
 
     result = IOLoop.current().run_sync(
@@ -168,4 +153,283 @@ def test_resolve_link_s1_hk(_get_ids):
                                                             'entity_id': '321a23'
                                                        })
     assert res is not None
-    assert res == 'http://test/this+id+has+spaces+and+%3F'
\ No newline at end of file
+    assert res == 'http://test/this+id+has+spaces+and+%3F'
+
+@patch('resolution.controllers.hub_key_handler._get_offers_by_type_and_id')
+@patch('resolution.controllers.hub_key_handler._get_asset_document')
+@patch('resolution.controllers.hub_key_handler._parse_hub_key')
+@patch('resolution.controllers.hub_key_handler._get_repos_for_source_id')
+@gen_test
+def test_redirect_to_asset_fetches_offers_while_looking_up_asset(_get_repos_for_source_id, _parse_hub_key,
+                                                                 _get_asset_document, _get_offers_by_type_and_id):
+    repos = Future()
+    _get_repos_for_source_id.return_value = repos
+    _parse_hub_key.return_value = make_future({'repository_id': 'repo1', 'entity_id': 'asset1'})
+    _get_asset_document.return_value = make_future({'@graph': []})
+    _get_offers_by_type_and_id.return_value = make_future([])
+    handler = Mock()
+    handler.check_etag_header.return_value = False
+
+    result = hub_key_handler.redirectToAsset(handler, hub_key_handler.RequestContext('', show_json=True),
+                                             {}, 'testidtype', '1234')
+    assert _get_offers_by_type_and_id.call_count == 1
+    repos.set_result([{'repository_id': 'repo1', 'entity_id': 'asset1'}])
+    yield result
+
+    _get_offers_by_type_and_id.assert_called_once_with('testidtype', '1234')
+    handler.write.assert_called_once_with({'asset': {'@graph': []}, 'provider': {}, 'offers': []})
+
+
+@patch('resolution.controllers.hub_key_handler._get_offers_by_type_and_id')
+@patch('resolution.controllers.hub_key_handler._get_asset_details')
+@patch('resolution.controllers.hub_key_handler._parse_hub_key')
+@gen_test
+def test_redirect_to_asset_skips_details_for_reference_link(_parse_hub_key, _get_asset_details,
+                                                            _get_offers_by_type_and_id):
+    hub_key = 'https://openpermissions.org/s0/hub1/asset/exampleco/testidtype/1234'
+    _parse_hub_key.return_value = make_future({'id_type': 'testidtype', 'entity_id': '1234'})
+    provider = {'reference_links': {'redirect_id_type': 'testidtype',
+                                    'links': {'testidtype': 'http://example.com/{source_id}'}}}
+    handler = Mock()
+    context = hub_key_handler.RequestContext('utm_source=test')
+
+    yield hub_key_handler.redirectToAsset(handler, context, provider, None, None, hub_key=hub_key)
+
+    handler.redirect.assert_called_once_with('http://example.com/1234?utm_source=test')
+    assert not _get_asset_details.called
+    assert not _get_offers_by_type_and_id.called
+
+
+def test_request_context_strips_internal_query_parameters():
+    context = hub_key_handler.RequestContext('hubpid=exampleco&hubidt=isbn&hubaid=1234&utm_source=test&a=2&a=1')
+
+    assert not context.show_json
+    assert context.clean_params == {'utm_source': ['test'], 'a': ['2', '1']}
+    assert context.clean_query == 'a=2&a=1&utm_source=test'
+
+
+def test_merge_querystrings_adds_request_parameters():
+    context = hub_key_handler.RequestContext('hubpid=exampleco&utm_source=test')
+
+    assert hub_key_handler._mergeQuerystrings(context, 'http://example.com/1234?x=1') == \
+        'http://example.com/1234?x=1&utm_source=test'
+    assert hub_key_handler._mergeQuerystrings(context, None) == ''
+
+
+@pytest.mark.parametrize("url", [
+    'https://openpermissions.org/s0/hub1/asset/exampleco/isbn/978-1%2f2',
+    'http://OpenPermissions.org:80/s0/hub1/asset/exampleco/isbn/978-1%2F2',
+    'https://openpermissions.org:443/s0/hub1/asset/exampleco/isbn/978%2d1%2f2?utm_source=test',
+    'https://openpermissions.org/s0/hub1/asset/exampleco/isbn/978-1%2f2#top',
+])
+def test_canonical_hub_key(url):
+    assert hub_key_handler.canonical_hub_key(url) == \
+        'https://openpermissions.org/s0/hub1/asset/exampleco/isbn/978-1%2F2'
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+def test_canonical_hub_key_uses_configured_host(options):
+    options.hub_key_host = 'openpermissions.org'
+
+    assert hub_key_handler.canonical_hub_key('http://localhost:8000/s1/hub1/repo/asset/1234') == \
+        'https://openpermissions.org/s1/hub1/repo/asset/1234'
+
+
+def test_requested_hub_key_keeps_scheme_and_host():
+    url = 'http://Localhost:8000/s0/hub1/asset/exampleco/isbn/978%2d1?utm_source=test'
+
+    assert hub_key_handler.requested_hub_key(url) == 'http://Localhost:8000/s0/hub1/asset/exampleco/isbn/978%2d1'
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_asset_details_cached_by_canonical_key_and_fetched_as_requested(get_client, options):
+    options.hub_key_host = ''
+    get_entity = get_client.return_value.query.entities.get
+    get_entity.return_value = make_future({'data': {'@graph': []}})
+    requested = 'http://openpermissions.org/s0/hub1/asset/exampleco/isbn/canonical%2d1'
+
+    yield hub_key_handler._get_asset_details(requested)
+    yield hub_key_handler._get_asset_details('https://openpermissions.org/s0/hub1/asset/exampleco/isbn/canonical-1')
+
+    get_entity.assert_called_once_with(hub_key=requested)
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_fetch_offers_for_several_assets_in_one_request(get_client, options):
+    offers = get_client.return_value.query.search.offers
+    offers.post.return_value = make_future({'data': [
+        {'source_id_type': 'isbn', 'source_id': '2', 'offers': ['offer2']},
+        {'source_id_type': 'isbn', 'source_id': '1', 'offers': ['offer1']}
+    ]})
+
+    results = yield hub_key_handler._fetch_offers([('ISBN', '1'), ('isbn', '2'), ('isbn', '3')])
+
+    assert results == [[{'source_id_type': 'isbn', 'source_id': '1', 'offers': ['offer1']}],
+                       [{'source_id_type': 'isbn', 'source_id': '2', 'offers': ['offer2']}],
+                       []]
+    assert offers.post.call_count == 1
+    body = offers.prepare_request.call_args[1]['body']
+    assert json.loads(body) == [{'source_id_type': 'ISBN', 'source_id': '1'},
+                                {'source_id_type': 'isbn', 'source_id': '2'},
+                                {'source_id_type': 'isbn', 'source_id': '3'}]
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_fetch_offers_encodes_ids(get_client, options):
+    offers = get_client.return_value.query.search.offers
+    offers.post.return_value = make_future({'data': []})
+
+    results = yield hub_key_handler._fetch_offers([('isbn', 'a"b')])
+
+    assert results == [[]]
+    assert json.loads(offers.prepare_request.call_args[1]['body']) == [{'source_id_type': 'isbn',
+                                                                        'source_id': 'a"b'}]
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_fetch_offers_matches_normalised_ids(get_client, options):
+    offers = get_client.return_value.query.search.offers
+    offers.post.return_value = make_future({'data': [
+        {'source_id_type': 'ISBN', 'source_id': 'a b', 'offers': ['offer1']}
+    ]})
+
+    results = yield hub_key_handler._fetch_offers([('isbn', 'a%20b'), ('isbn', '2')])
+
+    assert results == [[{'source_id_type': 'ISBN', 'source_id': 'a b', 'offers': ['offer1']}], []]
+
+
+@patch('resolution.controllers.hub_key_handler._offers_batching', True)
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_fetch_offers_queries_each_asset_without_ids_in_results(get_client, options):
+    offers = get_client.return_value.query.search.offers
+    offers.post.side_effect = [make_future({'data': [{'offers': ['offer1']}, {'offers': ['offer2']}]}),
+                               make_future({'data': [{'offers': ['offer1']}]}),
+                               make_future({'data': [{'offers': ['offer2']}]})]
+
+    results = yield hub_key_handler._fetch_offers([('isbn', '1'), ('isbn', '2')])
+
+    assert results == [[{'offers': ['offer1']}], [{'offers': ['offer2']}]]
+    assert offers.post.call_count == 3
+    bodies = [json.loads(call[1]['body']) for call in offers.prepare_request.call_args_list[1:]]
+    assert bodies == [[{'source_id_type': 'isbn', 'source_id': '1'}],
+                      [{'source_id_type': 'isbn', 'source_id': '2'}]]
+    assert hub_key_handler._offers_batching is False
+
+
+@patch('resolution.controllers.hub_key_handler.options')
+@patch('resolution.controllers.hub_key_handler.get_client')
+@gen_test
+def test_fetch_offers_queries_each_asset_after_batch_error(get_client, options):
+    offers = get_client.return_value.query.search.offers
+    offers.post.side_effect = [httpclient.HTTPError(502),
+                               make_future({'data': [{'offers': ['offer1']}]}),
+                               httpclient.HTTPError(500)]
+
+    results = yield hub_key_handler._fetch_offers([('isbn', '1'), ('isbn', '2')])
+
+    assert results[0] == [{'offers': ['offer1']}]
+    assert isinstance(results[1], HTTPError)
+    assert results[1].status_code == 500
+
+
+@patch('resolution.controllers.hub_key_handler._offers_loader')
+@patch('resolution.controllers.hub_key_handler._query_offers')
+@patch('resolution.controllers.hub_key_handler.options')
+@gen_test
+def test_get_offers_without_batching(options, _query_offers, _offers_loader):
+    options.offers_batch_ids = False
+    _query_offers.return_value = make_future([{'offers': ['offer1']}])
+
+    result = yield hub_key_handler._get_offers_by_type_and_id('isbn', 'unbatched')
+
+    assert result == [{'offers': ['offer1']}]
+    _query_offers.assert_called_once_with([('isbn', 'unbatched')])
+    assert not _offers_loader.load.called
+
+
+@patch('resolution.controllers.hub_key_handler._get_source_ids_by_type')
+@gen_test
+def test_resolve_payment_link(_get_source_ids_by_type):
+    _get_source_ids_by_type.return_value = make_future({'isbn': '1234'})
+    res = yield hub_key_handler.resolve_payment_link_id_type({'source_id_type': 'ISBN',
+                                                              'url': 'http://pay/{source_id}/{offer_id}'},
+                                                             {'repository_id': 'repo1', 'entity_id': 'asset1'}, 'o1')
+    assert res == 'http://pay/1234/o1'
+
+
+@patch('resolution.controllers.hub_key_handler._get_source_ids_by_type')
+@gen_test
+def test_resolve_payment_link_with_invalid_template(_get_source_ids_by_type):
+    _get_source_ids_by_type.return_value = make_future({'isbn': '1234'})
+
+    with pytest.raises(HTTPError) as exc:
+        yield hub_key_handler.resolve_payment_link_id_type({'source_id_type': 'isbn',
+                                                            'url': 'http://pay/{source_id}/{price}'},
+                                                           {'repository_id': 'repo1', 'entity_id': 'asset1'}, 'o1')
+
+    assert exc.value.status_code == 500
+
+
+@patch('resolution.controllers.hub_key_handler._get_offers_by_type_and_id')
+@patch('resolution.controllers.hub_key_handler._get_provider_document')
+@patch('resolution.controllers.hub_key_handler._get_asset_document')
+@patch('resolution.controllers.hub_key_handler._parse_hub_key')
+@gen_test
+def test_redirect_to_asset_json_includes_full_documents(_parse_hub_key, _get_asset_document, _get_provider_document,
+                                                        _get_offers_by_type_and_id):
+    hub_key = 'https://openpermissions.org/s1/hub1/repo1/asset/asset1'
+    asset = {'@graph': [
+        {'@id': 'id:1', '@type': 'op:Id', 'op:value': {'@value': '1234'}, 'op:id_type': {'@id': 'hub:isbn'}},
+        {'@id': 'id:asset', '@type': 'op:Asset', 'dcterm:title': {'@value': 'A book'}},
+        {'@id': 'id:creator', '@type': 'op:Party', 'op:name': {'@value': 'An author'}}
+    ]}
+    organisation = {'id': 'org1', 'name': 'exampleco', 'website': 'example.com', 'twitter': '@exampleco'}
+    _parse_hub_key.return_value = make_future({'repository_id': 'repo1', 'entity_id': 'asset1'})
+    _get_asset_document.return_value = make_future(asset)
+    _get_provider_document.return_value = make_future(organisation)
+    _get_offers_by_type_and_id.return_value = make_future([])
+    handler = Mock()
+    handler.check_etag_header.return_value = False
+    provider = Provider(id='org1', name='exampleco', website='http://example.com')
+
+    yield hub_key_handler.redirectToAsset(handler, hub_key_handler.RequestContext('', show_json=True),
+                                          provider, None, None, hub_key=hub_key)
+
+    _get_offers_by_type_and_id.assert_called_once_with('isbn', '1234')
+    handler.write.assert_called_once_with({'asset': asset,
+                                           'provider': dict(organisation, website='http://example.com'),
+                                           'offers': []})
+
+
+@patch('resolution.controllers.hub_key_handler._get_offers_by_type_and_id')
+@patch('resolution.controllers.hub_key_handler._get_provider_document')
+@patch('resolution.controllers.hub_key_handler._get_asset_document')
+@patch('resolution.controllers.hub_key_handler._parse_hub_key')
+@patch('resolution.controllers.hub_key_handler._asset_hub_key')
+@gen_test
+def test_redirect_to_asset_json_includes_given_provider_document(_asset_hub_key, _parse_hub_key, _get_asset_document,
+                                                                 _get_provider_document, _get_offers_by_type_and_id):
+    licensor = {'id': 'org1', 'name': 'exampleco', 'website': 'example.com', 'licensor_type': 'query'}
+    _asset_hub_key.return_value = make_future('https://openpermissions.org/s1/hub1/repo1/asset/asset1')
+    _parse_hub_key.return_value = make_future({'repository_id': 'repo1', 'entity_id': 'asset1'})
+    _get_asset_document.return_value = make_future({'@graph': []})
+    _get_offers_by_type_and_id.return_value = make_future([])
+    handler = Mock()
+    handler.check_etag_header.return_value = False
+
+    yield hub_key_handler.redirectToAsset(handler, hub_key_handler.RequestContext('', show_json=True),
+                                          Provider.from_resource(licensor), 'isbn', '1234',
+                                          provider_document=licensor)
+
+    handler.write.assert_called_once_with({'asset': {'@graph': []}, 'provider': licensor, 'offers': []})
+    assert not _get_provider_document.called
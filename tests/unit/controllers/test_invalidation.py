@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+from mock import Mock, patch
+
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from resolution.controllers import invalidation
+from resolution.controllers.hub_key_handler import _get_asset_details, _get_provider, _get_repository
+from resolution.controllers.page_cache import pages
+from resolution.controllers.records import AssetDetails, Provider, Repository
+from resolution.controllers.resolution_index import asset_entry, hub_key_entry, resolved
+
+S0_KEY = 'https://openpermissions.org/s0/hub1/asset/org1/isbn/1234'
+S1_KEY = 'https://openpermissions.org/s1/hub1/repo1/asset/5678'
+
+
+@pytest.fixture
+def caches(request):
+    _get_provider.prime(('org1',), Provider(id='org1'))
+    _get_provider.prime(('org2',), Provider(id='org2'))
+    _get_repository.prime(('repo1',), Repository(id='repo1', organisation_id='org2'))
+    _get_asset_details.prime((S0_KEY,), AssetDetails(ids=()))
+    _get_asset_details.prime((S1_KEY,), AssetDetails(ids=()))
+    resolved.add(hub_key_entry(S1_KEY), 'http://example.com/5678')
+    resolved.add(asset_entry('isbn', '1234'), 'http://example.com/1234')
+    pages.cache.set(('provider', 'org1'), 'page', 60)
+
+    def clear():
+        for cache in (_get_provider.cache, _get_repository.cache, _get_asset_details.cache, resolved.cache,
+                      pages.cache):
+            cache.clear()
+
+    request.addfinalizer(clear)
+
+
+@pytest.fixture
+def directory(request):
+    path = tempfile.mkdtemp()
+    invalidation.create_directory(path)
+
+    def remove():
+        invalidation._directory = None
+        invalidation._offset = 0
+        invalidation._generation = 0
+        invalidation._recorded = None
+        shutil.rmtree(path)
+
+    request.addfinalizer(remove)
+    return path
+
+
+def test_purge_provider(caches):
+    num_purged = invalidation.purge({'provider_id': 'ORG1'})
+
+    assert ('org1',) not in _get_provider.cache
+    assert (S0_KEY,) not in _get_asset_details.cache
+    assert ('provider', 'org1') not in pages.cache
+    assert len(resolved.cache) == 0
+    assert ('org2',) in _get_provider.cache
+    assert (S1_KEY,) in _get_asset_details.cache
+    assert num_purged == 5
+
+
+def test_purge_repository_by_value_and_hub_key(caches):
+    invalidation.purge({'repository_id': 'repo1'})
+
+    assert ('repo1',) not in _get_repository.cache
+    assert (S1_KEY,) not in _get_asset_details.cache
+    assert (S0_KEY,) in _get_asset_details.cache
+
+
+def test_purge_source_id_keeps_other_redirects(caches):
+    invalidation.purge({'source_id': '1234'})
+
+    assert asset_entry('isbn', '1234') not in resolved.cache
+    assert (S0_KEY,) not in _get_asset_details.cache
+    assert hub_key_entry(S1_KEY) in resolved.cache
+
+
+def test_purge_canonical_hub_key(caches):
+    invalidation.purge({'hub_key': S1_KEY.replace('https', 'http') + '?utm_source=test'})
+
+    assert hub_key_entry(S1_KEY) not in resolved.cache
+    assert (S1_KEY,) not in _get_asset_details.cache
+
+
+def test_other_processes_invalidations_are_applied(caches, directory):
+    invalidation.publish({'provider_id': 'org2'})
+
+    with open(os.path.join(directory, invalidation.LOG_NAME), 'a') as f:
+        f.write(json.dumps({'pid': os.getpid() + 1, 'invalidation': {'provider_id': 'org1'}}) + '\n')
+        f.write('{"pid": 1, "invalid')
+
+    invalidation.poll()
+
+    assert ('org1',) not in _get_provider.cache
+    assert ('org2',) not in _get_provider.cache
+    assert invalidation._offset == os.path.getsize(os.path.join(directory, invalidation.LOG_NAME)) - \
+        len('{"pid": 1, "invalid')
+
+
+def _write_offset(directory, pid, generation, offset):
+    with open(os.path.join(directory, invalidation.OFFSET_PREFIX + str(pid)), 'w') as f:
+        f.write('{} {}'.format(generation, offset))
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_log_max_bytes=1)
+def test_log_kept_until_read_by_every_process(options, caches, directory):
+    invalidation.publish({'provider_id': 'org2'})
+    _write_offset(directory, os.getppid(), 0, 0)
+
+    invalidation.poll()
+
+    log = os.path.join(directory, invalidation.LOG_NAME)
+    assert os.path.getsize(log) > 0
+    assert invalidation._generation == 0
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_log_max_bytes=1)
+def test_log_emptied_once_read_by_every_living_process(options, caches, directory):
+    log = os.path.join(directory, invalidation.LOG_NAME)
+    dead = subprocess.Popen([sys.executable, '-c', '']).pid
+    os.waitpid(dead, 0)
+    invalidation.publish({'provider_id': 'org2'})
+    _write_offset(directory, os.getppid(), 0, os.path.getsize(log))
+    _write_offset(directory, dead, 0, 0)
+
+    invalidation.poll()
+
+    assert os.path.getsize(log) == 0
+    assert not os.path.exists(os.path.join(directory, invalidation.OFFSET_PREFIX + str(dead)))
+
+    with open(log, 'a') as f:
+        f.write(json.dumps({'pid': os.getpid() + 1, 'invalidation': {'provider_id': 'org1'}}) + '\n')
+
+    invalidation.poll()
+
+    assert invalidation._generation == 1
+    assert ('org1',) not in _get_provider.cache
+
+
+def _handler(method='POST', authorization=None):
+    handler = Mock()
+    handler.UNAUTHENTICATED_ACCESS = invalidation.InvalidationHandler.UNAUTHENTICATED_ACCESS
+    handler.request.method = method
+    handler.request.headers = {'Authorization': authorization} if authorization else {}
+    handler.endpoint_access = lambda method: invalidation.InvalidationHandler.endpoint_access.__func__(
+        handler, method)
+    handler.METHOD_ACCESS = invalidation.InvalidationHandler.METHOD_ACCESS
+    return handler
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_secret='')
+@gen_test
+def test_invalidate_requires_token_without_oauth(options):
+    handler = _handler()
+
+    with pytest.raises(HTTPError) as exc:
+        yield invalidation.InvalidationHandler.prepare.__func__(handler)
+
+    assert exc.value.status_code == 401
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_secret='secret')
+@gen_test
+def test_invalidate_with_secret(options):
+    handler = _handler(authorization='Bearer secret')
+
+    yield invalidation.InvalidationHandler.prepare.__func__(handler)
+
+    assert not handler.verify_token.called
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_secret='secret')
+@gen_test
+def test_invalidate_token_without_access(options):
+    handler = _handler(authorization='Bearer token')
+    handler.verify_token.return_value = make_future(False)
+
+    with pytest.raises(HTTPError) as exc:
+        yield invalidation.InvalidationHandler.prepare.__func__(handler)
+
+    assert exc.value.status_code == 403
+    handler.verify_token.assert_called_once_with('token', 'w')
+
+
+@patch('resolution.controllers.invalidation.options', invalidation_secret='secret')
+@gen_test
+def test_invalidate_non_ascii_token(options):
+    handler = _handler(authorization=u'Bearer s\xe9cret')
+    handler.verify_token.return_value = make_future(False)
+
+    with pytest.raises(HTTPError) as exc:
+        yield invalidation.InvalidationHandler.prepare.__func__(handler)
+
+    assert exc.value.status_code == 403
+
+
+class TestInvalidationRequests(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r'/invalidate', invalidation.InvalidationHandler, {'version': '0.0.1'})])
+
+    @patch('resolution.controllers.invalidation.options', invalidation_secret='secret')
+    def test_get_is_not_allowed(self, options):
+        response = self.fetch('/invalidate', headers={'Authorization': 'Bearer secret'})
+
+        assert response.code == 405
+
+    @patch('resolution.controllers.invalidation.options', invalidation_secret='secret')
+    def test_post_without_token(self, options):
+        response = self.fetch('/invalidate', method='POST', body=json.dumps({'provider_id': 'org1'}))
+
+        assert response.code == 401
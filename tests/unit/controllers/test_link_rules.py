@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+
+from resolution.controllers import link_rules
+
+
+def test_reference_link_rule_is_compiled_once():
+    reference_links = {'redirect_id_type': 'ISBN', 'links': {'isbn': 'http://example.com/{source_id}'}}
+
+    rule = link_rules.reference_link_rule(reference_links)
+
+    assert rule.id_type == 'isbn'
+    assert rule.valid
+    assert rule.uses_source_id
+    assert rule.format(source_id='1234') == 'http://example.com/1234'
+    assert link_rules.reference_link_rule(dict(reference_links)) is rule
+
+
+@pytest.mark.parametrize('reference_links', [
+    None,
+    {},
+    {'redirect_id_type': None},
+    {'redirect_id_type': 'isbn'},
+    {'redirect_id_type': 'isbn', 'links': {'doi': 'http://example.com/{source_id}'}},
+])
+def test_no_reference_link_rule(reference_links):
+    assert link_rules.reference_link_rule(reference_links) is None
+
+
+@pytest.mark.parametrize('template', [
+    'http://example.com/{source_id}/{offer_id}',
+    'http://example.com/{source_id',
+    'http://example.com/{source_id}/{0}',
+])
+def test_invalid_reference_link_rule(template):
+    rule = link_rules.reference_link_rule({'redirect_id_type': 'isbn', 'links': {'isbn': template}})
+
+    assert not rule.valid
+
+
+def test_payment_link_rule():
+    rule = link_rules.payment_link_rule({'source_id_type': 'isbn', 'url': 'http://pay/{source_id}/{offer_id}'})
+
+    assert rule.valid
+    assert rule.format(source_id='1234', offer_id='1') == 'http://pay/1234/1'
+
+
+def test_index_source_ids():
+    index = link_rules.index_source_ids([
+        {'source_id_type': 'ISBN', 'source_id': '1'},
+        {'source_id_type': 'some%20type', 'source_id': 'a%2Fb'},
+        {'source_id_type': 'isbn', 'source_id': '2'},
+    ])
+
+    assert index == {'isbn': '2', 'some type': 'a/b'}
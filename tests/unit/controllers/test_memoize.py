@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import Mock, patch
+from tornado import gen
+from tornado.concurrent import Future
+
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import deadlines, memoize
+from resolution.controllers.clients import UpstreamUnavailable
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = memoize.LRUCache(2)
+    cache.set('a', 1, 60)
+    cache.set('b', 2, 60)
+    cache.get('a')
+    cache.set('c', 3, 60)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.num_evictions == 1
+
+
+def test_lru_cache_bounded_by_bytes():
+    cache = memoize.LRUCache(100, max_bytes=200)
+    cache.set('a', 'x' * 100, 60)
+    cache.set('b', 'x' * 100, 60)
+
+    assert len(cache) == 1
+    assert 'b' in cache
+    assert cache.bytes <= 200
+
+
+def test_memoize_caches_result():
+    fn = Mock(return_value='result')
+    memoized = memoize.Memoize(fn)
+
+    assert memoized('a') == 'result'
+    assert memoized('a') == 'result'
+
+    assert fn.call_count == 1
+    assert memoized.num_misses == 1
+    assert memoized.num_hits == 1
+
+
+@patch('resolution.controllers.memoize.time')
+def test_memoize_refreshes_expired_entry(time):
+    time.time.return_value = 1000
+    fn = Mock(return_value='result')
+    memoized = memoize.Memoize(fn)
+
+    memoized('a')
+    time.time.return_value = 1000 + memoize.options.memoize_seconds + 1
+    memoized('a')
+
+    assert fn.call_count == 2
+    assert memoized.num_refreshes == 1
+
+
+@gen_test
+def test_memoize_coroutine_caches_result():
+    fn = Mock(return_value=make_future('result'))
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    first = yield memoized('a')
+    second = yield memoized('a')
+
+    assert first == second == 'result'
+    assert fn.call_count == 1
+
+
+@gen_test
+def test_memoize_coroutine_coalesces_concurrent_calls():
+    pending = Future()
+    fn = Mock(return_value=pending)
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    first = memoized('a')
+    second = memoized('a')
+    pending.set_result('result')
+    results = yield [first, second]
+
+    assert results == ['result', 'result']
+    assert fn.call_count == 1
+    assert memoized.num_coalesced == 1
+    assert memoized.in_flight == {}
+
+
+@gen_test
+def test_memoize_coroutine_does_not_cache_errors():
+    pending = Future()
+    fn = Mock(side_effect=[pending, make_future('result')])
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    first = memoized('a')
+    second = memoized('a')
+    pending.set_exception(ValueError('upstream error'))
+
+    for future in (first, second):
+        with pytest.raises(ValueError):
+            yield future
+
+    result = yield memoized('a')
+
+    assert result == 'result'
+    assert fn.call_count == 2
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+@gen_test
+def test_memoize_coroutine_serves_stale_while_refreshing(time, options):
+    options.memoize_backend = 'local'
+    options.memoize_max_items = 10
+    options.memoize_max_bytes = 0
+    options.memoize_negative_seconds = 0
+    options.memoize_seconds = 60
+    options.memoize_stale_seconds = 30
+    time.time.return_value = 1000
+    fn = Mock(side_effect=[make_future('old'), make_future('new')])
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    time.time.return_value = 1070
+    stale = yield memoized('a')
+    # let the background refresh run
+    yield gen.moment
+    fresh = yield memoized('a')
+
+    assert stale == 'old'
+    assert fresh == 'new'
+    assert fn.call_count == 2
+    assert memoized.num_stale_hits == 1
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+@gen_test
+def test_memoize_coroutine_serves_stale_on_error(time, options):
+    options.memoize_backend = 'local'
+    options.memoize_max_items = 10
+    options.memoize_max_bytes = 0
+    options.memoize_negative_seconds = 0
+    options.memoize_seconds = 60
+    options.memoize_stale_seconds = 0
+    options.memoize_stale_if_error_seconds = 600
+    time.time.return_value = 1000
+    error = Future()
+    error.set_exception(ValueError('upstream error'))
+    fn = Mock(side_effect=[make_future('old'), error])
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    time.time.return_value = 1070
+    result = yield memoized('a')
+
+    assert result == 'old'
+    assert memoized.num_stale_errors == 1
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+@gen_test
+def test_memoize_coroutine_does_not_serve_stale_when_not_found(time, options):
+    options.memoize_backend = 'local'
+    options.memoize_max_items = 10
+    options.memoize_max_bytes = 0
+    options.memoize_negative_seconds = 0
+    options.memoize_seconds = 60
+    options.memoize_stale_seconds = 0
+    options.memoize_stale_if_error_seconds = 600
+    time.time.return_value = 1000
+    not_found = Future()
+    not_found.set_exception(HTTPError(404, 'Unknown provider'))
+    fn = Mock(side_effect=[make_future('old'), not_found])
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    time.time.return_value = 1070
+    with pytest.raises(HTTPError):
+        yield memoized('a')
+
+    assert memoized.num_stale_errors == 0
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+@gen_test
+def test_memoize_coroutine_serves_stale_while_circuit_open(time, options):
+    options.memoize_backend = 'local'
+    options.memoize_max_items = 10
+    options.memoize_max_bytes = 0
+    options.memoize_negative_seconds = 0
+    options.memoize_seconds = 60
+    options.memoize_stale_seconds = 0
+    options.memoize_stale_if_error_seconds = 600
+    time.time.return_value = 1000
+    unavailable = UpstreamUnavailable(503, 'Service unavailable')
+    errors = []
+    for _ in range(2):
+        errors.append(Future())
+        errors[-1].set_exception(unavailable)
+    fn = Mock(side_effect=[make_future('old')] + errors)
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    time.time.return_value = 1070
+    result = yield memoized('a')
+    time.time.return_value = 5000
+    with pytest.raises(UpstreamUnavailable):
+        yield memoized('a')
+
+    assert result == 'old'
+    assert memoized.num_stale_errors == 1
+
+
+@gen_test
+def test_memoize_coroutine_caches_not_found():
+    not_found = Future()
+    not_found.set_exception(HTTPError(404, 'Unknown provider'))
+    fn = Mock(return_value=not_found)
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            yield memoized('a')
+
+    assert fn.call_count == 1
+    assert memoized.num_negative_hits == 1
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+@gen_test
+def test_memoize_coroutine_caches_not_found_after_value_expires(time, options):
+    options.memoize_backend = 'local'
+    options.memoize_max_items = 10
+    options.memoize_max_bytes = 0
+    options.memoize_negative_max_items = 10
+    options.memoize_negative_seconds = 300
+    options.memoize_seconds = 60
+    options.memoize_stale_seconds = 0
+    options.memoize_stale_if_error_seconds = 0
+    time.time.return_value = 1000
+    not_found = Future()
+    not_found.set_exception(HTTPError(404, 'Unknown provider'))
+    fn = Mock(side_effect=[make_future('old'), not_found])
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    time.time.return_value = 1070
+    for _ in range(3):
+        with pytest.raises(HTTPError):
+            yield memoized('a')
+
+    assert fn.call_count == 2
+    assert memoized.num_negative_hits == 2
+
+
+@gen_test
+def test_memoize_coroutine_does_not_cache_other_errors():
+    error = Future()
+    error.set_exception(HTTPError(500, 'Unexpected error'))
+    fn = Mock(return_value=error)
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            yield memoized('a')
+
+    assert fn.call_count == 2
+    assert memoized.num_negative_hits == 0
+
+
+@patch('resolution.controllers.memoize.options')
+@patch('resolution.controllers.memoize.time')
+def test_ttl_cache_expires_entries(time, options):
+    options.memoize_backend = 'local'
+    options.test_max_items = 10
+    options.test_seconds = 60
+    time.time.return_value = 1000
+    cache = memoize.TTLCache('test', 'test_max_items', 'test_seconds')
+    cache.add('a', 1)
+
+    assert cache.lookup('a') == 1
+    time.time.return_value = 1061
+    assert cache.lookup('a') is None
+    assert (cache.num_hits, cache.num_misses) == (1, 1)
+
+
+@patch('resolution.controllers.memoize.options')
+def test_ttl_cache_disabled(options):
+    options.memoize_backend = 'local'
+    options.test_max_items = 10
+    options.test_seconds = 0
+    cache = memoize.TTLCache('test', 'test_max_items', 'test_seconds')
+    cache.add('a', 1)
+
+    assert cache.lookup('a') is None
+    assert len(cache.cache) == 0
+
+
+@patch('resolution.controllers.deadlines.options')
+@gen_test
+def test_memoize_coroutine_callers_wait_until_their_own_deadline(options):
+    remaining = []
+
+    @gen.coroutine
+    def fn(key):
+        remaining.append(deadlines.remaining())
+        yield gen.sleep(0.05)
+        raise gen.Return(key.upper())
+
+    memoized = memoize.MemoizeCoroutine(fn)
+    options.request_deadline_seconds = 0.01
+    hurried = deadlines.run(memoized, 'a')
+    options.request_deadline_seconds = 0
+    patient = memoized('a')
+
+    with pytest.raises(HTTPError) as exc:
+        yield hurried
+    result = yield patient
+
+    assert exc.value.status_code == 504
+    assert result == 'A'
+    assert remaining == [None]
+    assert memoized.num_coalesced == 1
+
+
+@gen_test
+def test_memoize_coroutine_keyed():
+    fn = Mock(return_value=make_future('result'))
+    memoized = memoize.MemoizeCoroutine.keyed(lambda name: (name.lower(),))(fn)
+
+    first = yield memoized('A')
+    second = yield memoized('a')
+
+    assert first == second == 'result'
+    fn.assert_called_once_with('A')
+    assert ('a',) in memoized.cache
+
+
+@gen_test
+def test_memoize_coroutine_stats():
+    fn = Mock(return_value=make_future('result'))
+    memoized = memoize.MemoizeCoroutine(fn)
+
+    yield memoized('a')
+    yield memoized('a')
+
+    stats = memoize.stats()[memoized.namespace]
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['in_flight'] == 0
+
+
+@patch('resolution.controllers.memoize.logging')
+def test_memoize_does_not_log_unless_debug(logging):
+    logging.getLogger.return_value.isEnabledFor.return_value = False
+    memoized = memoize.Memoize(Mock(return_value='result'))
+
+    memoized('a')
+
+    assert not logging.debug.called
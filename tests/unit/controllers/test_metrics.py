@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import cPickle
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock import MagicMock, patch
+from tornado.concurrent import Future
+
+from resolution.controllers import metrics
+
+
+@patch.dict('resolution.controllers.metrics._histograms', clear=True)
+def test_observe():
+    metrics.observe('test_seconds', 0.003, function='f')
+    metrics.observe('test_seconds', 20, function='f')
+
+    histogram = metrics.snapshot()['histograms'][('test_seconds', (('function', 'f'),))]
+    assert histogram[metrics.BUCKETS.index(0.005)] == 1
+    assert histogram[len(metrics.BUCKETS)] == 1
+    assert histogram[-1] == 20.003
+
+
+@patch.dict('resolution.controllers.metrics._histograms', clear=True)
+def test_timed():
+    future = Future()
+    metrics.timed('test_seconds', future, function='f')
+    assert metrics.snapshot()['histograms'] == {}
+
+    future.set_result(None)
+
+    assert sum(metrics.snapshot()['histograms'][('test_seconds', (('function', 'f'),))][:-1]) == 1
+
+
+@patch.dict('resolution.controllers.metrics._caches', clear=True)
+@patch.dict('resolution.controllers.metrics._histograms', clear=True)
+def test_exposition():
+    metrics.register_cache('test', MagicMock(num_hits=3, num_misses=1))
+    metrics.observe('resolution_upstream_seconds', 0.2, function='f')
+
+    text = metrics.exposition(metrics.snapshot())
+
+    assert '# TYPE resolution_upstream_seconds histogram' in text
+    assert 'resolution_upstream_seconds_bucket{function="f",le="0.1"} 0' in text
+    assert 'resolution_upstream_seconds_bucket{function="f",le="0.25"} 1' in text
+    assert 'resolution_upstream_seconds_bucket{function="f",le="+Inf"} 1' in text
+    assert 'resolution_upstream_seconds_count{function="f"} 1' in text
+    assert 'resolution_cache_hits_total{cache="test"} 3' in text
+    assert 'resolution_cache_misses_total{cache="test"} 1' in text
+
+
+@patch.dict('resolution.controllers.metrics._caches', clear=True)
+@patch.dict('resolution.controllers.metrics._histograms', clear=True)
+def test_collect_merges_processes():
+    directory = tempfile.mkdtemp()
+    try:
+        with patch('resolution.controllers.metrics._directory', directory):
+            metrics.register_cache('test', MagicMock(num_hits=3, num_misses=1))
+            metrics.observe('test_seconds', 0.2)
+            metrics.write_snapshot()
+
+            # another process' snapshot
+            with open(os.path.join(directory, '1.metrics'), 'wb') as f:
+                cPickle.dump(metrics.snapshot(), f)
+
+            collected = metrics.collect()
+    finally:
+        shutil.rmtree(directory)
+
+    assert collected['counters'][('resolution_cache_hits_total', (('cache', 'test'),))] == 6
+    assert sum(collected['histograms'][('test_seconds', ())][:-1]) == 2
+
+
+@patch.dict('resolution.controllers.metrics._caches', clear=True)
+@patch.dict('resolution.controllers.metrics._histograms', clear=True)
+def test_collect_skips_exited_and_stale_processes():
+    dead = subprocess.Popen([sys.executable, '-c', '']).pid
+    os.waitpid(dead, 0)
+    directory = tempfile.mkdtemp()
+    try:
+        with patch('resolution.controllers.metrics._directory', directory):
+            metrics.register_cache('test', MagicMock(num_hits=3, num_misses=1))
+            metrics.write_snapshot()
+
+            dead_snapshot = os.path.join(directory, '{}.metrics'.format(dead))
+            stale_snapshot = os.path.join(directory, '1.metrics')
+            for filename in (dead_snapshot, stale_snapshot):
+                with open(filename, 'wb') as f:
+                    cPickle.dump(metrics.snapshot(), f)
+            stale = time.time() - (metrics.STALE_SNAPSHOTS + 1) * metrics.options.metrics_snapshot_seconds
+            os.utime(stale_snapshot, (stale, stale))
+
+            collected = metrics.collect()
+
+            assert not os.path.exists(dead_snapshot)
+            assert os.path.exists(stale_snapshot)
+    finally:
+        shutil.rmtree(directory)
+
+    assert collected['counters'][('resolution_cache_hits_total', (('cache', 'test'),))] == 3
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import MagicMock
+from tornado.httputil import HTTPHeaders
+
+from resolution.controllers import page_cache
+
+
+def _handler(**headers):
+    handler = MagicMock()
+    handler.render_string.return_value = '<html>page</html>'
+    handler.request.headers = HTTPHeaders(headers)
+    handler.check_etag_header.return_value = False
+    return handler
+
+
+def test_template_loader_compiles_templates():
+    loader = page_cache.template_loader()
+
+    assert 'asset_template.html' in loader.templates
+    assert 'provider_template.html' in loader.templates
+    assert 'error.html' in loader.templates
+
+
+def test_render_stores_page():
+    pages = page_cache.PageCache()
+    handler = _handler()
+
+    pages.render(handler, ('provider', 'org1'), 'provider_template.html', data={})
+
+    handler.render_string.assert_called_once_with('provider_template.html', data={})
+    handler.finish.assert_called_once_with('<html>page</html>')
+
+    page = pages.lookup(('provider', 'org1'))
+    assert page.html == '<html>page</html>'
+    handler.set_header.assert_any_call('ETag', page.etag)
+    assert pages.lookup(('provider', 'org2')) is None
+    assert pages.num_hits == 1
+    assert pages.num_misses == 1
+
+
+def test_write_not_modified_etag():
+    pages = page_cache.PageCache()
+    handler = _handler()
+    handler.check_etag_header.return_value = True
+
+    pages.write(handler, page_cache.Page('<html>page</html>', '"abc"', 1000))
+
+    handler.set_status.assert_called_once_with(304)
+    handler.finish.assert_called_once_with()
+
+
+def test_write_not_modified_since():
+    pages = page_cache.PageCache()
+    handler = _handler(**{'If-Modified-Since': 'Thu, 01 Jan 1970 00:16:40 GMT'})
+
+    pages.write(handler, page_cache.Page('<html>page</html>', '"abc"', 1000.5))
+
+    handler.set_status.assert_called_once_with(304)
+
+
+def test_write_modified_since():
+    pages = page_cache.PageCache()
+    handler = _handler(**{'If-Modified-Since': 'Thu, 01 Jan 1970 00:16:39 GMT'})
+
+    pages.write(handler, page_cache.Page('<html>page</html>', '"abc"', 1000))
+
+    assert not handler.set_status.called
+    handler.finish.assert_called_once_with('<html>page</html>')
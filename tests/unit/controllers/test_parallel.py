@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from tornado import gen
+from tornado.concurrent import Future
+
+from koi.exceptions import HTTPError
+from koi.test_helpers import gen_test
+from resolution.controllers import parallel
+
+
+@gen_test
+def test_gather_preserves_order():
+    @gen.coroutine
+    def fn(item):
+        # finish in reverse order
+        yield gen.sleep(0.001 * (5 - item))
+        raise gen.Return(item * 2)
+
+    result = yield parallel.gather(fn, range(5), concurrency=5, timeout=1)
+
+    assert result == [0, 2, 4, 6, 8]
+
+
+@gen_test
+def test_gather_limits_concurrency():
+    state = {'active': 0, 'peak': 0}
+
+    @gen.coroutine
+    def fn(item):
+        state['active'] += 1
+        state['peak'] = max(state['peak'], state['active'])
+        yield gen.moment
+        state['active'] -= 1
+        raise gen.Return(item)
+
+    result = yield parallel.gather(fn, range(10), concurrency=3, timeout=1)
+
+    assert result == range(10)
+    assert state['peak'] == 3
+
+
+@gen_test
+def test_gather_times_out():
+    with pytest.raises(HTTPError) as exc:
+        yield parallel.gather(lambda item: Future(), [1], concurrency=1, timeout=0.01)
+
+    assert exc.value.status_code == 504
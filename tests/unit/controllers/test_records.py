@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import cPickle
+import pickle
+
+import pytest
+
+from resolution.controllers import memoize
+from resolution.controllers.records import AssetDetails, Provider, Repository
+
+ORGANISATION = {
+    'id': 'org1',
+    'name': 'exampleco',
+    'website': 'http://example.com',
+    'logo': 'http://example.com/{id}.png',
+    'reference_links': {'redirect_id_type': 'isbn', 'links': {'isbn': 'http://example.com/{source_id}'}},
+    'created_by': 'user1',
+    'state': 'approved',
+    'users': [{'id': 'user{}'.format(i), 'role': 'admin'} for i in range(50)]
+}
+
+ASSET = {'@graph': [
+    {'@id': 'id:1', '@type': 'op:Id', 'op:value': {'@value': '1234'}, 'op:id_type': {'@id': 'hub:isbn'}},
+    {'@id': 'id:asset', '@type': ['op:Asset'], 'dcterm:description': {'@value': 'A book'}},
+    {'@id': 'id:other', '@type': 'op:Offer', 'dcterm:title': {'@value': 'Not used'}}
+]}
+
+
+def test_provider_is_read_like_a_dict():
+    provider = Provider.from_resource(ORGANISATION)
+
+    assert provider['name'] == 'exampleco'
+    assert provider.get('payment') is None
+    assert provider.get('email', '') == ''
+    assert 'users' not in provider
+    assert provider['logo'].format(**provider) == 'http://example.com/org1.png'
+    assert dict(provider) == dict((k, ORGANISATION[k]) for k in ('id', 'name', 'website', 'logo', 'reference_links'))
+
+    with pytest.raises(KeyError):
+        provider['email']
+
+
+def test_provider_copy():
+    provider = Provider(id='org1', website='example.com')
+
+    assert provider.copy(website='http://example.com') == Provider(id='org1', website='http://example.com')
+    assert provider.website == 'example.com'
+
+
+def test_repository_from_resource():
+    repository = Repository.from_resource({'id': 'repo1', 'organisation': {'id': 'org1', 'name': 'exampleco'},
+                                           'service': {'location': 'https://localhost:8003'}, 'state': 'approved'})
+
+    assert repository == Repository(id='repo1', organisation_id='org1', organisation_name='exampleco',
+                                    location='https://localhost:8003')
+
+
+def test_asset_details_from_resource():
+    details = AssetDetails.from_resource(ASSET)
+
+    assert details.ids == (('id:1', 'hub:isbn', '1234'),)
+    assert details.description == ('id:asset', 'A book')
+
+
+@pytest.mark.parametrize('module', [pickle, cPickle])
+@pytest.mark.parametrize('protocol', [0, 2])
+def test_records_can_be_pickled(module, protocol):
+    records = [Provider.from_resource(ORGANISATION), Repository(id='repo1'), AssetDetails.from_resource(ASSET)]
+
+    assert module.loads(module.dumps(records, protocol)) == records
+
+
+def test_records_are_smaller_than_resources():
+    assert memoize._approx_size(Provider.from_resource(ORGANISATION)) < memoize._approx_size(ORGANISATION) / 4
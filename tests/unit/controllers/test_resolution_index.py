@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import patch
+from tornado.options import options
+
+from resolution.controllers import resolution_index
+
+
+def test_lookup_resolved_redirect():
+    index = resolution_index.ResolutionIndex()
+    key = resolution_index.provider_asset_entry('ExampleCo', 'isbn', '1234')
+    index.add(key, 'http://example.com/1234')
+
+    assert index.lookup(resolution_index.provider_asset_entry('exampleco', 'isbn', '1234')) == 'http://example.com/1234'
+    assert index.lookup(resolution_index.asset_entry('isbn', '1234')) is None
+    assert index.num_hits == 1
+    assert index.num_misses == 1
+
+
+@patch('time.time')
+def test_lookup_expired_redirect(time):
+    time.return_value = 1000
+    index = resolution_index.ResolutionIndex()
+    key = resolution_index.hub_key_entry('https://openpermissions.org/s1/hub1/repo/asset/1234')
+    index.add(key, 'http://example.com/1234')
+
+    time.return_value = 1000 + options.resolution_index_seconds + 1
+
+    assert index.lookup(key) is None
+
+
+def test_entries_ignore_id_type_case():
+    assert resolution_index.asset_entry('ISBN', '1234') == resolution_index.asset_entry('isbn', '1234')
+    assert (resolution_index.provider_asset_entry('ExampleCo', 'ISBN', '1234') ==
+            resolution_index.provider_asset_entry('exampleco', 'isbn', '1234'))
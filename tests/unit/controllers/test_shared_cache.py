@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import os
+
+from chub.handlers import ResponseObject
+from mock import Mock, patch
+
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import memoize, shared_cache
+
+
+def test_shared_cache_round_trip():
+    region = shared_cache.SharedRegion(8, 1024)
+    cache = shared_cache.SharedMemoryCache('test', region)
+    cache.set(('a', 'b'), ResponseObject({'data': {'id': 'a'}}), 60)
+
+    entry = cache.get(('a', 'b'))
+
+    assert entry.value['data'] == {'id': 'a'}
+    assert entry.expires > entry.timestamp
+    assert len(cache) == 1
+
+
+def test_shared_cache_namespaces_are_separate():
+    region = shared_cache.SharedRegion(8, 1024)
+    first = shared_cache.SharedMemoryCache('first', region)
+    second = shared_cache.SharedMemoryCache('second', region)
+    first.set(('a',), 1, 60)
+
+    assert second.get(('a',)) is None
+    second.clear()
+    assert first.get(('a',)).value == 1
+
+
+def test_shared_cache_skips_oversized_entries():
+    region = shared_cache.SharedRegion(8, 128)
+    cache = shared_cache.SharedMemoryCache('test', region)
+    cache.set(('a',), 'x' * 1000, 60)
+
+    assert cache.get(('a',)) is None
+    assert cache.num_oversized == 1
+
+
+def test_shared_cache_evicts_when_bucket_full():
+    region = shared_cache.SharedRegion(4, 256)
+    cache = shared_cache.SharedMemoryCache('test', region)
+    for i in range(5):
+        cache.set((str(i),), i, 60 + i)
+
+    assert len(cache) == 4
+    assert cache.num_evictions == 1
+    assert cache.get(('0',)) is None
+
+
+def test_shared_cache_visible_to_forked_process():
+    region = shared_cache.SharedRegion(8, 1024)
+    cache = shared_cache.SharedMemoryCache('test', region)
+
+    pid = os.fork()
+    if pid == 0:
+        cache.set(('a',), 'from child', 60)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert cache.get(('a',)).value == 'from child'
+
+
+@patch('resolution.controllers.memoize.options')
+@gen_test
+def test_memoize_uses_configured_backend(options):
+    options.memoize_backend = 'test'
+    options.memoize_seconds = 60
+    options.memoize_negative_seconds = 0
+    stand_in = memoize.LRUCache(10)
+    factory = Mock(return_value=stand_in)
+    fn = Mock(return_value=make_future('result'))
+
+    with patch.dict(memoize.BACKENDS, {'test': factory}):
+        result = yield memoize.MemoizeCoroutine(fn)('a')
+
+    assert result == 'result'
+    assert stand_in.get(('a',)).value == 'result'
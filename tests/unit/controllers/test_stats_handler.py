@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import os
+
+from koi import base
+
+from resolution.controllers import clients, stats_handler
+from resolution.controllers.hub_key_handler import _get_provider
+
+
+def test_stats():
+    stats = stats_handler.stats()
+
+    assert stats['pid'] == os.getpid()
+    assert 'hits' in stats['memoize'][_get_provider.namespace]
+    assert 'hits' in stats['resolution_index']
+    assert 'hits' in stats['pages']
+    assert isinstance(stats['upstreams'], list)
+
+
+def test_stats_require_read_access():
+    assert stats_handler.StatsHandler.METHOD_ACCESS['GET'] == base.BaseHandler.READ_ACCESS
+
+
+def test_stats_do_not_include_upstream_urls():
+    clients.get_upstream('https://localhost:8006')
+
+    assert all('url' not in upstream for upstream in stats_handler.stats()['upstreams'])
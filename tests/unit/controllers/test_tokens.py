@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import time
+
+from mock import patch
+from tornado.concurrent import Future
+
+from chub.oauth2 import Read
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import tokens
+
+OPTIONS = {'service_id': 'resolution', 'client_secret': 'secret', 'url_auth': 'https://localhost:8007',
+           'token_refresh_seconds': 120}
+
+
+@patch('resolution.controllers.tokens.options', **OPTIONS)
+@patch('resolution.controllers.tokens.get_client')
+@gen_test
+def test_token_is_reused_until_expiry(get_client, options):
+    post = get_client.return_value.auth.token.post
+    post.return_value = make_future({'access_token': 'token', 'expiry': time.time() + 3600})
+    manager = tokens.TokenManager(Read())
+
+    first = yield manager.get()
+    second = yield manager.get()
+
+    assert first == second == 'token'
+    assert post.call_count == 1
+
+
+@patch('resolution.controllers.tokens.options', **OPTIONS)
+@patch('resolution.controllers.tokens.get_client')
+@gen_test
+def test_expired_token_is_refreshed(get_client, options):
+    post = get_client.return_value.auth.token.post
+    post.side_effect = [make_future({'access_token': 'old', 'expiry': time.time() + 1}),
+                        make_future({'access_token': 'new', 'expiry': time.time() + 3600})]
+    manager = tokens.TokenManager(Read())
+
+    yield manager.get()
+    token = yield manager.get()
+
+    assert token == 'new'
+    assert post.call_count == 2
+
+
+@patch('resolution.controllers.tokens.options', **OPTIONS)
+@patch('resolution.controllers.tokens.get_client')
+@gen_test
+def test_concurrent_refreshes_are_coalesced(get_client, options):
+    pending = Future()
+    post = get_client.return_value.auth.token.post
+    post.return_value = pending
+    manager = tokens.TokenManager(Read())
+
+    first = manager.get()
+    second = manager.get()
+    pending.set_result({'access_token': 'token', 'expiry': time.time() + 3600})
+    result = yield [first, second]
+
+    assert result == ['token', 'token']
+    assert post.call_count == 1
+    assert manager.in_flight is None
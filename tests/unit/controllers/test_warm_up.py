@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import Mock, call, patch
+
+from koi.test_helpers import make_future, gen_test
+from resolution.controllers import warm_up
+from resolution.controllers.records import Provider, Repository
+
+
+@patch('resolution.controllers.warm_up._get_repository')
+@patch('resolution.controllers.warm_up._get_provider_by_name')
+@patch('resolution.controllers.warm_up._get_provider')
+@patch('resolution.controllers.warm_up.options', url_accounts='https://localhost:8006', warm_up_page_size=100,
+       warm_up_max_items=10000)
+@patch('resolution.controllers.warm_up.get_client')
+@gen_test
+def test_warm_up_primes_caches(get_client, options, _get_provider, _get_provider_by_name, _get_repository):
+    organisation = {'id': 'org1', 'name': 'exampleco'}
+    repository = {'id': 'repo1', 'organisation': {'id': 'org1'}, 'service': {'location': 'https://localhost:8003'}}
+    accounts = get_client.return_value.accounts
+    accounts.organisations.get.return_value = make_future({'data': [organisation]})
+    accounts.repositories.get.return_value = make_future({'data': [repository, {'id': 'repo2'}]})
+
+    result = yield warm_up.warm_up()
+
+    assert result == (1, 1)
+    _get_provider.prime.assert_called_once_with(('org1',), Provider(id='org1', name='exampleco'))
+    _get_provider_by_name.prime.assert_called_once_with(('exampleco',), Provider(id='org1', name='exampleco'))
+    _get_repository.prime.assert_called_once_with(('repo1',), Repository(id='repo1', organisation_id='org1',
+                                                                          location='https://localhost:8003'))
+
+
+@patch('resolution.controllers.warm_up.options', warm_up_page_size=2, warm_up_max_items=10)
+@gen_test
+def test_fetch_all_pages(options):
+    resource = Mock()
+    resource.get.side_effect = [make_future({'data': [1, 2]}), make_future({'data': [3]})]
+
+    result = yield warm_up._fetch_all(resource)
+
+    assert result == [1, 2, 3]
+    assert resource.get.call_args_list == [call(page=1, page_size=2), call(page=2, page_size=2)]
+
+
+@patch('resolution.controllers.warm_up.options', warm_up_page_size=2, warm_up_max_items=3)
+@gen_test
+def test_fetch_all_up_to_max_items(options):
+    resource = Mock()
+    resource.get.side_effect = [make_future({'data': [1, 2]}), make_future({'data': [3, 4]})]
+
+    result = yield warm_up._fetch_all(resource)
+
+    assert result == [1, 2, 3]
+    assert resource.get.call_count == 2
+
+
+@patch('resolution.controllers.warm_up.options', warm_up_page_size=2, warm_up_max_items=10)
+@gen_test
+def test_fetch_all_without_paging(options):
+    resource = Mock()
+    resource.get.return_value = make_future({'data': [1, 2, 3, 4]})
+
+    result = yield warm_up._fetch_all(resource)
+
+    assert result == [1, 2, 3, 4]
+    assert resource.get.call_count == 1
+
+
+@patch('resolution.controllers.warm_up.IOLoop')
+@patch('resolution.controllers.warm_up.warm_up')
+@patch('resolution.controllers.warm_up.options', warm_up_interval_seconds=100)
+@gen_test
+def test_run_schedules_next_with_jitter(options, warm_up_, IOLoop):
+    warm_up_.return_value = make_future((1, 1))
+
+    yield warm_up._run()
+
+    delay, callback = IOLoop.current.return_value.call_later.call_args[0]
+    assert 100 * (1 - warm_up.JITTER) <= delay <= 100 * (1 + warm_up.JITTER)
+    assert callback is warm_up._run
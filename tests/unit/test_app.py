@@ -14,13 +14,17 @@ from tornado.web import Application
 import resolution.app
 
 
+@patch('resolution.app.invalidation')
+@patch('resolution.app.metrics')
+@patch('resolution.app.warm_up')
 @patch('resolution.app.options')
 @patch('tornado.ioloop.IOLoop.instance')
 @patch('resolution.app.make_application')
 @patch('resolution.app.koi.make_server')
 @patch('resolution.app.koi.load_config')
 def test_main_configure_and_run_service(load_config, make_server,
-                                        make_application, instance, options):
+                                        make_application, instance, options,
+                                        warm_up, metrics, invalidation):
     server = make_server.return_value
     options.processes = 1
     # MUT
@@ -31,6 +35,11 @@ def test_main_configure_and_run_service(load_config, make_server,
     make_server.call_count == 1
     server.start.assert_called_once_with(1)
     instance.call_count == 1
+    warm_up.start.assert_called_once_with()
+    assert metrics.create_directory.call_count == 1
+    metrics.start.assert_called_once_with()
+    assert invalidation.create_directory.call_count == 1
+    invalidation.start.assert_called_once_with()
 
 
 def test_make_application():